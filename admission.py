@@ -0,0 +1,139 @@
+import math
+import threading
+import time
+from collections import deque
+
+
+# Контроль допуска к тяжелым эндпоинтам (оформление заказа, запись в корзину):
+# не больше max_concurrent запросов одновременно, остальные ждут в очереди строго
+# по порядку прихода. Переполненная очередь и слишком долгое ожидание отклоняются
+# сразу, с позицией и оценкой времени ожидания, вместо таймаута на стороне БД.
+
+
+class AdmissionRejected(Exception):
+    """Запрос не допущен: очередь полна или ожидание превысило max_wait."""
+
+    def __init__(self, name, reason, position, eta):
+        super().__init__(f'{name}: {reason} (position {position}, eta {eta:.1f}s)')
+        self.name = name
+        self.reason = reason # 'queue_full' | 'timeout'
+        self.position = position
+        self.eta = eta
+
+    @property
+    def retry_after(self):
+        return max(1, math.ceil(self.eta))
+
+
+class _Waiter:
+    __slots__ = ('event', 'admitted')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.admitted = False
+
+
+class Admission:
+    """Допуск, выданный AdmissionController.enter(); release() освобождает место."""
+
+    __slots__ = ('_controller', '_started', 'position', 'waited')
+
+    def __init__(self, controller, position, waited):
+        self._controller = controller
+        self._started = time.monotonic()
+        self.position = position # Позиция в очереди при входе, 0 - без ожидания
+        self.waited = waited # Сколько ждал в очереди, сек
+
+    def release(self):
+        if self._controller is not None:
+            controller, self._controller = self._controller, None
+            controller.release(time.monotonic() - self._started)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class AdmissionController:
+    def __init__(self, name, max_concurrent, max_queue, max_wait, initial_service_time=0.05):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.max_wait = max_wait # Дольше в очереди не ждем, сек
+        self._lock = threading.Lock()
+        self._queue = deque()
+        self._active = 0
+        self._service_time = initial_service_time # Скользящее среднее времени обработки, сек
+
+        self.admitted = 0
+        self.queued = 0
+        self.rejected_full = 0
+        self.rejected_timeout = 0
+
+    def _eta(self, position):
+        # Через сколько освободится место для позиции position в очереди
+        return position * self._service_time / self.max_concurrent
+
+    def estimate(self):
+        """(позиция, eta) для запроса, пришедшего сейчас."""
+        with self._lock:
+            position = len(self._queue) + (1 if self._active >= self.max_concurrent else 0)
+            return position, self._eta(position)
+
+    def enter(self):
+        with self._lock:
+            if self._active < self.max_concurrent and not self._queue:
+                self._active += 1
+                self.admitted += 1
+                return Admission(self, 0, 0.0)
+            position = len(self._queue) + 1
+            eta = self._eta(position)
+            if len(self._queue) >= self.max_queue:
+                self.rejected_full += 1
+                raise AdmissionRejected(self.name, 'queue_full', position, eta)
+            if eta > self.max_wait:
+                # Заведомо не дождется своей очереди - отказываем сразу
+                self.rejected_timeout += 1
+                raise AdmissionRejected(self.name, 'timeout', position, eta)
+            waiter = _Waiter()
+            self._queue.append(waiter)
+            self.queued += 1
+
+        started = time.monotonic()
+        waiter.event.wait(self.max_wait)
+        with self._lock:
+            if not waiter.admitted:
+                # Место могло освободиться уже после таймаута - проверяем под блокировкой
+                self._queue.remove(waiter)
+                self.rejected_timeout += 1
+                raise AdmissionRejected(self.name, 'timeout', position, self._eta(position))
+            self.admitted += 1
+        return Admission(self, position, time.monotonic() - started)
+
+    def release(self, service_time):
+        with self._lock:
+            self._service_time += 0.1 * (service_time - self._service_time)
+            if self._queue:
+                # Место передается первому в очереди, счетчик активных не меняется
+                waiter = self._queue.popleft()
+                waiter.admitted = True
+                waiter.event.set()
+            else:
+                self._active -= 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'max_concurrent': self.max_concurrent,
+                'max_queue': self.max_queue,
+                'max_wait': self.max_wait,
+                'active': self._active,
+                'waiting': len(self._queue),
+                'avg_service_time': round(self._service_time, 4),
+                'admitted': self.admitted,
+                'queued': self.queued,
+                'rejected_queue_full': self.rejected_full,
+                'rejected_timeout': self.rejected_timeout,
+            }
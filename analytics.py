@@ -0,0 +1,165 @@
+import logging
+import os
+import threading
+from datetime import date, timedelta
+
+
+logger = logging.getLogger(__name__)
+
+
+# Отчеты по продажам из дневных агрегатов sales_daily (migrations/008_sales_rollups.sql).
+# Триггеры дописывают приращения в sales_delta (migrations/009_sales_delta.sql), а
+# SalesDeltaFold в фоне переносит их в sales_daily. Запросы здесь читают не историю
+# заказов, а sales_daily_live - несколько строк на день и ключ плюс еще не перенесенное.
+
+DIMENSIONS = ('version', 'album', 'artist', 'category')
+METRICS = ('units', 'revenue', 'discount_amount')
+
+MAX_RANGE_DAYS = 3660
+
+# Подписи ключей для топа
+_LABEL_SQL = {
+    'version': '''
+        SELECT av.id::text AS key, av.version_name AS name, a.id AS album_id, a.title AS album_title,
+               ar.id AS artist_id, ar.name AS artist_name
+        FROM album_versions av
+        JOIN albums a ON a.id = av.album_id
+        JOIN artists ar ON ar.id = a.artist_id
+        WHERE av.id::text = ANY(%s)
+    ''',
+    'album': '''
+        SELECT a.id::text AS key, a.title AS name, ar.id AS artist_id, ar.name AS artist_name
+        FROM albums a
+        JOIN artists ar ON ar.id = a.artist_id
+        WHERE a.id::text = ANY(%s)
+    ''',
+    'artist': '''
+        SELECT ar.id::text AS key, ar.name AS name, ar.category
+        FROM artists ar
+        WHERE ar.id::text = ANY(%s)
+    ''',
+}
+
+
+def date_range(date_from=None, date_to=None, default_days=30):
+    """(date_from, date_to) из ISO-строк; по умолчанию - последние default_days дней.
+    Ошибки - ValueError."""
+    try:
+        end = date.fromisoformat(date_to) if date_to else date.today()
+        start = date.fromisoformat(date_from) if date_from else end - timedelta(days=default_days - 1)
+    except ValueError:
+        raise ValueError('Dates must be YYYY-MM-DD')
+    if start > end:
+        raise ValueError('date_from must not be after date_to')
+    if (end - start).days >= MAX_RANGE_DAYS:
+        raise ValueError(f'Range must not exceed {MAX_RANGE_DAYS} days')
+    return start, end
+
+
+def sales_series(cur, dimension, key, date_from, date_to):
+    """Продажи по дням (включая дни без продаж) и итог за период.
+    key=None - сумма по всем ключам измерения (для category это все продажи)."""
+    cur.execute('''
+        SELECT d::date AS day,
+               COALESCE(SUM(s.units), 0) AS units,
+               COALESCE(SUM(s.revenue), 0) AS revenue,
+               COALESCE(SUM(s.discount_amount), 0) AS discount_amount
+        FROM generate_series(%(date_from)s::date, %(date_to)s::date, interval '1 day') d
+        LEFT JOIN sales_daily_live s
+            ON s.day = d::date AND s.dimension = %(dimension)s
+           AND (%(key)s::text IS NULL OR s.key = %(key)s::text)
+        GROUP BY d
+        ORDER BY d
+    ''', {'dimension': dimension, 'key': key, 'date_from': date_from, 'date_to': date_to})
+    series = cur.fetchall()
+    totals = {metric: sum(row[metric] for row in series) for metric in METRICS}
+    return series, totals
+
+
+def top_sales(cur, dimension, date_from, date_to, metric='revenue', limit=10):
+    """Топ-N ключей измерения за период по metric, с подписями (название, артист...)."""
+    if metric not in METRICS:
+        raise ValueError(f'Unsupported metric: {metric}')
+    cur.execute(f'''
+        SELECT key, SUM(units) AS units, SUM(revenue) AS revenue,
+               SUM(discount_amount) AS discount_amount
+        FROM sales_daily_live
+        WHERE dimension = %s AND day BETWEEN %s AND %s
+        GROUP BY key
+        ORDER BY {metric} DESC, key
+        LIMIT %s
+    ''', (dimension, date_from, date_to, limit))
+    rows = cur.fetchall()
+    if rows and dimension in _LABEL_SQL:
+        cur.execute(_LABEL_SQL[dimension], ([row['key'] for row in rows],))
+        labels = {label.pop('key'): label for label in cur.fetchall()}
+        for row in rows:
+            row.update(labels.get(row['key'], {}))
+    return rows
+
+
+def rebuild_sales(conn, date_from=None, date_to=None):
+    """Пересчитывает агрегаты за период из истории заказов. Возвращает число строк агрегатов."""
+    with conn.cursor() as cur:
+        cur.execute('SELECT rebuild_sales_rollup(%s, %s)', (date_from, date_to))
+        return cur.fetchone()[0]
+
+
+def fold_sales_delta(conn, batch_size=10000):
+    """Переносит до batch_size приращений из sales_delta в sales_daily в текущей транзакции.
+    Возвращает их число или None, если перенос уже идет в другом процессе."""
+    with conn.cursor() as cur:
+        cur.execute('SELECT fold_sales_delta(%s)', (batch_size,))
+        return cur.fetchone()[0]
+
+
+class SalesDeltaFold:
+    """Фоновый поток, периодически переносящий приращения продаж в sales_daily.
+    Из нескольких процессов переносит только один (advisory lock в fold_sales_delta)."""
+
+    def __init__(self, connect, interval=5.0, batch_size=10000):
+        self.connect = connect # Возвращает соединение; close() отдает его обратно
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='sales-fold', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def run_once(self):
+        """Переносит все накопленное пачками по batch_size, каждая в своей транзакции.
+        Возвращает число перенесенных строк."""
+        total = 0
+        conn = self.connect()
+        try:
+            while not self._stop.is_set():
+                moved = fold_sales_delta(conn, self.batch_size)
+                conn.commit()
+                if not moved:
+                    break
+                total += moved
+                if moved < self.batch_size:
+                    break
+            return total
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception:
+                logger.exception('Sales rollup fold failed')
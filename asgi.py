@@ -0,0 +1,406 @@
+"""Асинхронный режим: то же приложение за ASGI-сервером.
+
+Горячие маршруты чтения - корзина, заказы покупателя, профиль, избранное - выполняются
+корутинами на пуле asyncpg и не занимают поток, пока ждут PostgreSQL. Маршруты каталога
+отдаются из кэша ответов процесса без потока, если запись свежая. Все остальное (запись,
+админка, промахи кэша) передается Flask-приложению в пуле потоков - как в синхронном режиме.
+
+Асинхронные обработчики работают в контексте запроса Flask: маршрутизация, проверка JWT,
+обработчики ошибок и after_request (CORS, сжатие) - те же, что у синхронных, поэтому
+ответы совпадают байт в байт. Запросы и сборка ответов берутся из server.py.
+
+Нужны asyncpg и ASGI-сервер, например:
+    uvicorn asgi:app --workers 4
+Синхронный режим (server:app за WSGI-сервером) не меняется.
+"""
+import asyncio
+import functools
+import re
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from tempfile import SpooledTemporaryFile
+
+import asyncpg
+from flask import jsonify, request
+from flask_jwt_extended import decode_token, get_jwt_identity, verify_jwt_in_request
+
+import server
+from server import DB_CONFIG
+from db_pool import PoolExhausted
+from loaders import group_related, assign_related, order_items_query
+from pagination import keyset_query, keyset_result, InvalidCursor
+
+flask_app = server.create_app()
+
+flask_app.config['ASYNC_DB_POOL_MIN_SIZE'] = 2 # Соединений asyncpg при старте
+flask_app.config['ASYNC_DB_POOL_MAX_SIZE'] = 20 # Максимум соединений asyncpg на процесс
+flask_app.config['ASYNC_DB_POOL_TIMEOUT'] = 0.5 # Ожидание свободного соединения, сек
+flask_app.config['ASYNC_BRIDGE_THREADS'] = 32 # Потоков для маршрутов, выполняемых Flask
+flask_app.config['ASYNC_BODY_SPOOL_SIZE'] = 1024 * 1024 # Больше - тело запроса пишется во временный файл, байт
+
+_PLACEHOLDER = re.compile(r'%s')
+
+
+@functools.lru_cache(maxsize=256)
+def pg(sql):
+    """Запрос с %s (psycopg2) -> с $1, $2, ... (asyncpg)."""
+    counter = iter(range(1, 1000))
+    return _PLACEHOLDER.sub(lambda match: f'${next(counter)}', sql)
+
+
+def records(rows):
+    return [dict(row) for row in rows]
+
+
+def identity_user_id(identity):
+    # identity - строка id (см. login) или словарь с id
+    return int(identity['id'] if isinstance(identity, dict) else identity)
+
+
+def parse_order_key(values):
+    # Значения ключа (created_at, id) из курсора; asyncpg требует типизированные параметры
+    created_at, order_id = values
+    return datetime.fromisoformat(created_at), int(order_id)
+
+
+class AsyncDatabase:
+    def __init__(self):
+        self.pool = None
+
+    async def start(self):
+        self.pool = await asyncpg.create_pool(
+            host=DB_CONFIG['host'],
+            port=int(DB_CONFIG['port']),
+            database=DB_CONFIG['database'],
+            user=DB_CONFIG['user'],
+            password=DB_CONFIG['password'],
+            min_size=flask_app.config['ASYNC_DB_POOL_MIN_SIZE'],
+            max_size=flask_app.config['ASYNC_DB_POOL_MAX_SIZE']
+        )
+
+    async def close(self):
+        if self.pool is not None:
+            await self.pool.close()
+
+    def acquire(self):
+        return _Acquire(self.pool, flask_app.config['ASYNC_DB_POOL_TIMEOUT'])
+
+
+class _Acquire:
+    # Как у синхронного пула: не дождались соединения - PoolExhausted (503 с Retry-After)
+    def __init__(self, pool, timeout):
+        self.pool = pool
+        self.timeout = timeout
+        self.conn = None
+
+    async def __aenter__(self):
+        try:
+            self.conn = await self.pool.acquire(timeout=self.timeout)
+        except asyncio.TimeoutError:
+            raise PoolExhausted(self.timeout, flask_app.config['DB_POOL_RETRY_AFTER'])
+        return self.conn
+
+    async def __aexit__(self, *exc):
+        await self.pool.release(self.conn)
+
+
+db = AsyncDatabase()
+
+
+async def authenticate():
+    """verify_jwt_in_request() и id пользователя. Проверка отзыва токена читает состояние
+    пользователя из кэша (server.is_token_revoked); при промахе оно загружается здесь через
+    asyncpg, чтобы проверка не обращалась к БД синхронно из цикла событий."""
+    header = request.headers.get(flask_app.config['JWT_HEADER_NAME'], '')
+    try:
+        claims = decode_token(header.split(' ', 1)[-1])
+        user_id = server.user_id_of(claims[flask_app.config['JWT_IDENTITY_CLAIM']])
+    except Exception:
+        user_id = None # Ошибку токена сообщит verify_jwt_in_request
+    if user_id is not None and not server.user_state_cache.is_fresh(user_id):
+        generation = server.user_state_cache.generation
+        async with db.acquire() as conn:
+            row = await conn.fetchrow(pg(server.USER_STATE_SQL), user_id)
+        server.cache_user_state(user_id, row, generation)
+    verify_jwt_in_request()
+    return identity_user_id(get_jwt_identity())
+
+
+# ---- Асинхронные обработчики ----
+# Повторяют синхронные обработчики с тем же именем (endpoint) в server.py.
+# Возвращают то же, что view-функция Flask, или None - тогда маршрут выполняет Flask.
+
+async def cart_operations():
+    user_id = await authenticate()
+    try:
+        async with db.acquire() as conn:
+            items = records(await conn.fetch(pg(server.CART_ITEMS_SQL), user_id))
+        return jsonify(server.cart_payload(items))
+    except PoolExhausted:
+        raise
+    except Exception as e:
+        flask_app.logger.error(f"Cart operation error: {str(e)}")
+        return jsonify({'message': str(e)}), 500
+
+
+async def get_user_orders():
+    user_id = await authenticate()
+    try:
+        per_page, cursor, offset, page = server.pagination_args()
+        key_columns, key_fields = server.USER_ORDERS_KEY
+        sql, params, direction = keyset_query(
+            server.USER_ORDERS_SELECT, ['o.user_id = %s'], [user_id],
+            key_columns, per_page, cursor, offset, parse_key=parse_order_key
+        )
+        async with db.acquire() as conn:
+            rows = records(await conn.fetch(pg(sql), *params))
+            orders, next_cursor, prev_cursor = keyset_result(
+                rows, direction, key_fields, per_page, cursor, offset
+            )
+            grouped = group_related(orders, 'items')
+            if grouped:
+                assign_related(grouped, records(await conn.fetch(pg(order_items_query()), list(grouped))))
+            total_orders = await conn.fetchval(pg(server.USER_ORDER_COUNT_SQL), user_id) or 0
+
+        return jsonify({
+            'orders': orders,
+            'total': total_orders,
+            'page': page,
+            'per_page': per_page,
+            'next_cursor': next_cursor,
+            'prev_cursor': prev_cursor
+        })
+
+    except InvalidCursor as e:
+        return jsonify({'message': str(e)}), 400
+    except PoolExhausted:
+        raise
+    except Exception as e:
+        flask_app.logger.error(f"Get user orders error: {str(e)}")
+        return jsonify({'message': str(e)}), 500
+
+
+async def get_user_order(order_id):
+    user_id = await authenticate()
+    try:
+        async with db.acquire() as conn:
+            order = await conn.fetchrow(pg(server.USER_ORDER_SQL), order_id, user_id)
+            if not order:
+                return jsonify({'message': 'Order not found or access denied'}), 404
+            order = dict(order)
+            order['items'] = records(await conn.fetch(pg(server.USER_ORDER_ITEMS_SQL), order_id))
+        return jsonify(order)
+
+    except PoolExhausted:
+        raise
+    except Exception as e:
+        flask_app.logger.error(f"Get user order error: {str(e)}")
+        return jsonify({'message': str(e)}), 500
+
+
+async def get_profile():
+    user_id = await authenticate()
+    try:
+        async with db.acquire() as conn:
+            user = await conn.fetchrow(pg(server.PROFILE_SQL), user_id)
+        if not user:
+            return jsonify({'message': 'User not found'}), 404
+        return jsonify(server.profile_payload(user))
+
+    except PoolExhausted:
+        raise
+    except Exception as e:
+        return jsonify({'message': str(e)}), 500
+
+
+async def wishlist():
+    user_id = await authenticate()
+    try:
+        async with db.acquire() as conn:
+            items = records(await conn.fetch(pg(server.WISHLIST_SQL), user_id))
+        return jsonify(items)
+
+    except PoolExhausted:
+        raise
+    except Exception as e:
+        flask_app.logger.error(f"Wishlist error: {str(e)}")
+        return jsonify({'message': str(e)}), 500
+
+
+def cached_catalog_view(endpoint):
+    # Свежая запись кэша отдается из памяти (ETag, 304, сжатие - как у обработчика Flask).
+    # Любой промах - запись устарела, версия каталога не загружена, слушатель не запущен -
+    # маршрут выполняется в потоке и заполняет кэш: в цикле событий нет запросов к БД
+    async def handler(**kwargs):
+        return server.cached_catalog_response(endpoint)
+    return handler
+
+
+NATIVE_ROUTES = {
+    'cart_operations': cart_operations,
+    'get_user_orders': get_user_orders,
+    'get_user_order': get_user_order,
+    'get_profile': get_profile,
+    'wishlist': wishlist,
+    'get_albums': cached_catalog_view('get_albums'),
+    'get_album': cached_catalog_view('get_album'),
+    'get_artists_by_category': cached_catalog_view('get_artists_by_category'),
+    'get_artist': cached_catalog_view('get_artist'),
+}
+
+
+# ---- ASGI ----
+
+def build_environ(scope, body):
+    """WSGI environ из ASGI scope (для контекста запроса Flask и для моста)."""
+    server_name, server_port = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server_name,
+        'SERVER_PORT': str(server_port),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for raw_name, raw_value in scope['headers']:
+        name = raw_name.decode('latin-1').upper().replace('-', '_')
+        value = raw_value.decode('latin-1')
+        if name == 'CONTENT_TYPE' or name == 'CONTENT_LENGTH':
+            key = name
+        else:
+            key = f'HTTP_{name}'
+        environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+
+def response_headers(headers):
+    return [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+
+
+async def read_body(receive):
+    body = SpooledTemporaryFile(max_size=flask_app.config['ASYNC_BODY_SPOOL_SIZE'])
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        body.write(message.get('body', b''))
+        if not message.get('more_body'):
+            break
+    body.seek(0)
+    return body
+
+
+class AsgiApp:
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            if scope['method'] != 'GET' or not await self.native(scope, send):
+                await self.bridge(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                try:
+                    loop = asyncio.get_running_loop()
+                    loop.set_default_executor(ThreadPoolExecutor(
+                        max_workers=flask_app.config['ASYNC_BRIDGE_THREADS'], thread_name_prefix='wsgi-bridge'
+                    ))
+                    await db.start()
+                    # Ресурсы процесса (пул, NOTIFY, индекс скидок) создаются до первого запроса,
+                    # чтобы асинхронные обработчики не ждали их загрузки в цикле событий
+                    await loop.run_in_executor(None, server.init_worker)
+                except Exception as e:
+                    await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await db.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def native(self, scope, send):
+        """Выполняет маршрут асинхронным обработчиком. False - обработчика нет, нужен Flask."""
+        ctx = self.flask_app.request_context(build_environ(scope, SpooledTemporaryFile()))
+        ctx.push()
+        try:
+            rule = request.url_rule
+            handler = NATIVE_ROUTES.get(rule.endpoint) if rule is not None else None
+            if handler is None:
+                return False
+            try:
+                rv = await handler(**request.view_args)
+                if rv is None:
+                    return False
+                response = self.flask_app.make_response(rv)
+            except Exception as e:
+                try:
+                    response = self.flask_app.make_response(self.flask_app.handle_user_exception(e))
+                except Exception as unhandled:
+                    response = self.flask_app.make_response(self.flask_app.handle_exception(unhandled))
+            response = self.flask_app.process_response(response)
+            await send({
+                'type': 'http.response.start',
+                'status': response.status_code,
+                'headers': response_headers(response.headers.items())
+            })
+            for chunk in response.iter_encoded():
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+            return True
+        finally:
+            ctx.pop()
+
+    async def bridge(self, scope, receive, send):
+        # WSGI-приложение в пуле потоков; тело ответа читается по кускам, так что потоковые
+        # ответы (выгрузки, прогресс импорта) идут клиенту по мере готовности
+        loop = asyncio.get_running_loop()
+        body = await read_body(receive)
+        environ = build_environ(scope, body)
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started['status'] = int(status.split(' ', 1)[0])
+            started['headers'] = response_headers(headers)
+            return lambda data: None
+
+        try:
+            result = await loop.run_in_executor(None, self.flask_app, environ, start_response)
+            try:
+                chunks = iter(result)
+                first = await loop.run_in_executor(None, next, chunks, None)
+                await send({
+                    'type': 'http.response.start',
+                    'status': started['status'],
+                    'headers': started['headers']
+                })
+                chunk = first
+                while chunk is not None:
+                    if chunk:
+                        await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                    chunk = await loop.run_in_executor(None, next, chunks, None)
+                await send({'type': 'http.response.body', 'body': b''})
+            finally:
+                if hasattr(result, 'close'):
+                    await loop.run_in_executor(None, result.close)
+        finally:
+            body.close()
+
+
+app = AsgiApp(flask_app)
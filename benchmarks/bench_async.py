@@ -0,0 +1,206 @@
+"""Синхронный и асинхронный режим на одних маршрутах: пропускная способность и задержки.
+
+Создает во временных строках артиста, альбом, пользователя с корзиной и заказами, затем
+для каждого сервера из --targets держит --clients одновременных клиентов. Каждый клиент
+по своему keep-alive соединению по кругу запрашивает --routes; --send-delay имитирует
+медленного клиента (запрос отправляется двумя частями с паузой), --think - паузу между
+запросами. В конце печатаются запросы в секунду, p50 / p95 / p99 и ошибки; созданные
+данные удаляются. Нужна БД из DB_CONFIG с примененными миграциями.
+
+Серверы запускаются отдельно, с одинаковым числом процессов, например:
+    gunicorn --workers 1 --threads 32 --bind 127.0.0.1:8001 server:app
+    uvicorn asgi:app --workers 1 --port 8002
+
+Запуск из корня репозитория:
+    python benchmarks/bench_async.py --targets sync=http://127.0.0.1:8001 async=http://127.0.0.1:8002 \\
+        [--clients 1000] [--duration 30] [--send-delay 0.2] [--think 0]
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+import uuid
+from urllib.parse import urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from server import app, get_db_connection
+from flask_jwt_extended import create_access_token
+
+ROUTES = {
+    'cart': '/api/cart',
+    'orders': '/api/orders',
+    'order': '/api/orders/{order_id}',
+    'album': '/api/albums/{album_id}',
+    'profile': '/api/profile',
+    'wishlist': '/api/wishlist',
+}
+
+
+def setup_fixture(cur, orders):
+    tag = uuid.uuid4().hex[:8]
+    cur.execute("INSERT INTO artists (name, category) VALUES (%s, 'solo') RETURNING id", (f'bench-{tag}',))
+    artist_id = cur.fetchone()[0]
+    cur.execute('''
+        INSERT INTO albums (artist_id, title, base_price, status)
+        VALUES (%s, %s, 25.00, 'in_stock') RETURNING id
+    ''', (artist_id, f'bench-{tag}'))
+    album_id = cur.fetchone()[0]
+    cur.execute('''
+        INSERT INTO album_versions (album_id, version_name, price_diff, stock_quantity, is_limited)
+        VALUES (%s, 'standard', 0, 1000000, false) RETURNING id
+    ''', (album_id,))
+    version_id = cur.fetchone()[0]
+    cur.execute('''
+        INSERT INTO users (email, password_hash, first_name, last_name, is_admin)
+        VALUES (%s, 'x', 'Bench', 'User', false) RETURNING id
+    ''', (f'bench-{tag}@example.com',))
+    user_id = cur.fetchone()[0]
+    cur.execute('INSERT INTO cart (user_id) VALUES (%s) RETURNING id', (user_id,))
+    cart_id = cur.fetchone()[0]
+    cur.execute('INSERT INTO cart_items (cart_id, album_version_id, quantity) VALUES (%s, %s, 2)',
+                (cart_id, version_id))
+    cur.execute('INSERT INTO wishlist (user_id, album_id) VALUES (%s, %s)', (user_id, album_id))
+    order_ids = []
+    for _ in range(orders):
+        cur.execute("INSERT INTO orders (user_id, total_amount, status) VALUES (%s, 50.00, 'paid') RETURNING id",
+                    (user_id,))
+        order_ids.append(cur.fetchone()[0])
+        cur.execute('''
+            INSERT INTO order_items (order_id, album_version_id, quantity, price_per_unit, version_name)
+            VALUES (%s, %s, 2, 25.00, 'standard')
+        ''', (order_ids[-1], version_id))
+    return artist_id, album_id, user_id, cart_id, order_ids
+
+
+def teardown_fixture(cur, artist_id, album_id, user_id, cart_id):
+    cur.execute('DELETE FROM order_items WHERE order_id IN (SELECT id FROM orders WHERE user_id = %s)', (user_id,))
+    cur.execute('DELETE FROM orders WHERE user_id = %s', (user_id,))
+    cur.execute('DELETE FROM wishlist WHERE user_id = %s', (user_id,))
+    cur.execute('DELETE FROM cart_items WHERE cart_id = %s', (cart_id,))
+    cur.execute('DELETE FROM cart WHERE id = %s', (cart_id,))
+    cur.execute('DELETE FROM users WHERE id = %s', (user_id,))
+    cur.execute('DELETE FROM album_versions WHERE album_id = %s', (album_id,))
+    cur.execute('DELETE FROM albums WHERE id = %s', (album_id,))
+    cur.execute('DELETE FROM artists WHERE id = %s', (artist_id,))
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+async def read_response(reader):
+    head = await reader.readuntil(b'\r\n\r\n')
+    lines = head.decode('latin-1').split('\r\n')
+    status = int(lines[0].split(' ')[1])
+    headers = {}
+    for line in lines[1:]:
+        if ':' in line:
+            name, value = line.split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+    if headers.get('transfer-encoding') == 'chunked':
+        while True:
+            size = int((await reader.readuntil(b'\r\n')).strip(), 16)
+            await reader.readexactly(size + 2)
+            if size == 0:
+                break
+    else:
+        await reader.readexactly(int(headers.get('content-length', 0)))
+    return status, headers.get('connection') == 'close'
+
+
+async def client(host, port, paths, token, deadline, send_delay, think, timings, errors):
+    reader = writer = None
+    n = 0
+    while time.monotonic() < deadline:
+        path = paths[n % len(paths)]
+        n += 1
+        request = (f'GET {path} HTTP/1.1\r\nHost: {host}\r\nAuthorization: Bearer {token}\r\n'
+                   f'Connection: keep-alive\r\n\r\n').encode()
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection(host, port)
+            if send_delay:
+                # Медленный клиент: сервер получает запрос не сразу целиком
+                writer.write(request[:16])
+                await writer.drain()
+                await asyncio.sleep(send_delay)
+            writer.write(request[16:] if send_delay else request)
+            await writer.drain()
+            started = time.perf_counter() # Задержка - от конца запроса до конца ответа
+            status, close = await read_response(reader)
+            timings.append((time.perf_counter() - started) * 1000)
+            if status != 200:
+                errors[status] = errors.get(status, 0) + 1
+            if close:
+                writer.close()
+                writer = None
+        except (OSError, asyncio.IncompleteReadError, ValueError) as e:
+            errors[type(e).__name__] = errors.get(type(e).__name__, 0) + 1
+            if writer is not None:
+                writer.close()
+            writer = None
+        if think:
+            await asyncio.sleep(think)
+    if writer is not None:
+        writer.close()
+
+
+async def run_target(url, paths, token, clients, duration, send_delay, think):
+    parts = urlsplit(url)
+    timings, errors = [], {}
+    deadline = time.monotonic() + duration
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        client(parts.hostname, parts.port or 80, paths[n % len(paths):] + paths[:n % len(paths)],
+               token, deadline, send_delay, think, timings, errors)
+        for n in range(clients)
+    ))
+    return timings, errors, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--targets', nargs='+', required=True, help='имя=URL, например sync=http://127.0.0.1:8001')
+    parser.add_argument('--routes', nargs='+', choices=sorted(ROUTES), default=['cart', 'orders', 'order', 'album'])
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--send-delay', type=float, default=0.2, help='пауза посреди запроса, сек')
+    parser.add_argument('--think', type=float, default=0, help='пауза между запросами клиента, сек')
+    parser.add_argument('--orders', type=int, default=20)
+    args = parser.parse_args()
+
+    with app.app_context():
+        conn = get_db_connection()
+        cur = conn.cursor()
+        artist_id, album_id, user_id, cart_id, order_ids = setup_fixture(cur, args.orders)
+        conn.commit()
+        token = create_access_token(identity=str(user_id))
+
+    paths = [ROUTES[route].format(order_id=order_ids[0], album_id=album_id) for route in args.routes]
+    try:
+        print(f'clients={args.clients} duration={args.duration}s send_delay={args.send_delay}s '
+              f'routes={",".join(args.routes)}')
+        print(f'{"target":>8} {"req/s":>9} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"mean ms":>8}  errors')
+        for target in args.targets:
+            name, url = target.split('=', 1)
+            timings, errors, elapsed = asyncio.run(run_target(
+                url, paths, token, args.clients, args.duration, args.send_delay, args.think
+            ))
+            if not timings:
+                print(f'{name:>8} no successful requests  {errors}')
+                continue
+            print(f'{name:>8} {len(timings) / elapsed:>9.1f} {percentile(timings, 0.5):>8.2f} '
+                  f'{percentile(timings, 0.95):>8.2f} {percentile(timings, 0.99):>8.2f} '
+                  f'{statistics.mean(timings):>8.2f}  {errors or "-"}')
+    finally:
+        teardown_fixture(cur, artist_id, album_id, user_id, cart_id)
+        conn.commit()
+        cur.close()
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
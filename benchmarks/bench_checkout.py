@@ -0,0 +1,101 @@
+"""Задержка оформления заказа (POST /api/orders) в зависимости от размера корзины.
+
+Создает во временных строках артиста, альбом с версиями и пользователя, для каждого
+размера корзины N раз наполняет корзину и оформляет заказ через тестовый клиент Flask,
+затем удаляет все созданные данные. Нужна БД из DB_CONFIG с примененными миграциями.
+
+Запуск из корня репозитория:
+    python benchmarks/bench_checkout.py [--sizes 1 10 50] [--runs 50]
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+import uuid
+
+from psycopg2.extras import execute_values
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from server import app, get_db_connection
+from flask_jwt_extended import create_access_token
+
+
+def setup_fixture(cur, versions):
+    tag = uuid.uuid4().hex[:8]
+    cur.execute("INSERT INTO artists (name, category) VALUES (%s, 'solo') RETURNING id", (f'bench-{tag}',))
+    artist_id = cur.fetchone()[0]
+    cur.execute('''
+        INSERT INTO albums (artist_id, title, base_price, status)
+        VALUES (%s, %s, 25.00, 'in_stock') RETURNING id
+    ''', (artist_id, f'bench-{tag}'))
+    album_id = cur.fetchone()[0]
+    version_ids = [row[0] for row in execute_values(cur, '''
+        INSERT INTO album_versions (album_id, version_name, price_diff, stock_quantity, is_limited)
+        VALUES %s RETURNING id
+    ''', [(album_id, f'v{n}', n % 5, 1000000, False) for n in range(versions)], fetch=True)]
+    cur.execute('''
+        INSERT INTO users (email, password_hash, first_name, last_name, is_admin)
+        VALUES (%s, 'x', 'Bench', 'User', false) RETURNING id
+    ''', (f'bench-{tag}@example.com',))
+    user_id = cur.fetchone()[0]
+    cur.execute('INSERT INTO cart (user_id) VALUES (%s) RETURNING id', (user_id,))
+    cart_id = cur.fetchone()[0]
+    return artist_id, album_id, version_ids, user_id, cart_id
+
+
+def teardown_fixture(cur, artist_id, album_id, user_id, cart_id):
+    cur.execute('DELETE FROM order_items WHERE order_id IN (SELECT id FROM orders WHERE user_id = %s)', (user_id,))
+    cur.execute('DELETE FROM orders WHERE user_id = %s', (user_id,))
+    cur.execute('DELETE FROM cart_items WHERE cart_id = %s', (cart_id,))
+    cur.execute('DELETE FROM cart WHERE id = %s', (cart_id,))
+    cur.execute('DELETE FROM users WHERE id = %s', (user_id,))
+    cur.execute('DELETE FROM album_versions WHERE album_id = %s', (album_id,))
+    cur.execute('DELETE FROM albums WHERE id = %s', (album_id,))
+    cur.execute('DELETE FROM artists WHERE id = %s', (artist_id,))
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1, 10, 50])
+    parser.add_argument('--runs', type=int, default=50)
+    args = parser.parse_args()
+
+    with app.app_context():
+        conn = get_db_connection()
+        cur = conn.cursor()
+        fixture = setup_fixture(cur, max(args.sizes))
+        conn.commit()
+        artist_id, album_id, version_ids, user_id, cart_id = fixture
+        token = create_access_token(identity=str(user_id))
+
+    client = app.test_client()
+    headers = {'Authorization': f'Bearer {token}'}
+    try:
+        print(f'{"lines":>5} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"mean ms":>8}')
+        for size in args.sizes:
+            timings = []
+            for _ in range(args.runs):
+                execute_values(cur, 'INSERT INTO cart_items (cart_id, album_version_id, quantity) VALUES %s',
+                               [(cart_id, version_id, 1) for version_id in version_ids[:size]])
+                conn.commit()
+                started = time.perf_counter()
+                response = client.post('/api/orders', headers=headers)
+                timings.append((time.perf_counter() - started) * 1000)
+                assert response.status_code == 201, response.get_json()
+            print(f'{size:>5} {percentile(timings, 0.5):>8.2f} {percentile(timings, 0.95):>8.2f} '
+                  f'{percentile(timings, 0.99):>8.2f} {statistics.mean(timings):>8.2f}')
+    finally:
+        teardown_fixture(cur, artist_id, album_id, user_id, cart_id)
+        conn.commit()
+        cur.close()
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""Сравнение стандартного JSON-провайдера Flask и OrjsonProvider на данных,
+похожих на ответы /api/albums и /api/admin/orders.
+
+Запуск из корня репозитория:
+    python benchmarks/bench_json.py [--albums 2000] [--orders 100] [--repeat 20]
+"""
+import argparse
+import os
+import random
+import sys
+import timeit
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+
+from flask import Flask
+from flask.json.provider import DefaultJSONProvider
+from psycopg2.extras import RealDictRow
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from json_provider import OrjsonProvider
+
+
+def make_albums(count, rng):
+    albums = []
+    for album_id in range(1, count + 1):
+        album = RealDictRow({
+            'id': album_id,
+            'artist': f'Artist {rng.randint(1, 300)}',
+            'title': f'Альбом {album_id}',
+            'base_price': Decimal(rng.randint(1500, 4500)) / 100,
+            'main_image_url': f'https://cdn.example.com/albums/{album_id}.jpg',
+            'status': rng.choice(['in_stock', 'pre_order']),
+            'release_date': date(2020, 1, 1) + timedelta(days=rng.randint(0, 1800)),
+        })
+        album['versions'] = [
+            RealDictRow({
+                'id': album_id * 10 + n,
+                'version_name': f'Ver. {n}',
+                'price_diff': Decimal(rng.randint(0, 500)) / 100,
+                'stock_quantity': rng.randint(0, 500),
+            })
+            for n in range(rng.randint(1, 5))
+        ]
+        albums.append(album)
+    return albums
+
+
+def make_orders(count, rng):
+    orders = []
+    for order_id in range(1, count + 1):
+        order = RealDictRow({
+            'id': order_id,
+            'user_id': rng.randint(1, 10000),
+            'user_email': f'user{order_id}@example.com',
+            'user_full_name': 'Ким Минджи',
+            'total_amount': Decimal(rng.randint(2000, 40000)) / 100,
+            'status': rng.choice(['created', 'paid', 'shipped']),
+            'created_at': datetime(2024, 1, 1) + timedelta(minutes=rng.randint(0, 500000)),
+            'paid_at': None,
+            'tracking_number': None,
+        })
+        order['items'] = [
+            RealDictRow({
+                'id': order_id * 10 + n,
+                'order_id': order_id,
+                'album_version_id': rng.randint(1, 20000),
+                'quantity': rng.randint(1, 3),
+                'price_per_unit': Decimal(rng.randint(1500, 4500)) / 100,
+                'version_name': f'Ver. {n}',
+                'album_title': f'Альбом {n}',
+                'artist_name': f'Artist {n}',
+            })
+            for n in range(rng.randint(1, 4))
+        ]
+        orders.append(order)
+    return {'orders': orders, 'total': count, 'page': 1, 'per_page': count}
+
+
+def bench(name, payload, repeat):
+    results = {}
+    for provider_class in (DefaultJSONProvider, OrjsonProvider):
+        app = Flask(__name__)
+        app.json = provider_class(app)
+        with app.app_context():
+            body = app.json.response(payload).get_data()
+            seconds = min(timeit.repeat(lambda: app.json.response(payload), number=1, repeat=repeat))
+        results[provider_class.__name__] = (seconds, body)
+
+    (base_time, base_body), (fast_time, fast_body) = results.values()
+    assert base_body == fast_body, f'{name}: output differs from DefaultJSONProvider'
+    print(f'{name:<16} {len(base_body) / 1024:>9.1f} KiB  '
+          f'default {base_time * 1000:8.2f} ms  orjson {fast_time * 1000:8.2f} ms  '
+          f'x{base_time / fast_time:.1f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--albums', type=int, default=2000)
+    parser.add_argument('--orders', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    bench('/api/albums', make_albums(args.albums, rng), args.repeat)
+    bench('/api/admin/orders', make_orders(args.orders, rng), args.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+"""Всплеск входов: задержка остальных маршрутов при хешировании в пуле и в потоке запроса.
+
+Создает во временных строках альбом и --users пользователей с настоящими хешами паролей
+(метод PASSWORD_HASH_METHOD). Сначала --probe-clients клиентов --duration секунд запрашивают
+дешевый маршрут (карточку альбома) - это базовая задержка; затем то же самое повторяется
+на фоне --login-clients клиентов, непрерывно выполняющих POST /api/login. Для каждой
+фазы печатаются p50 / p95 / p99 пробного маршрута и число входов в секунду; созданные
+данные удаляются. Нужна БД из DB_CONFIG с примененными миграциями.
+
+Сравнение - два запуска сервера с одинаковым числом процессов и потоков, например:
+    gunicorn --workers 2 --threads 16 --bind 127.0.0.1:8001 server:app
+    KPOP_PASSWORD_POOL_WORKERS=0 gunicorn --workers 2 --threads 16 --bind 127.0.0.1:8002 server:app
+
+Запуск из корня репозитория:
+    python benchmarks/bench_login.py --targets pool=http://127.0.0.1:8001 inline=http://127.0.0.1:8002 \\
+        [--login-clients 32] [--probe-clients 8] [--duration 20]
+"""
+import argparse
+import http.client
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from urllib.parse import urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from server import app, get_db_connection
+from werkzeug.security import generate_password_hash
+
+PASSWORD = 'bench-password'
+
+
+def setup_fixture(cur, users):
+    tag = uuid.uuid4().hex[:8]
+    cur.execute("INSERT INTO artists (name, category) VALUES (%s, 'solo') RETURNING id", (f'bench-{tag}',))
+    artist_id = cur.fetchone()[0]
+    cur.execute('''
+        INSERT INTO albums (artist_id, title, base_price, status)
+        VALUES (%s, %s, 25.00, 'in_stock') RETURNING id
+    ''', (artist_id, f'bench-{tag}'))
+    album_id = cur.fetchone()[0]
+    password_hash = generate_password_hash(
+        PASSWORD, method=app.config['PASSWORD_HASH_METHOD'], salt_length=app.config['PASSWORD_SALT_LENGTH']
+    )
+    emails = [f'bench-{tag}-{n}@example.com' for n in range(users)]
+    for email in emails:
+        cur.execute('''
+            INSERT INTO users (email, password_hash, first_name, last_name, is_admin)
+            VALUES (%s, %s, 'Bench', 'User', false)
+        ''', (email, password_hash))
+    return artist_id, album_id, emails, tag
+
+
+def teardown_fixture(cur, artist_id, album_id, tag):
+    cur.execute('DELETE FROM users WHERE email LIKE %s', (f'bench-{tag}-%@example.com',))
+    cur.execute('DELETE FROM albums WHERE id = %s', (album_id,))
+    cur.execute('DELETE FROM artists WHERE id = %s', (artist_id,))
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def worker(url, make_request, deadline, timings, errors, lock):
+    parts = urlsplit(url)
+    conn = None
+    n = 0
+    while time.monotonic() < deadline:
+        method, path, body = make_request(n)
+        n += 1
+        try:
+            if conn is None:
+                conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=60)
+            started = time.perf_counter()
+            conn.request(method, path, body=body, headers={'Content-Type': 'application/json'} if body else {})
+            response = conn.getresponse()
+            response.read()
+            elapsed = (time.perf_counter() - started) * 1000
+            with lock:
+                timings.append(elapsed)
+                if response.status != 200:
+                    errors[response.status] = errors.get(response.status, 0) + 1
+            if response.will_close:
+                conn.close()
+                conn = None
+        except (OSError, http.client.HTTPException) as e:
+            with lock:
+                errors[type(e).__name__] = errors.get(type(e).__name__, 0) + 1
+            if conn is not None:
+                conn.close()
+            conn = None
+    if conn is not None:
+        conn.close()
+
+
+def run_phase(url, album_id, emails, probe_clients, login_clients, duration):
+    """(задержки пробного маршрута, ошибки пробного маршрута, входов, ошибки входа, сек)"""
+    lock = threading.Lock()
+    probe_timings, probe_errors = [], {}
+    login_timings, login_errors = [], {}
+    deadline = time.monotonic() + duration
+
+    def probe(n):
+        return 'GET', f'/api/albums/{album_id}', None
+
+    def login(n):
+        body = json.dumps({'email': emails[n % len(emails)], 'password': PASSWORD})
+        return 'POST', '/api/login', body
+
+    threads = [
+        threading.Thread(target=worker, args=(url, probe, deadline, probe_timings, probe_errors, lock))
+        for _ in range(probe_clients)
+    ] + [
+        threading.Thread(target=worker, args=(url, login, deadline, login_timings, login_errors, lock))
+        for _ in range(login_clients)
+    ]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return probe_timings, probe_errors, len(login_timings), login_errors, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--targets', nargs='+', required=True, help='имя=URL, например pool=http://127.0.0.1:8001')
+    parser.add_argument('--login-clients', type=int, default=32)
+    parser.add_argument('--probe-clients', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=20)
+    parser.add_argument('--users', type=int, default=50)
+    args = parser.parse_args()
+
+    with app.app_context():
+        conn = get_db_connection()
+        cur = conn.cursor()
+        artist_id, album_id, emails, tag = setup_fixture(cur, args.users)
+        conn.commit()
+
+    try:
+        print(f'login_clients={args.login_clients} probe_clients={args.probe_clients} '
+              f'duration={args.duration}s method={app.config["PASSWORD_HASH_METHOD"]}')
+        print(f'{"target":>8} {"phase":>8} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"logins/s":>9}  errors')
+        for target in args.targets:
+            name, url = target.split('=', 1)
+            for phase, login_clients in (('baseline', 0), ('storm', args.login_clients)):
+                timings, errors, logins, login_errors, elapsed = run_phase(
+                    url, album_id, emails, args.probe_clients, login_clients, args.duration
+                )
+                if not timings:
+                    print(f'{name:>8} {phase:>8} no successful requests  {errors}')
+                    continue
+                all_errors = {**{f'probe {k}': v for k, v in errors.items()},
+                              **{f'login {k}': v for k, v in login_errors.items()}}
+                print(f'{name:>8} {phase:>8} {percentile(timings, 0.5):>8.2f} {percentile(timings, 0.95):>8.2f} '
+                      f'{percentile(timings, 0.99):>8.2f} {logins / elapsed:>9.1f}  {all_errors or "-"}')
+    finally:
+        teardown_fixture(cur, artist_id, album_id, tag)
+        conn.commit()
+        cur.close()
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
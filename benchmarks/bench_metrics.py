@@ -0,0 +1,78 @@
+"""Накладные расходы метрик запросов (metrics.py).
+
+1. Маршрут целиком: GET /api/queue (без БД) через тестовый клиент Flask с METRICS_ENABLED
+   true и false - разница на запрос и доля от времени запроса.
+2. С --db: SELECT 1 на обычном соединении psycopg2 и на InstrumentedConnection внутри
+   собранного запроса - разница на SQL-запрос. Нужна БД из DB_CONFIG.
+
+Запуск из корня репозитория:
+    python benchmarks/bench_metrics.py [--requests 20000] [--queries 20000] [--db]
+"""
+import argparse
+import os
+import sys
+import time
+
+import psycopg2
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from server import app, DB_CONFIG
+from metrics import InstrumentedConnection, begin_request, end_request
+
+
+def time_requests(client, count):
+    client.get('/api/queue') # Прогрев
+    started = time.perf_counter()
+    for _ in range(count):
+        client.get('/api/queue')
+    return (time.perf_counter() - started) / count
+
+
+def time_queries(conn, count):
+    with conn.cursor() as cur:
+        cur.execute('SELECT 1')
+        started = time.perf_counter()
+        for _ in range(count):
+            cur.execute('SELECT 1')
+            cur.fetchone()
+        return (time.perf_counter() - started) / count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=20000)
+    parser.add_argument('--queries', type=int, default=20000)
+    parser.add_argument('--db', action='store_true', help='замерить и курсоры на реальной БД')
+    args = parser.parse_args()
+
+    client = app.test_client()
+    results = {}
+    for enabled in (False, True, False, True): # Чередование сглаживает дрейф частоты процессора
+        app.config['METRICS_ENABLED'] = enabled
+        per_request = time_requests(client, args.requests)
+        results[enabled] = min(results.get(enabled, per_request), per_request)
+    app.config['METRICS_ENABLED'] = True
+    overhead = results[True] - results[False]
+    print(f'request  off {results[False] * 1e6:8.1f} us  on {results[True] * 1e6:8.1f} us  '
+          f'overhead {overhead * 1e6:6.1f} us ({overhead / results[False] * 100:.1f}%)')
+
+    if args.db:
+        plain = psycopg2.connect(**DB_CONFIG)
+        instrumented = psycopg2.connect(connection_factory=InstrumentedConnection, **DB_CONFIG)
+        try:
+            base = time_queries(plain, args.queries)
+            token = begin_request()
+            try:
+                timed = time_queries(instrumented, args.queries)
+            finally:
+                end_request(token)
+        finally:
+            plain.close()
+            instrumented.close()
+        overhead = timed - base
+        print(f'query    off {base * 1e6:8.1f} us  on {timed * 1e6:8.1f} us  '
+              f'overhead {overhead * 1e6:6.1f} us ({overhead / base * 100:.1f}%)')
+
+
+if __name__ == '__main__':
+    main()
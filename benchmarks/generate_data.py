@@ -0,0 +1,324 @@
+"""Синтетические данные для нагрузочных тестов: каталог, покупатели, корзины, избранное,
+скидки и история заказов в масштабе миллионов строк.
+
+Данные детерминированы: одинаковые --seed и размеры дают одинаковые строки. Загрузка -
+через COPY; id для связанных строк резервируются заранее (setval под блокировкой таблицы).
+У всех покупателей пароль 'loadtest', email - loadtest-<n>@example.com, администратор -
+loadtest-admin@example.com; по ним входит benchmarks/load_journeys.py. Нужна локальная БД
+из DB_CONFIG с примененными миграциями; предыдущие сгенерированные данные удаляет --drop.
+
+Заказы и позиции по умолчанию грузятся с session_replication_role = replica (нужен
+суперпользователь): построчные триггеры не срабатывают, а производные таблицы
+(user_order_stats, sales_daily) пересчитываются одним запросом в конце. --with-triggers
+грузит их с триггерами - медленнее, но без прав суперпользователя.
+
+Запуск из корня репозитория:
+    python benchmarks/generate_data.py [--seed 42] [--artists 300] [--albums 3000] [--users 100000] \\
+        [--orders 1000000] [--discounts 20] [--drop] [--with-triggers]
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+
+import psycopg2
+from werkzeug.security import generate_password_hash
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from server import app, DB_CONFIG, ARTIST_CATEGORIES, invalidate_catalog
+from inventory import stripe_versions
+from analytics import rebuild_sales
+
+PASSWORD = 'loadtest'
+EMAIL = 'loadtest-{}@example.com'
+ADMIN_EMAIL = 'loadtest-admin@example.com'
+ARTIST_PREFIX = 'Loadtest Artist'
+DISCOUNT_PREFIX = 'loadtest'
+
+UNLIMITED_STOCK = 1000000 # Нелимитированные версии не кончаются за тест
+HISTORY_DAYS = 730
+ORDER_STATUS_WEIGHTS = {'created': 5, 'paid': 15, 'shipped': 15, 'delivered': 60, 'cancelled': 5}
+ALBUM_STATUS_WEIGHTS = {'in_stock': 80, 'pre_order': 10, 'out_of_stock': 10}
+VERSION_NAMES = ('Standard', 'Photobook', 'Digipack', 'Jewel', 'Platform', 'Limited', 'Weverse')
+
+
+def _copy_value(value):
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    return (str(value).replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+def copy_line(row):
+    return '\t'.join(_copy_value(value) for value in row) + '\n'
+
+
+class CopySource:
+    """Файл для copy_expert: строки формата text из итератора, без сборки всего объема в памяти."""
+
+    def __init__(self, rows):
+        self._rows = iter(rows)
+        self._buffer = b''
+
+    def read(self, size=-1):
+        chunks = [self._buffer]
+        length = len(self._buffer)
+        while size < 0 or length < size:
+            row = next(self._rows, None)
+            if row is None:
+                break
+            line = copy_line(row).encode()
+            chunks.append(line)
+            length += len(line)
+        data = b''.join(chunks)
+        if size < 0:
+            self._buffer = b''
+            return data
+        self._buffer = data[size:]
+        return data[:size]
+
+
+def copy_rows(cur, table, columns, rows):
+    cur.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN", CopySource(rows))
+    return cur.rowcount
+
+
+def reserve_ids(cur, table, count):
+    """Первый из count подряд идущих id таблицы; последовательность сдвигается за них."""
+    cur.execute(f'LOCK TABLE {table} IN SHARE ROW EXCLUSIVE MODE')
+    cur.execute("SELECT pg_get_serial_sequence(%s, 'id')", (table,))
+    sequence = cur.fetchone()[0]
+    cur.execute(f'''
+        SELECT setval(%s, GREATEST((SELECT COALESCE(MAX(id), 0) FROM {table}),
+                                   (SELECT last_value FROM {sequence})) + %s)
+    ''', (sequence, count))
+    return cur.fetchone()[0] - count + 1
+
+
+def weighted(rng, weights):
+    return rng.choices(list(weights), list(weights.values()))[0]
+
+
+def drop_generated(cur):
+    cur.execute('SELECT id FROM users WHERE email LIKE %s', ('loadtest-%@example.com',))
+    user_ids = [row[0] for row in cur.fetchall()]
+    cur.execute('SELECT id FROM artists WHERE name LIKE %s', (f'{ARTIST_PREFIX} %',))
+    artist_ids = [row[0] for row in cur.fetchall()]
+    cur.execute('DELETE FROM order_items WHERE order_id IN (SELECT id FROM orders WHERE user_id = ANY(%s))', (user_ids,))
+    cur.execute('DELETE FROM orders WHERE user_id = ANY(%s)', (user_ids,))
+    cur.execute('DELETE FROM user_order_stats WHERE user_id = ANY(%s)', (user_ids,))
+    cur.execute('DELETE FROM cart_items WHERE cart_id IN (SELECT id FROM cart WHERE user_id = ANY(%s))', (user_ids,))
+    cur.execute('DELETE FROM cart WHERE user_id = ANY(%s)', (user_ids,))
+    cur.execute('DELETE FROM wishlist WHERE user_id = ANY(%s)', (user_ids,))
+    cur.execute('DELETE FROM user_addresses WHERE user_id = ANY(%s)', (user_ids,))
+    cur.execute('DELETE FROM users WHERE id = ANY(%s)', (user_ids,))
+    cur.execute('DELETE FROM album_discounts WHERE discount_id IN (SELECT id FROM discounts WHERE name LIKE %s)',
+                (f'{DISCOUNT_PREFIX}-%',))
+    cur.execute('DELETE FROM discounts WHERE name LIKE %s', (f'{DISCOUNT_PREFIX}-%',))
+    cur.execute('DELETE FROM album_discounts WHERE album_id IN (SELECT id FROM albums WHERE artist_id = ANY(%s))',
+                (artist_ids,))
+    cur.execute('DELETE FROM wishlist WHERE album_id IN (SELECT id FROM albums WHERE artist_id = ANY(%s))', (artist_ids,))
+    cur.execute('''
+        DELETE FROM album_versions WHERE album_id IN (SELECT id FROM albums WHERE artist_id = ANY(%s))
+    ''', (artist_ids,))
+    cur.execute('DELETE FROM albums WHERE artist_id = ANY(%s)', (artist_ids,))
+    cur.execute('DELETE FROM artists WHERE id = ANY(%s)', (artist_ids,))
+    return len(user_ids), len(artist_ids)
+
+
+def generate_catalog(cur, rng, artists, albums):
+    """Артисты, альбомы и версии. Возвращает (id альбомов, [(id версии, id альбома, цена, лимитированная, название)])."""
+    artist_start = reserve_ids(cur, 'artists', artists)
+    copy_rows(cur, 'artists', ('id', 'name', 'category', 'description', 'image_url'), (
+        (artist_start + n, f'{ARTIST_PREFIX} {n}', rng.choice(ARTIST_CATEGORIES),
+         f'Synthetic artist {n}', f'https://cdn.example.com/artists/{n}.jpg')
+        for n in range(artists)
+    ))
+
+    album_start = reserve_ids(cur, 'albums', albums)
+    album_rows = []
+    today = date.today()
+    for n in range(albums):
+        status = weighted(rng, ALBUM_STATUS_WEIGHTS)
+        album_rows.append((
+            album_start + n, artist_start + rng.randrange(artists), f'Album {n}',
+            Decimal(rng.randint(1500, 4500)) / 100, f'Synthetic album {n}',
+            today - timedelta(days=rng.randint(-60, 6 * 365)), status,
+            f'https://cdn.example.com/albums/{n}.jpg', status == 'pre_order'
+        ))
+    copy_rows(cur, 'albums', ('id', 'artist_id', 'title', 'base_price', 'description', 'release_date',
+                              'status', 'main_image_url', 'is_preorder'), album_rows)
+
+    versions = []
+    version_rows = []
+    for album in album_rows:
+        for name in rng.sample(VERSION_NAMES, rng.randint(1, 5)):
+            is_limited = name == 'Limited' or rng.random() < 0.05
+            price_diff = Decimal(rng.randint(0, 1000)) / 100
+            version_rows.append((album[0], name, price_diff, f'{name} packaging',
+                                 rng.randint(50, 500) if is_limited else UNLIMITED_STOCK, is_limited))
+    version_start = reserve_ids(cur, 'album_versions', len(version_rows))
+    copy_rows(cur, 'album_versions', ('id', 'album_id', 'version_name', 'price_diff', 'packaging_details',
+                                      'stock_quantity', 'is_limited'),
+              ((version_start + n, *row) for n, row in enumerate(version_rows)))
+    prices = {album[0]: album[3] for album in album_rows}
+    for n, (album_id, name, price_diff, _, _, is_limited) in enumerate(version_rows):
+        versions.append((version_start + n, album_id, prices[album_id] + price_diff, is_limited, name))
+    stripe_versions(cur.connection, app.config['INVENTORY_STRIPES'])
+    return [album[0] for album in album_rows], versions
+
+
+def generate_users(cur, rng, users, album_ids, versions):
+    """Покупатели (и один администратор), корзины и избранное. Возвращает id покупателей."""
+    password_hash = generate_password_hash(
+        PASSWORD, method=app.config['PASSWORD_HASH_METHOD'], salt_length=app.config['PASSWORD_SALT_LENGTH']
+    )
+    user_start = reserve_ids(cur, 'users', users + 1)
+    copy_rows(cur, 'users', ('id', 'email', 'password_hash', 'first_name', 'last_name', 'is_admin'), (
+        (user_start + n, EMAIL.format(n) if n < users else ADMIN_EMAIL, password_hash,
+         'Load', f'User {n}' if n < users else 'Admin', n == users)
+        for n in range(users + 1)
+    ))
+    user_ids = list(range(user_start, user_start + users))
+
+    # Корзина - у трети покупателей, 1-3 нелимитированные версии
+    buyers = [user_id for user_id in user_ids if rng.random() < 0.3]
+    cart_start = reserve_ids(cur, 'cart', len(buyers))
+    copy_rows(cur, 'cart', ('id', 'user_id'), ((cart_start + n, user_id) for n, user_id in enumerate(buyers)))
+    unlimited = [version[0] for version in versions if not version[3]]
+    copy_rows(cur, 'cart_items', ('cart_id', 'album_version_id', 'quantity'), (
+        (cart_start + n, version_id, rng.randint(1, 3))
+        for n in range(len(buyers))
+        for version_id in rng.sample(unlimited, rng.randint(1, 3))
+    ))
+
+    copy_rows(cur, 'wishlist', ('user_id', 'album_id'), (
+        (user_id, album_id)
+        for user_id in user_ids if rng.random() < 0.4
+        for album_id in rng.sample(album_ids, rng.randint(1, 5))
+    ))
+    return user_ids
+
+
+def generate_discounts(cur, rng, discounts, album_ids):
+    """Скидки на альбомы; возвращает {id альбома: процент} действующих сейчас."""
+    today = date.today()
+    active = {}
+    discount_start = reserve_ids(cur, 'discounts', discounts)
+    rows, links = [], []
+    for n in range(discounts):
+        start = today - timedelta(days=rng.randint(0, 60))
+        end = start + timedelta(days=rng.randint(7, 120))
+        percent = rng.choice((5, 10, 15, 20, 25, 30))
+        rows.append((discount_start + n, f'{DISCOUNT_PREFIX}-{n}', 'Synthetic discount', percent, start, end, True))
+        for album_id in rng.sample(album_ids, min(len(album_ids), rng.randint(10, 100))):
+            links.append((discount_start + n, album_id))
+            if start <= today <= end:
+                active[album_id] = max(active.get(album_id, 0), percent)
+    copy_rows(cur, 'discounts', ('id', 'name', 'description', 'discount_percent', 'start_date', 'end_date',
+                                 'is_active'), rows)
+    # Одна скидка на альбом может повторяться в разных акциях - дубликаты пары убираются
+    copy_rows(cur, 'album_discounts', ('discount_id', 'album_id'), sorted(set(links)))
+    return active
+
+
+def generate_orders(cur, rng, orders, user_ids, versions, discounted):
+    """Заказы и позиции. Покупатели неравномерны: часть заказывает намного чаще остальных."""
+    order_start = reserve_ids(cur, 'orders', orders)
+    now = datetime.now()
+    weights = [rng.paretovariate(1.2) for _ in user_ids]
+    buyers = rng.choices(user_ids, weights, k=orders)
+
+    with tempfile.TemporaryFile('w+', encoding='utf-8') as items:
+        def order_rows():
+            for n in range(orders):
+                order_id = order_start + n
+                total = Decimal(0)
+                for version_id, album_id, list_price, _, name in rng.sample(versions, rng.randint(1, 4)):
+                    quantity = rng.randint(1, 3)
+                    percent = discounted.get(album_id, 0) if rng.random() < 0.5 else 0
+                    price = (list_price * (100 - percent) / 100).quantize(Decimal('0.01'))
+                    total += price * quantity
+                    items.write(copy_line((order_id, version_id, quantity, price, name, list_price)))
+                created_at = now - timedelta(seconds=rng.randint(0, HISTORY_DAYS * 86400))
+                yield order_id, buyers[n], total, weighted(rng, ORDER_STATUS_WEIGHTS), created_at
+
+        copy_rows(cur, 'orders', ('id', 'user_id', 'total_amount', 'status', 'created_at'), order_rows())
+        items.seek(0)
+        cur.copy_expert('''
+            COPY order_items (order_id, album_version_id, quantity, price_per_unit, version_name, list_price)
+            FROM STDIN
+        ''', items)
+        return cur.rowcount
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--artists', type=int, default=300)
+    parser.add_argument('--albums', type=int, default=3000)
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--orders', type=int, default=1000000)
+    parser.add_argument('--discounts', type=int, default=20)
+    parser.add_argument('--drop', action='store_true', help='сначала удалить ранее сгенерированные данные')
+    parser.add_argument('--with-triggers', action='store_true', help='грузить заказы с построчными триггерами')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    conn = psycopg2.connect(**DB_CONFIG)
+    cur = conn.cursor()
+
+    def step(title, fn, *fn_args):
+        started = time.perf_counter()
+        result = fn(*fn_args)
+        conn.commit()
+        print(f'{title:<24} {time.perf_counter() - started:8.1f}s')
+        return result
+
+    try:
+        if args.drop:
+            users, artists = step('drop', drop_generated, cur)
+            print(f'  removed {users} users, {artists} artists')
+        cur.execute('SELECT 1 FROM users WHERE email = %s', (ADMIN_EMAIL,))
+        if cur.fetchone():
+            parser.error('generated data already exists, run with --drop')
+
+        album_ids, versions = step('catalog', generate_catalog, cur, rng, args.artists, args.albums)
+        user_ids = step('users, carts, wishlists', generate_users, cur, rng, args.users, album_ids, versions)
+        discounted = step('discounts', generate_discounts, cur, rng, args.discounts, album_ids)
+
+        def orders():
+            if not args.with_triggers:
+                # Без построчных триггеров (и проверок внешних ключей); производные таблицы - ниже
+                cur.execute('SET LOCAL session_replication_role = replica')
+            count = generate_orders(cur, rng, args.orders, user_ids, versions, discounted)
+            print(f'  {args.orders} orders, {count} items')
+        step('orders', orders)
+
+        if not args.with_triggers:
+            def derived():
+                cur.execute('''
+                    INSERT INTO user_order_stats (user_id, order_count)
+                    SELECT user_id, COUNT(*) FROM orders WHERE user_id BETWEEN %s AND %s GROUP BY user_id
+                    ON CONFLICT (user_id) DO UPDATE SET order_count = EXCLUDED.order_count
+                ''', (user_ids[0], user_ids[-1]))
+                rebuild_sales(conn)
+            step('order stats, sales rollup', derived)
+
+        # Работающие серверы сбрасывают кэш каталога по NOTIFY
+        step('catalog invalidation', invalidate_catalog, cur, '*')
+        conn.autocommit = True
+        step('analyze', cur.execute, 'ANALYZE')
+    finally:
+        cur.close()
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
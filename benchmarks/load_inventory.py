@@ -0,0 +1,140 @@
+"""Нагрузочный тест резервирования: много покупателей одновременно оформляют заказы
+на одну лимитированную версию.
+
+Создает артиста, альбом с одной лимитированной версией (остаток --stock, разложенный
+на --stripes корзин) и --users пользователей. --threads потоков в цикле кладут версию
+в корзину и оформляют заказ, пока остаток не кончится. В конце проверяется, что продано
+ровно столько, сколько списано, и не больше исходного остатка; созданные данные удаляются.
+Для сравнения с одной горячей строкой запустите с --stripes 1.
+
+Запуск из корня репозитория:
+    python benchmarks/load_inventory.py [--stock 2000] [--stripes 8] [--threads 16] [--users 64]
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+import uuid
+
+from psycopg2.extras import execute_values
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from server import app, get_db_connection
+from inventory import stripe_versions
+from flask_jwt_extended import create_access_token
+
+
+def setup_fixture(cur, stock, stripes, users):
+    tag = uuid.uuid4().hex[:8]
+    cur.execute("INSERT INTO artists (name, category) VALUES (%s, 'solo') RETURNING id", (f'load-{tag}',))
+    artist_id = cur.fetchone()[0]
+    cur.execute('''
+        INSERT INTO albums (artist_id, title, base_price, status)
+        VALUES (%s, %s, 25.00, 'in_stock') RETURNING id
+    ''', (artist_id, f'load-{tag}'))
+    album_id = cur.fetchone()[0]
+    cur.execute('''
+        INSERT INTO album_versions (album_id, version_name, price_diff, stock_quantity, is_limited)
+        VALUES (%s, 'limited', 0, %s, true) RETURNING id
+    ''', (album_id, stock))
+    version_id = cur.fetchone()[0]
+    stripe_versions(cur.connection, stripes, album_id)
+    user_ids = [row[0] for row in execute_values(cur, '''
+        INSERT INTO users (email, password_hash, first_name, last_name, is_admin)
+        VALUES %s RETURNING id
+    ''', [(f'load-{tag}-{n}@example.com', 'x', 'Load', 'User', False) for n in range(users)], fetch=True)]
+    carts = dict(execute_values(cur, 'INSERT INTO cart (user_id) VALUES %s RETURNING user_id, id',
+                                [(user_id,) for user_id in user_ids], fetch=True))
+    return artist_id, album_id, version_id, user_ids, carts
+
+
+def teardown_fixture(cur, artist_id, album_id, user_ids):
+    cur.execute('DELETE FROM order_items WHERE order_id IN (SELECT id FROM orders WHERE user_id = ANY(%s))', (user_ids,))
+    cur.execute('DELETE FROM orders WHERE user_id = ANY(%s)', (user_ids,))
+    cur.execute('DELETE FROM cart_items WHERE cart_id IN (SELECT id FROM cart WHERE user_id = ANY(%s))', (user_ids,))
+    cur.execute('DELETE FROM cart WHERE user_id = ANY(%s)', (user_ids,))
+    cur.execute('DELETE FROM users WHERE id = ANY(%s)', (user_ids,))
+    cur.execute('DELETE FROM album_versions WHERE album_id = %s', (album_id,))
+    cur.execute('DELETE FROM albums WHERE id = %s', (album_id,))
+    cur.execute('DELETE FROM artists WHERE id = %s', (artist_id,))
+
+
+def buyer(users, version_id, carts, tokens, results, sold_out):
+    client = app.test_client()
+    counts = results[threading.current_thread().name] = {'created': 0, 'shortfall': 0, 'error': 0}
+    while not sold_out.is_set():
+        for user_id in users:
+            with app.app_context():
+                conn = get_db_connection()
+                with conn.cursor() as cur:
+                    cur.execute('INSERT INTO cart_items (cart_id, album_version_id, quantity) VALUES (%s, %s, 1)',
+                                (carts[user_id], version_id))
+                conn.commit()
+                conn.close()
+            response = client.post('/api/orders', headers={'Authorization': f'Bearer {tokens[user_id]}'})
+            if response.status_code == 201:
+                counts['created'] += 1
+            elif response.status_code == 409:
+                counts['shortfall'] += 1
+                sold_out.set()
+                break
+            else:
+                counts['error'] += 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--stock', type=int, default=2000)
+    parser.add_argument('--stripes', type=int, default=8)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--users', type=int, default=64)
+    args = parser.parse_args()
+
+    app.config['INVENTORY_STRIPES'] = args.stripes
+    with app.app_context():
+        conn = get_db_connection()
+        cur = conn.cursor()
+        artist_id, album_id, version_id, user_ids, carts = setup_fixture(cur, args.stock, args.stripes, args.users)
+        conn.commit()
+        tokens = {user_id: create_access_token(identity=str(user_id)) for user_id in user_ids}
+
+    results = {}
+    sold_out = threading.Event()
+    threads = [
+        threading.Thread(
+            target=buyer, name=f'buyer-{n}',
+            args=(user_ids[n::args.threads], version_id, carts, tokens, results, sold_out)
+        )
+        for n in range(args.threads)
+    ]
+    try:
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        created = sum(counts['created'] for counts in results.values())
+        errors = sum(counts['error'] for counts in results.values())
+        cur.execute('SELECT COALESCE(SUM(quantity), 0) FROM order_items WHERE album_version_id = %s', (version_id,))
+        sold = cur.fetchone()[0]
+        cur.execute('SELECT COALESCE(SUM(quantity), 0) FROM inventory_buckets WHERE album_version_id = %s', (version_id,))
+        remaining = cur.fetchone()[0]
+        conn.commit()
+
+        print(f'stripes={args.stripes} threads={args.threads} stock={args.stock}')
+        print(f'orders: {created} in {elapsed:.2f}s ({created / elapsed:.1f}/s), errors: {errors}')
+        print(f'sold: {sold}, remaining: {remaining}')
+        assert sold + remaining == args.stock, 'reserved stock does not match sold items'
+        assert sold <= args.stock, 'oversold'
+    finally:
+        teardown_fixture(cur, artist_id, album_id, user_ids)
+        conn.commit()
+        cur.close()
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
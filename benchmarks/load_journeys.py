@@ -0,0 +1,348 @@
+"""Нагрузочный тест по сценариям покупателей и администратора с сохранением результатов.
+
+Работает на данных benchmarks/generate_data.py. --shoppers покупателей входят под
+сгенерированными учетными записями и по кругу проходят сценарий: каталог (страницы с
+фильтром и сортировкой), карточка альбома, добавление в корзину, оформление заказа,
+история заказов; --admins администраторов листают /api/admin/orders и открывают заказы.
+Решения сценария (что открыть, брать ли товар, оформлять ли) - из генератора с --seed.
+Первые --warmup секунд не учитываются.
+
+В конце печатаются запросы в секунду, p50 / p95 / p99 и ошибки по каждому маршруту;
+те же числа с параметрами запуска и коммитом сохраняются в JSON (--output). Сравнение
+двух запусков отмечает маршруты, у которых p95 вырос больше --threshold, и завершается
+с кодом 1, если такие есть.
+
+Сервер запускается отдельно, например:
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+Запуск из корня репозитория:
+    python benchmarks/load_journeys.py run --target http://127.0.0.1:8000 [--shoppers 50] [--admins 2] \\
+        [--duration 60] [--warmup 10] [--seed 42] [--output results.json] [--baseline old.json]
+    python benchmarks/load_journeys.py compare old.json new.json [--threshold 0.1]
+"""
+import argparse
+import gzip
+import http.client
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from urllib.parse import urlencode, urlsplit
+
+import psycopg2
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from server import DB_CONFIG, ARTIST_CATEGORIES
+from generate_data import PASSWORD, ADMIN_EMAIL, UNLIMITED_STOCK
+
+SORTS = ('release_date_desc', 'price_asc', 'price_desc', 'title_asc')
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+class Recorder:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.timings = {} # маршрут -> [мс]
+        self.errors = {} # маршрут -> {статус: число}
+        self.recording = False
+
+    def add(self, route, status, elapsed_ms):
+        if not self.recording:
+            return
+        with self._lock:
+            self.timings.setdefault(route, []).append(elapsed_ms)
+            if status >= 400 or status == 0:
+                errors = self.errors.setdefault(route, {})
+                errors[str(status)] = errors.get(str(status), 0) + 1
+
+    def summary(self, elapsed):
+        endpoints = {}
+        for route, timings in sorted(self.timings.items()):
+            endpoints[route] = {
+                'count': len(timings),
+                'rps': round(len(timings) / elapsed, 2),
+                'p50_ms': round(percentile(timings, 0.5), 2),
+                'p95_ms': round(percentile(timings, 0.95), 2),
+                'p99_ms': round(percentile(timings, 0.99), 2),
+                'mean_ms': round(statistics.mean(timings), 2),
+                'errors': self.errors.get(route, {}),
+            }
+        everything = [value for timings in self.timings.values() for value in timings]
+        total = {
+            'count': len(everything),
+            'rps': round(len(everything) / elapsed, 2),
+            'p50_ms': round(percentile(everything, 0.5), 2) if everything else None,
+            'p95_ms': round(percentile(everything, 0.95), 2) if everything else None,
+            'p99_ms': round(percentile(everything, 0.99), 2) if everything else None,
+            'errors': sum(sum(errors.values()) for errors in self.errors.values()),
+        }
+        return endpoints, total
+
+
+class Session:
+    """Keep-alive соединение одного виртуального пользователя."""
+
+    def __init__(self, url, recorder):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.recorder = recorder
+        self.conn = None
+        self.token = None
+
+    def request(self, route, method, path, body=None):
+        """(статус, JSON ответа или None). route - имя маршрута для статистики."""
+        headers = {'Accept-Encoding': 'gzip'}
+        if body is not None:
+            headers['Content-Type'] = 'application/json'
+            body = json.dumps(body)
+        if self.token:
+            headers['Authorization'] = f'Bearer {self.token}'
+        started = time.perf_counter()
+        try:
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection(self.host, self.port, timeout=60)
+            self.conn.request(method, path, body=body, headers=headers)
+            response = self.conn.getresponse()
+            data = response.read()
+            status = response.status
+            if response.will_close:
+                self.close()
+        except (OSError, http.client.HTTPException):
+            self.close()
+            self.recorder.add(route, 0, (time.perf_counter() - started) * 1000)
+            return 0, None
+        self.recorder.add(route, status, (time.perf_counter() - started) * 1000)
+        if not (response.getheader('Content-Type') or '').startswith('application/json'):
+            return status, None
+        try:
+            if response.getheader('Content-Encoding') == 'gzip':
+                data = gzip.decompress(data)
+            return status, json.loads(data)
+        except (OSError, ValueError):
+            return status, None
+
+    def login(self, email):
+        status, data = self.request('POST /api/login', 'POST', '/api/login', {'email': email, 'password': PASSWORD})
+        self.token = data['accessToken'] if status == 200 and data else None
+        return self.token is not None
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+def shopper(session, rng, fixture, deadline):
+    while time.monotonic() < deadline:
+        # Каталог: первая страница с фильтром, иногда следующая
+        params = {'sort': rng.choice(SORTS), 'limit': 24}
+        if rng.random() < 0.5:
+            params['category'] = rng.choice(ARTIST_CATEGORIES)
+        status, page = session.request('GET /api/albums?browse', 'GET', '/api/albums?' + urlencode(params))
+        if page and page.get('next_cursor') and rng.random() < 0.3:
+            session.request('GET /api/albums?browse', 'GET',
+                            '/api/albums?' + urlencode({**params, 'cursor': page['next_cursor']}))
+
+        # Карточка альбома и его скидки
+        album_id = rng.choice(fixture['album_ids'])
+        session.request('GET /api/albums/<id>', 'GET', f'/api/albums/{album_id}')
+        session.request('GET /api/albums/<id>/discounts', 'GET', f'/api/albums/{album_id}/discounts')
+
+        # Корзина и оформление
+        if rng.random() < 0.4:
+            version_id = rng.choice(fixture['version_ids'])
+            session.request('POST /api/cart', 'POST', '/api/cart', {'version_id': version_id, 'quantity': 1})
+            session.request('GET /api/cart', 'GET', '/api/cart')
+            if rng.random() < 0.5:
+                session.request('POST /api/orders', 'POST', '/api/orders')
+
+        # История заказов
+        if rng.random() < 0.3:
+            status, history = session.request('GET /api/orders', 'GET', '/api/orders?per_page=10')
+            if history and history.get('orders'):
+                order_id = rng.choice(history['orders'])['id']
+                session.request('GET /api/orders/<id>', 'GET', f'/api/orders/{order_id}')
+
+
+def admin(session, rng, deadline):
+    while time.monotonic() < deadline:
+        params = {'per_page': 50}
+        for _ in range(rng.randint(1, 5)):
+            status, page = session.request('GET /api/admin/orders', 'GET', '/api/admin/orders?' + urlencode(params))
+            if not page or not page.get('next_cursor'):
+                break
+            params['cursor'] = page['next_cursor']
+        if page and page.get('orders') and rng.random() < 0.5:
+            order_id = rng.choice(page['orders'])['id']
+            session.request('GET /api/admin/orders/<id>', 'GET', f'/api/admin/orders/{order_id}')
+
+
+def load_fixture(shoppers, seed):
+    rng = random.Random(seed)
+    conn = psycopg2.connect(**DB_CONFIG)
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT email FROM users WHERE email LIKE 'loadtest-%%@example.com' AND email != %s ORDER BY id",
+                        (ADMIN_EMAIL,))
+            emails = [row[0] for row in cur.fetchall()]
+            cur.execute("SELECT id FROM albums WHERE status != 'out_of_stock' ORDER BY id")
+            album_ids = [row[0] for row in cur.fetchall()]
+            # Только нелимитированные версии: остаток лимитированных кончился бы посреди теста
+            cur.execute('SELECT id FROM album_versions WHERE NOT is_limited AND stock_quantity >= %s ORDER BY id',
+                        (UNLIMITED_STOCK // 2,))
+            version_ids = [row[0] for row in cur.fetchall()]
+    finally:
+        conn.close()
+    if not emails or not album_ids or not version_ids:
+        sys.exit('no generated data, run benchmarks/generate_data.py first')
+    return {
+        'emails': rng.sample(emails, min(shoppers, len(emails))),
+        'album_ids': album_ids,
+        'version_ids': version_ids,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run(args):
+    fixture = load_fixture(args.shoppers, args.seed)
+    recorder = Recorder()
+    deadline = time.monotonic() + args.warmup + args.duration
+
+    def virtual_user(n, is_admin):
+        rng = random.Random(args.seed * 1000003 + n)
+        session = Session(args.target, recorder)
+        try:
+            email = ADMIN_EMAIL if is_admin else fixture['emails'][n % len(fixture['emails'])]
+            if not session.login(email):
+                return
+            if is_admin:
+                admin(session, rng, deadline)
+            else:
+                shopper(session, rng, fixture, deadline)
+        finally:
+            session.close()
+
+    threads = [threading.Thread(target=virtual_user, args=(n, False), daemon=True) for n in range(args.shoppers)]
+    threads += [threading.Thread(target=virtual_user, args=(args.shoppers + n, True), daemon=True)
+                for n in range(args.admins)]
+    print(f'shoppers={args.shoppers} admins={args.admins} warmup={args.warmup}s duration={args.duration}s '
+          f'seed={args.seed} target={args.target}')
+    for thread in threads:
+        thread.start()
+    time.sleep(args.warmup)
+    recorder.recording = True
+    started = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    recorder.recording = False
+    elapsed = time.perf_counter() - started
+
+    endpoints, total = recorder.summary(elapsed)
+    print_results(endpoints, total)
+    results = {
+        'meta': {
+            'started_at': datetime.now(timezone.utc).isoformat(),
+            'commit': git_commit(),
+            'target': args.target,
+            'shoppers': args.shoppers,
+            'admins': args.admins,
+            'duration': args.duration,
+            'warmup': args.warmup,
+            'seed': args.seed,
+        },
+        'endpoints': endpoints,
+        'total': total,
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print(f'results saved to {args.output}')
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            return compare_results(json.load(f), results, args.threshold)
+    return 0
+
+
+def print_results(endpoints, total):
+    print(f'{"route":<34} {"count":>7} {"req/s":>8} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8}  errors')
+    for route, row in endpoints.items():
+        print(f'{route:<34} {row["count"]:>7} {row["rps"]:>8.1f} {row["p50_ms"]:>8.2f} {row["p95_ms"]:>8.2f} '
+              f'{row["p99_ms"]:>8.2f}  {row["errors"] or "-"}')
+    if total['count']:
+        print(f'{"total":<34} {total["count"]:>7} {total["rps"]:>8.1f} {total["p50_ms"]:>8.2f} '
+              f'{total["p95_ms"]:>8.2f} {total["p99_ms"]:>8.2f}  {total["errors"] or "-"}')
+
+
+def compare_results(old, new, threshold):
+    """Печатает изменения по маршрутам; 1 - если p95 какого-то маршрута вырос больше threshold."""
+    print(f'\nbaseline {old["meta"].get("commit") or "?"} -> {new["meta"].get("commit") or "?"}')
+    print(f'{"route":<34} {"req/s":>16} {"p50 ms":>18} {"p95 ms":>18} {"p99 ms":>18}')
+    regressions = []
+    for route in sorted(set(old['endpoints']) | set(new['endpoints'])):
+        before, after = old['endpoints'].get(route), new['endpoints'].get(route)
+        if before is None or after is None:
+            print(f'{route:<34} {"only in " + ("new" if before is None else "baseline"):>16}')
+            continue
+        cells = []
+        for key in ('rps', 'p50_ms', 'p95_ms', 'p99_ms'):
+            change = (after[key] - before[key]) / before[key] if before[key] else 0.0
+            cells.append(f'{after[key]:>9.1f} {change:>+7.1%}')
+        slower = before['p95_ms'] and (after['p95_ms'] - before['p95_ms']) / before['p95_ms'] > threshold
+        if slower:
+            regressions.append(route)
+        print(f'{route:<34} {cells[0]:>16} {cells[1]:>18} {cells[2]:>18} {cells[3]:>18}'
+              f'{"  REGRESSION" if slower else ""}')
+    if regressions:
+        print(f'\np95 regressed more than {threshold:.0%} on: {", ".join(regressions)}')
+        return 1
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='выполнить тест и сохранить результаты')
+    run_parser.add_argument('--target', required=True, help='URL сервера, например http://127.0.0.1:8000')
+    run_parser.add_argument('--shoppers', type=int, default=50)
+    run_parser.add_argument('--admins', type=int, default=2)
+    run_parser.add_argument('--duration', type=float, default=60)
+    run_parser.add_argument('--warmup', type=float, default=10)
+    run_parser.add_argument('--seed', type=int, default=42)
+    run_parser.add_argument('--output', default=f'loadtest-{datetime.now():%Y%m%d-%H%M%S}.json')
+    run_parser.add_argument('--baseline', help='JSON предыдущего запуска для сравнения')
+    run_parser.add_argument('--threshold', type=float, default=0.1, help='допустимый рост p95, доля')
+
+    compare_parser = commands.add_parser('compare', help='сравнить два сохраненных запуска')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--threshold', type=float, default=0.1, help='допустимый рост p95, доля')
+
+    args = parser.parse_args()
+    if args.command == 'run':
+        sys.exit(run(args))
+    with open(args.baseline, encoding='utf-8') as f:
+        baseline = json.load(f)
+    with open(args.current, encoding='utf-8') as f:
+        current = json.load(f)
+    sys.exit(compare_results(baseline, current, args.threshold))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,386 @@
+import csv
+import io
+import json
+from datetime import date
+from decimal import Decimal, InvalidOperation
+
+
+# Массовый импорт каталога (артисты, альбомы, версии) из CSV или NDJSON.
+#
+# Одна строка файла - одна версия альбома вместе с данными альбома и артиста.
+# Строки разбираются потоково и проверяются; корректные пачками загружаются через COPY
+# во временную таблицу, затем тремя запросами сливаются в artists / albums / album_versions
+# с upsert по естественным ключам: имя артиста, (артист, название альбома),
+# (альбом, название версии). Пустое необязательное поле не затирает текущее значение.
+# В режиме dry_run все выполняется и откатывается - счетчики и ошибки те же, что при импорте.
+
+# Поля строки: (имя, разбор, обязательное)
+def _text(value):
+    return str(value)
+
+
+def _decimal(value):
+    try:
+        number = Decimal(str(value))
+    except InvalidOperation:
+        raise ValueError('must be a number')
+    if not number.is_finite():
+        raise ValueError('must be a number')
+    return number
+
+
+def _int(value):
+    if isinstance(value, bool):
+        raise ValueError('must be an integer')
+    try:
+        return int(str(value))
+    except ValueError:
+        raise ValueError('must be an integer')
+
+
+def _bool(value):
+    if isinstance(value, bool):
+        return value
+    text = str(value).strip().lower()
+    if text in ('1', 'true', 'yes', 't', 'y'):
+        return True
+    if text in ('0', 'false', 'no', 'f', 'n'):
+        return False
+    raise ValueError('must be true or false')
+
+
+def _date(value):
+    try:
+        return date.fromisoformat(str(value))
+    except ValueError:
+        raise ValueError('must be a date YYYY-MM-DD')
+
+
+FIELDS = (
+    ('artist_name', _text, True),
+    ('artist_category', _text, True),
+    ('artist_description', _text, False),
+    ('artist_image_url', _text, False),
+    ('album_title', _text, True),
+    ('base_price', _decimal, True),
+    ('album_description', _text, False),
+    ('release_date', _date, False),
+    ('status', _text, False),
+    ('main_image_url', _text, False),
+    ('is_preorder', _bool, False),
+    ('version_name', _text, True),
+    ('price_diff', _decimal, False),
+    ('packaging_details', _text, False),
+    ('stock_quantity', _int, False),
+    ('is_limited', _bool, False),
+)
+FIELD_NAMES = tuple(name for name, _, _ in FIELDS)
+
+FORMATS = ('csv', 'ndjson')
+
+
+def iter_records(stream, fmt):
+    """(номер строки, dict | None, ошибка) из бинарного потока."""
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    if fmt == 'csv':
+        reader = csv.DictReader(text)
+        for record in reader:
+            if None in record: # Лишние значения без заголовка
+                yield reader.line_num, None, 'too many values'
+            else:
+                yield reader.line_num, record, None
+    elif fmt == 'ndjson':
+        for line_no, line in enumerate(text, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                yield line_no, None, f'invalid JSON: {e}'
+                continue
+            if not isinstance(record, dict):
+                yield line_no, None, 'expected a JSON object'
+                continue
+            yield line_no, record, None
+    else:
+        raise ValueError(f'Unsupported format: {fmt}')
+
+
+def validate_record(record, categories, statuses):
+    """Возвращает (значения в порядке FIELDS, список ошибок)."""
+    values, errors = [], []
+    for name, parse, required in FIELDS:
+        raw = record.get(name)
+        if isinstance(raw, str):
+            raw = raw.strip()
+        if raw is None or raw == '':
+            if required:
+                errors.append(f'{name}: required')
+            values.append(None)
+            continue
+        try:
+            values.append(parse(raw))
+        except ValueError as e:
+            errors.append(f'{name}: {e}')
+            values.append(None)
+    row = dict(zip(FIELD_NAMES, values))
+    if row['artist_category'] is not None and row['artist_category'] not in categories:
+        errors.append('artist_category: unknown category')
+    if row['status'] is not None and row['status'] not in statuses:
+        errors.append('status: unknown status')
+    if row['stock_quantity'] is not None and row['stock_quantity'] < 0:
+        errors.append('stock_quantity: must not be negative')
+    unknown = set(record) - set(FIELD_NAMES)
+    if unknown:
+        errors.append(f"unknown fields: {', '.join(sorted(unknown))}")
+    return values, errors
+
+
+def _copy_value(value):
+    # Текстовый формат COPY
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    text = value.isoformat() if isinstance(value, date) else str(value)
+    return (text.replace('\\', '\\\\').replace('\t', '\\t')
+                .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+_STAGING_SQL = '''
+    CREATE TEMP TABLE import_rows (
+        line INTEGER NOT NULL,
+        artist_name TEXT NOT NULL,
+        artist_category TEXT NOT NULL,
+        artist_description TEXT,
+        artist_image_url TEXT,
+        album_title TEXT NOT NULL,
+        base_price NUMERIC NOT NULL,
+        album_description TEXT,
+        release_date DATE,
+        status TEXT,
+        main_image_url TEXT,
+        is_preorder BOOLEAN,
+        version_name TEXT NOT NULL,
+        price_diff NUMERIC,
+        packaging_details TEXT,
+        stock_quantity INTEGER,
+        is_limited BOOLEAN
+    ) ON COMMIT DROP
+'''
+
+# Слияние - по два запроса на таблицу: UPDATE существующих строк (пустое поле файла оставляет
+# текущее значение, неизмененные строки не трогаются - без мертвых версий строк и лишних
+# срабатываний триггеров) и INSERT недостающих со значениями по умолчанию.
+# Данные артиста и альбома берутся из последней строки файла, где они встречаются.
+_MERGE_SQL = {
+    'artists': (
+        '''
+        UPDATE artists ar SET
+            category = s.artist_category,
+            description = COALESCE(s.artist_description, ar.description),
+            image_url = COALESCE(s.artist_image_url, ar.image_url)
+        FROM (
+            SELECT DISTINCT ON (artist_name) *
+            FROM import_rows
+            ORDER BY artist_name, line DESC
+        ) s
+        WHERE ar.name = s.artist_name
+          AND (ar.category, ar.description, ar.image_url) IS DISTINCT FROM
+              (s.artist_category, COALESCE(s.artist_description, ar.description),
+               COALESCE(s.artist_image_url, ar.image_url))
+        ''',
+        '''
+        INSERT INTO artists (name, category, description, image_url)
+        SELECT DISTINCT ON (s.artist_name)
+               s.artist_name, s.artist_category, s.artist_description, s.artist_image_url
+        FROM import_rows s
+        WHERE NOT EXISTS (SELECT 1 FROM artists ar WHERE ar.name = s.artist_name)
+        ORDER BY s.artist_name, s.line DESC
+        ON CONFLICT (name) DO NOTHING
+        ''',
+        'SELECT COUNT(DISTINCT artist_name) FROM import_rows',
+    ),
+    'albums': (
+        '''
+        UPDATE albums a SET
+            base_price = s.base_price,
+            description = COALESCE(s.album_description, a.description),
+            release_date = COALESCE(s.release_date, a.release_date),
+            status = COALESCE(s.status, a.status),
+            main_image_url = COALESCE(s.main_image_url, a.main_image_url),
+            is_preorder = COALESCE(s.is_preorder, a.is_preorder)
+        FROM (
+            SELECT DISTINCT ON (ar.id, i.album_title) ar.id AS artist_id, i.*
+            FROM import_rows i
+            JOIN artists ar ON ar.name = i.artist_name
+            ORDER BY ar.id, i.album_title, i.line DESC
+        ) s
+        WHERE a.artist_id = s.artist_id AND a.title = s.album_title
+          AND (a.base_price, a.description, a.release_date, a.status, a.main_image_url, a.is_preorder)
+              IS DISTINCT FROM
+              (s.base_price, COALESCE(s.album_description, a.description),
+               COALESCE(s.release_date, a.release_date), COALESCE(s.status, a.status),
+               COALESCE(s.main_image_url, a.main_image_url), COALESCE(s.is_preorder, a.is_preorder))
+        ''',
+        '''
+        INSERT INTO albums (
+            artist_id, title, base_price, description, release_date,
+            status, main_image_url, is_preorder
+        )
+        SELECT DISTINCT ON (ar.id, s.album_title)
+               ar.id, s.album_title, s.base_price, COALESCE(s.album_description, ''), s.release_date,
+               COALESCE(s.status, 'in_stock'), COALESCE(s.main_image_url, ''), COALESCE(s.is_preorder, FALSE)
+        FROM import_rows s
+        JOIN artists ar ON ar.name = s.artist_name
+        WHERE NOT EXISTS (SELECT 1 FROM albums a WHERE a.artist_id = ar.id AND a.title = s.album_title)
+        ORDER BY ar.id, s.album_title, s.line DESC
+        ON CONFLICT (artist_id, title) DO NOTHING
+        ''',
+        'SELECT COUNT(*) FROM (SELECT DISTINCT artist_name, album_title FROM import_rows) t',
+    ),
+    'album_versions': (
+        '''
+        UPDATE album_versions av SET
+            price_diff = COALESCE(s.price_diff, av.price_diff),
+            packaging_details = COALESCE(s.packaging_details, av.packaging_details),
+            stock_quantity = COALESCE(s.stock_quantity, av.stock_quantity),
+            is_limited = COALESCE(s.is_limited, av.is_limited)
+        FROM import_rows s
+        JOIN artists ar ON ar.name = s.artist_name
+        JOIN albums a ON a.artist_id = ar.id AND a.title = s.album_title
+        WHERE av.album_id = a.id AND av.version_name = s.version_name
+          AND (av.price_diff, av.packaging_details, av.stock_quantity, av.is_limited) IS DISTINCT FROM
+              (COALESCE(s.price_diff, av.price_diff), COALESCE(s.packaging_details, av.packaging_details),
+               COALESCE(s.stock_quantity, av.stock_quantity), COALESCE(s.is_limited, av.is_limited))
+        ''',
+        '''
+        INSERT INTO album_versions (
+            album_id, version_name, price_diff, packaging_details, stock_quantity, is_limited
+        )
+        SELECT a.id, s.version_name, COALESCE(s.price_diff, 0), COALESCE(s.packaging_details, ''),
+               COALESCE(s.stock_quantity, 0), COALESCE(s.is_limited, FALSE)
+        FROM import_rows s
+        JOIN artists ar ON ar.name = s.artist_name
+        JOIN albums a ON a.artist_id = ar.id AND a.title = s.album_title
+        WHERE NOT EXISTS (
+            SELECT 1 FROM album_versions av WHERE av.album_id = a.id AND av.version_name = s.version_name
+        )
+        ON CONFLICT (album_id, version_name) DO NOTHING
+        ''',
+        'SELECT COUNT(*) FROM import_rows',
+    ),
+}
+
+# Версии, у которых меняется остаток или признак лимитированности: их корзины
+# резервирования пересоздаются после слияния (см. inventory.py)
+_RESTOCK_SQL = '''
+    SELECT av.id
+    FROM import_rows s
+    JOIN artists ar ON ar.name = s.artist_name
+    JOIN albums a ON a.artist_id = ar.id AND a.title = s.album_title
+    JOIN album_versions av ON av.album_id = a.id AND av.version_name = s.version_name
+    WHERE (s.stock_quantity IS NOT NULL AND s.stock_quantity <> av.stock_quantity)
+       OR (s.is_limited IS NOT NULL AND s.is_limited <> av.is_limited)
+'''
+
+
+def import_catalog(conn, stream, fmt, categories, statuses, dry_run=False, on_error='skip',
+                   batch_size=10000, max_reported_errors=1000, progress=None, before_commit=None):
+    """Импортирует каталог из бинарного потока в одной транзакции.
+
+    on_error: 'skip' - некорректные строки пропускаются, 'abort' - при любой ошибке ничего
+    не импортируется (в сводке aborted=True). progress(event) получает словари с фазой и счетчиками.
+    before_commit(conn, restock_ids) вызывается перед коммитом (не в dry_run); restock_ids -
+    версии, у которых изменился остаток или признак лимитированности.
+    Возвращает сводку: счетчики по таблицам, ошибки по строкам, dry_run.
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f'Unsupported format: {fmt}')
+    if on_error not in ('skip', 'abort'):
+        raise ValueError('on_error must be skip or abort')
+    report = progress or (lambda event: None)
+
+    summary = {
+        'dry_run': dry_run,
+        'rows_read': 0,
+        'rows_valid': 0,
+        'error_count': 0,
+        'errors': [],
+        'aborted': False,
+    }
+
+    def add_error(line_no, messages):
+        summary['error_count'] += 1
+        if len(summary['errors']) < max_reported_errors:
+            summary['errors'].append({'line': line_no, 'errors': messages})
+
+    try:
+        with conn.cursor() as cur:
+            cur.execute(_STAGING_SQL)
+            copy_sql = f"COPY import_rows (line, {', '.join(FIELD_NAMES)}) FROM STDIN"
+            seen = {} # (артист, альбом, версия) -> строка, где встретилась впервые
+            buffer = io.StringIO()
+            buffered = 0
+
+            def flush():
+                nonlocal buffer, buffered
+                if buffered:
+                    buffer.seek(0)
+                    cur.copy_expert(copy_sql, buffer)
+                    buffer, buffered = io.StringIO(), 0
+                report({'phase': 'load', 'rows_read': summary['rows_read'], 'rows_valid': summary['rows_valid']})
+
+            for line_no, record, error in iter_records(stream, fmt):
+                summary['rows_read'] += 1
+                if error is not None:
+                    add_error(line_no, [error])
+                    continue
+                values, errors = validate_record(record, categories, statuses)
+                if not errors:
+                    key = (values[0], values[4], values[11]) # artist_name, album_title, version_name
+                    if key in seen:
+                        errors = [f'duplicate of line {seen[key]}']
+                    else:
+                        seen[key] = line_no
+                if errors:
+                    add_error(line_no, errors)
+                    continue
+                summary['rows_valid'] += 1
+                buffer.write('\t'.join(_copy_value(v) for v in (line_no, *values)))
+                buffer.write('\n')
+                buffered += 1
+                if buffered >= batch_size:
+                    flush()
+            flush()
+
+            if summary['error_count'] and on_error == 'abort':
+                conn.rollback()
+                summary['aborted'] = True
+                return summary
+
+            cur.execute('ANALYZE import_rows')
+
+            cur.execute(_RESTOCK_SQL)
+            restock_ids = [row[0] for row in cur.fetchall()]
+
+            for table, (update_sql, insert_sql, count_sql) in _MERGE_SQL.items():
+                report({'phase': 'merge', 'table': table})
+                cur.execute(update_sql)
+                updated = cur.rowcount
+                cur.execute(insert_sql)
+                inserted = cur.rowcount
+                cur.execute(count_sql)
+                total = cur.fetchone()[0]
+                summary[table] = {'inserted': inserted, 'updated': updated, 'unchanged': total - inserted - updated}
+
+        if dry_run:
+            conn.rollback()
+        else:
+            if before_commit is not None:
+                before_commit(conn, restock_ids)
+            conn.commit()
+        return summary
+    except Exception:
+        conn.rollback()
+        raise
@@ -0,0 +1,85 @@
+import json
+import re
+from datetime import date, datetime
+from decimal import Decimal
+
+
+# Денормализованная модель каталога catalog_read_model (migrations/006_catalog_read_model.sql).
+# Строки поддерживаются триггерами БД; здесь - разбор JSONB-колонок, пересчет
+# по наступлению границ скидок и сверка с исходными таблицами.
+
+# JSONB-колонки выбираются как текст (album::text) и разбираются здесь: числа - в Decimal,
+# даты - обратно в date / datetime, чтобы ответ совпадал с прочитанным из исходных таблиц
+JSON_COLUMNS = ('album', 'versions', 'discount')
+
+_DATE_KEY = re.compile(r'(^|_)(date|at)$')
+_ISO_DATE = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+_ISO_DATETIME = re.compile(r'^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(\.\d+)?([+-]\d{2}(:\d{2})?)?$')
+
+# Колонки, которые сверяет check_read_model (refreshed_at - служебная)
+COMPARED_COLUMNS = (
+    'artist_id', 'artist', 'artist_image', 'category', 'title', 'base_price', 'main_image_url',
+    'status', 'release_date', 'is_preorder', 'album', 'versions', 'min_price', 'max_price',
+    'total_stock', 'discount', 'discount_changes_at'
+)
+
+
+def _restore_dates(obj):
+    for key, value in obj.items():
+        if isinstance(value, str) and _DATE_KEY.search(key):
+            if _ISO_DATE.match(value):
+                obj[key] = date.fromisoformat(value)
+            elif _ISO_DATETIME.match(value):
+                obj[key] = datetime.fromisoformat(value)
+    return obj
+
+
+def decode_json(text):
+    if text is None:
+        return None
+    return json.loads(text, parse_float=Decimal, object_hook=_restore_dates)
+
+
+def decode_row(row):
+    """Разбирает JSONB-колонки строки модели, выбранные как текст."""
+    for column in JSON_COLUMNS:
+        if column in row:
+            row[column] = decode_json(row[column])
+    return row
+
+
+def pick(obj, keys):
+    return {key: obj[key] for key in keys if key in obj}
+
+
+def refresh_albums(conn, album_ids):
+    with conn.cursor() as cur:
+        cur.execute('SELECT refresh_catalog_read_model(%s)', (list(album_ids),))
+
+
+def refresh_due(conn):
+    """Пересчитывает альбомы, у которых началась или закончилась скидка. Возвращает их id."""
+    with conn.cursor() as cur:
+        cur.execute('SELECT refresh_due_catalog_read_model()')
+        return [row[0] for row in cur.fetchall()]
+
+
+def check_read_model(conn, fix=False):
+    """Сверяет модель с catalog_read_model_source.
+    Возвращает [(album_id, 'missing' | 'orphaned' | 'stale')]; fix=True пересчитывает расхождения."""
+    differs = ' OR '.join(f's.{column} IS DISTINCT FROM m.{column}' for column in COMPARED_COLUMNS)
+    with conn.cursor() as cur:
+        cur.execute(f'''
+            SELECT COALESCE(s.id, m.id) AS id,
+                   CASE WHEN m.id IS NULL THEN 'missing'
+                        WHEN s.id IS NULL THEN 'orphaned'
+                        ELSE 'stale' END AS problem
+            FROM catalog_read_model_source s
+            FULL JOIN catalog_read_model m ON m.id = s.id
+            WHERE m.id IS NULL OR s.id IS NULL OR {differs}
+            ORDER BY 1
+        ''')
+        problems = cur.fetchall()
+    if fix and problems:
+        refresh_albums(conn, [album_id for album_id, _ in problems])
+    return problems
@@ -0,0 +1,83 @@
+import threading
+import zlib
+
+try:
+    import brotli
+except ImportError: # brotli необязателен: без него сжимаем только gzip
+    brotli = None
+
+
+# Сжатие ответов gzip / brotli: целиком, потоково и с запоминанием сжатых вариантов
+# для закэшированных тел ответов.
+
+ETAG_SUFFIXES = {'gzip': '-gzip', 'br': '-br'}
+
+
+def available_encodings():
+    # Порядок - предпочтение сервера при равных q у клиента
+    return ['br', 'gzip'] if brotli is not None else ['gzip']
+
+
+def compress(data, encoding, level):
+    if encoding == 'br':
+        return brotli.compress(data, quality=level)
+    if encoding == 'gzip':
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 31) # wbits=31 - формат gzip
+        return compressor.compress(data) + compressor.flush()
+    raise ValueError(f'Unsupported encoding: {encoding}')
+
+
+def compress_stream(chunks, encoding, level, flush=False):
+    """Сжимает итератор кусков, не собирая тело целиком в памяти.
+    flush - каждый кусок отдается клиенту сразу (для потоковых ответов: прогресс импорта,
+    выгрузка), иначе компрессор копит данные до заполнения своего блока."""
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=level)
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            data = compressor.process(chunk)
+            if flush:
+                data += compressor.flush()
+            if data:
+                yield data
+        yield compressor.finish()
+    elif encoding == 'gzip':
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            data = compressor.compress(chunk)
+            if flush and chunk:
+                data += compressor.flush(zlib.Z_SYNC_FLUSH)
+            if data:
+                yield data
+        yield compressor.flush()
+    else:
+        raise ValueError(f'Unsupported encoding: {encoding}')
+
+
+def iter_chunks(data, size):
+    for start in range(0, len(data), size):
+        yield data[start:start + size]
+
+
+class EncodedBody:
+    """Тело ответа и его сжатые варианты; каждый вариант вычисляется один раз."""
+
+    __slots__ = ('body', 'mimetype', '_variants', '_lock')
+
+    def __init__(self, body, mimetype):
+        self.body = body
+        self.mimetype = mimetype
+        self._variants = {}
+        self._lock = threading.Lock()
+
+    def encoded(self, encoding, level):
+        variant = self._variants.get(encoding)
+        if variant is None:
+            with self._lock:
+                variant = self._variants.get(encoding)
+                if variant is None:
+                    variant = self._variants[encoding] = compress(self.body, encoding, level)
+        return variant
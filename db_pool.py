@@ -0,0 +1,250 @@
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+
+import psycopg2
+from psycopg2 import extensions
+
+
+# Пул соединений с PostgreSQL: ограниченный размер, проверка соединения при выдаче,
+# пересоздание по возрасту и быстрый отказ при исчерпании пула.
+
+
+class PoolExhausted(Exception):
+    """Свободное соединение не появилось за отведенное время ожидания."""
+
+    def __init__(self, timeout, retry_after=1):
+        super().__init__(f'Database pool exhausted (waited {timeout:.3f}s)')
+        self.timeout = timeout
+        self.retry_after = retry_after
+
+
+class _PoolEntry:
+    __slots__ = ('raw', 'created_at', 'last_used_at')
+
+    def __init__(self, raw):
+        now = time.monotonic()
+        self.raw = raw
+        self.created_at = now
+        self.last_used_at = now
+
+
+class PooledConnection:
+    """Обертка над соединением: close() возвращает соединение в пул, а не закрывает его."""
+
+    def __init__(self, pool, entry):
+        self._pool = pool
+        self._entry = entry
+
+    @property
+    def raw(self):
+        return self._entry.raw
+
+    def close(self):
+        if self._entry is not None:
+            entry, self._entry = self._entry, None
+            self._pool.release(entry)
+
+    @property
+    def closed(self):
+        return self._entry is None or self._entry.raw.closed
+
+    def __getattr__(self, name):
+        if self._entry is None:
+            raise psycopg2.InterfaceError('connection already returned to pool')
+        return getattr(self._entry.raw, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class WaitHistogram:
+    """Гистограмма времени ожидания соединения (границы в секундах)."""
+
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(self.BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+
+    def snapshot(self):
+        buckets = {}
+        cumulative = 0
+        for bound, count in zip(self.BUCKETS + ('+Inf',), self.counts):
+            cumulative += count
+            buckets[str(bound)] = cumulative
+        return {'buckets': buckets, 'sum': round(self.total, 6), 'count': self.count}
+
+
+class ConnectionPool:
+    def __init__(self, dsn_kwargs, min_size=2, max_size=20, timeout=0.5,
+                 max_lifetime=1800, health_check_after=30, retry_after=1,
+                 connection_factory=None):
+        if min_size > max_size:
+            raise ValueError('min_size must not exceed max_size')
+        self.dsn_kwargs = dict(dsn_kwargs)
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout # Сколько ждать свободное соединение, сек
+        self.max_lifetime = max_lifetime # Максимальный возраст соединения, сек
+        self.health_check_after = health_check_after # После такого простоя соединение проверяется SELECT 1
+        self.retry_after = retry_after
+        self.connection_factory = connection_factory
+
+        self._lock = threading.Condition(threading.Lock())
+        self._idle = deque()
+        self._size = 0 # Открытые соединения (свободные + выданные)
+        self._in_use = 0
+        self._waiting = 0
+        self._closed = False
+        self.pid = os.getpid()
+
+        self.stats_created = 0
+        self.stats_recycled = 0
+        self.stats_failed_checks = 0
+        self.stats_exhausted = 0
+        self.wait_histogram = WaitHistogram()
+
+        for _ in range(min_size):
+            self._idle.append(self._connect())
+            self._size += 1
+
+    def _connect(self):
+        kwargs = dict(self.dsn_kwargs)
+        if self.connection_factory is not None:
+            kwargs['connection_factory'] = self.connection_factory
+        raw = psycopg2.connect(**kwargs)
+        self.stats_created += 1
+        return _PoolEntry(raw)
+
+    def _is_expired(self, entry, now):
+        return self.max_lifetime and now - entry.created_at > self.max_lifetime
+
+    def _is_healthy(self, entry, now):
+        raw = entry.raw
+        if raw.closed:
+            return False
+        if now - entry.last_used_at < self.health_check_after:
+            return True
+        try:
+            with raw.cursor() as cur:
+                cur.execute('SELECT 1')
+            raw.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    @staticmethod
+    def _discard(entry):
+        try:
+            entry.raw.close()
+        except psycopg2.Error:
+            pass
+
+    def getconn(self, timeout=None):
+        """Выдает соединение из пула или поднимает PoolExhausted по истечении timeout."""
+        timeout = self.timeout if timeout is None else timeout
+        started = time.monotonic()
+        deadline = started + timeout
+
+        with self._lock:
+            if self._closed:
+                raise psycopg2.InterfaceError('connection pool is closed')
+            self._waiting += 1
+            try:
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.stats_exhausted += 1
+                        self.wait_histogram.observe(time.monotonic() - started)
+                        raise PoolExhausted(timeout, self.retry_after)
+                    self._lock.wait(remaining)
+            finally:
+                self._waiting -= 1
+
+            entry = self._idle.pop() if self._idle else None
+            if entry is None:
+                self._size += 1 # Резервируем место до открытия соединения
+            self._in_use += 1
+            self.wait_histogram.observe(time.monotonic() - started)
+
+        # Сетевые операции выполняются вне блокировки
+        try:
+            now = time.monotonic()
+            if entry is not None and self._is_expired(entry, now):
+                self.stats_recycled += 1
+                self._discard(entry)
+                entry = None
+            elif entry is not None and not self._is_healthy(entry, now):
+                self.stats_failed_checks += 1
+                self._discard(entry)
+                entry = None
+            if entry is None:
+                entry = self._connect()
+        except Exception:
+            with self._lock:
+                self._size -= 1
+                self._in_use -= 1
+                self._lock.notify()
+            raise
+
+        return PooledConnection(self, entry)
+
+    def release(self, entry):
+        raw = entry.raw
+        keep = not raw.closed and not self._closed
+        if keep:
+            try:
+                # Незавершенная транзакция откатывается, чтобы не протечь в следующий запрос
+                if raw.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                    raw.rollback()
+            except psycopg2.Error:
+                keep = False
+
+        with self._lock:
+            self._in_use -= 1
+            if keep:
+                entry.last_used_at = time.monotonic()
+                self._idle.append(entry)
+            else:
+                self._size -= 1
+            self._lock.notify()
+
+        if not keep:
+            self._discard(entry)
+
+    def closeall(self):
+        with self._lock:
+            self._closed = True
+            idle, self._idle = list(self._idle), deque()
+            self._size -= len(idle)
+            self._lock.notify_all()
+        for entry in idle:
+            self._discard(entry)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'min_size': self.min_size,
+                'max_size': self.max_size,
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': self._in_use,
+                'waiting': self._waiting,
+                'created': self.stats_created,
+                'recycled': self.stats_recycled,
+                'failed_health_checks': self.stats_failed_checks,
+                'exhausted': self.stats_exhausted,
+                'wait_seconds': self.wait_histogram.snapshot(),
+            }
@@ -0,0 +1,199 @@
+import logging
+import os
+import threading
+import time
+from decimal import Decimal
+
+from psycopg2.extras import RealDictCursor
+
+
+# Индекс действующих скидок в памяти процесса.
+#
+# Для каждого альбома хранятся интервалы его скидок (текущих и будущих). Из них заранее
+# вычисляются действующие скидки и одна эффективная: наибольший процент, при равенстве -
+# меньший id. Поиск - обращение к словарю. Фоновый поток пересчитывает состояние ровно
+# на ближайшей границе start_date / end_date и перечитывает скидки из БД по запросу
+# (после изменений в админке) и раз в refresh_interval на случай потерянных уведомлений.
+#
+# Границы приходят из БД как "секунд до начала/конца" относительно NOW() и переводятся
+# в time.monotonic(), поэтому часовые пояса сервера и БД не влияют на результат.
+
+logger = logging.getLogger(__name__)
+
+_DISCOUNTS_SQL = '''
+    SELECT ad.album_id, d.*,
+           EXTRACT(EPOCH FROM d.start_date - NOW())::float AS _starts_in,
+           EXTRACT(EPOCH FROM d.end_date - NOW())::float AS _ends_in
+    FROM discounts d
+    JOIN album_discounts ad ON ad.discount_id = d.id
+    WHERE d.is_active = TRUE AND d.end_date >= NOW()
+    ORDER BY ad.album_id, d.id
+'''
+
+
+def effective_discount(discounts):
+    """Правило выбора одной скидки: наибольший процент, при равенстве - меньший id."""
+    if not discounts:
+        return None
+    return max(discounts, key=lambda d: (d['discount_percent'], -d['id']))
+
+
+def discounted_price(price, discount):
+    """Цена со скидкой, округленная до копеек (как при оформлении заказа)."""
+    if discount is None:
+        return price
+    percent = Decimal(str(discount['discount_percent']))
+    return (Decimal(price) * (1 - percent / 100)).quantize(Decimal('0.01'))
+
+
+class DiscountIndex:
+    def __init__(self, connect, refresh_interval=300.0, on_refresh=None):
+        self.connect = connect # Возвращает соединение; close() отдает его обратно
+        self.refresh_interval = refresh_interval
+        self.on_refresh = on_refresh # Вызывается фоновым потоком после границы или перезагрузки
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._reload_requested = False
+        self._refresh_pending = False # Был пересчет, о котором еще не сообщили on_refresh
+        self._intervals = {} # album_id -> [(начало, конец, скидка)] в шкале monotonic
+        self._active = {} # album_id -> действующие скидки (по id)
+        self._effective = {} # album_id -> эффективная скидка
+        self._next_boundary = float('inf')
+        self._loaded_at = None
+
+        self.reloads = 0
+        self.rebuilds = 0
+
+    # ---- Поиск ----
+
+    def _check_boundary(self):
+        # Таймер мог еще не сработать - пересчитываем на месте, чтобы граница была точной
+        if time.monotonic() >= self._next_boundary:
+            with self._lock:
+                if time.monotonic() >= self._next_boundary:
+                    self._rebuild()
+
+    def effective(self, album_id):
+        self._check_boundary()
+        return self._effective.get(album_id)
+
+    def active(self, album_id):
+        self._check_boundary()
+        return self._active.get(album_id, [])
+
+    def effective_percents(self, album_ids=None):
+        """{album_id: discount_percent} эффективных скидок альбомов album_ids (None - всех)."""
+        self._check_boundary()
+        effective = self._effective
+        if album_ids is None:
+            return {album_id: d['discount_percent'] for album_id, d in effective.items()}
+        return {
+            album_id: effective[album_id]['discount_percent']
+            for album_id in album_ids if album_id in effective
+        }
+
+    # ---- Загрузка и пересчет ----
+
+    def load(self):
+        conn = self.connect()
+        try:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute(_DISCOUNTS_SQL)
+                rows = cur.fetchall()
+        finally:
+            conn.close()
+        now = time.monotonic()
+        intervals = {}
+        for row in rows:
+            album_id = row.pop('album_id')
+            starts_at = now + row.pop('_starts_in')
+            ends_at = now + row.pop('_ends_in')
+            intervals.setdefault(album_id, []).append((starts_at, ends_at, row))
+        with self._lock:
+            self._intervals = intervals
+            self._loaded_at = now
+            self.reloads += 1
+            self._rebuild()
+
+    def _rebuild(self):
+        # Вызывается под self._lock
+        now = time.monotonic()
+        active, effective = {}, {}
+        next_boundary = float('inf')
+        for album_id, intervals in self._intervals.items():
+            current = []
+            for starts_at, ends_at, discount in intervals:
+                if starts_at <= now <= ends_at: # Как BETWEEN: обе границы включительно
+                    current.append(discount)
+                    next_boundary = min(next_boundary, ends_at)
+                elif now < starts_at:
+                    next_boundary = min(next_boundary, starts_at)
+            if current:
+                active[album_id] = current
+                effective[album_id] = effective_discount(current)
+        self._active = active
+        self._effective = effective
+        # Конец интервала включительный - скидка снимается сразу после него
+        self._next_boundary = next_boundary + 0.001
+        self.rebuilds += 1
+        self._refresh_pending = True
+        self._wake.set()
+
+    def request_reload(self):
+        """Перечитать скидки из БД в фоне (после изменений в админке)."""
+        self._reload_requested = True
+        self._wake.set()
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='discount-index', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            now = time.monotonic()
+            refresh_at = (self._loaded_at or now) + self.refresh_interval
+            self._wake.wait(max(0.0, min(self._next_boundary, refresh_at) - now))
+            self._wake.clear()
+            if self._stop.is_set():
+                break
+            try:
+                if self._reload_requested or time.monotonic() >= refresh_at:
+                    self._reload_requested = False
+                    self.load()
+                elif time.monotonic() >= self._next_boundary:
+                    with self._lock:
+                        self._rebuild()
+                # Пересчет мог сделать и поиск в другом потоке - сообщаем о нем отсюда
+                if self._refresh_pending and self.on_refresh is not None:
+                    self._refresh_pending = False
+                    try:
+                        self.on_refresh()
+                    except Exception:
+                        self._refresh_pending = True
+                        raise
+            except Exception:
+                logger.exception('Discount index refresh failed')
+                self._stop.wait(1.0)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'albums_with_discounts': len(self._intervals),
+                'albums_discounted_now': len(self._effective),
+                'next_boundary_in': (
+                    round(self._next_boundary - time.monotonic(), 3)
+                    if self._next_boundary != float('inf') else None
+                ),
+                'reloads': self.reloads,
+                'rebuilds': self.rebuilds,
+            }
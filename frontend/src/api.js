@@ -41,8 +41,9 @@ apiInstance.interceptors.request.use(config => {
 
 
 export default {
-  getAlbums() {
-    return apiInstance.get('/albums');
+  // params: category, artist_id, min_price, max_price, status, is_preorder, in_stock, sort, limit, cursor
+  getAlbums(params) {
+    return apiInstance.get('/albums', { params });
   },
 
   getAlbum(id) {
@@ -172,7 +172,12 @@ const AdminPanel = () => {
         ...response.data,
         artist_id: response.data.artist_id?.toString() || '',
         release_date: formatDateForInput(response.data.release_date),
-        versions: response.data.versions || [{
+        // original_stock_quantity - остаток на момент загрузки: сервер меняет остаток,
+        // только если его изменили в форме
+        versions: response.data.versions?.map(version => ({
+          ...version,
+          original_stock_quantity: version.stock_quantity
+        })) || [{
           version_name: '',
           price_diff: 0,
           packaging_details: '',
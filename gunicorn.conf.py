@@ -0,0 +1,64 @@
+# Настройки gunicorn для продакшена: gunicorn -c gunicorn.conf.py wsgi:app
+#
+# Значения берутся из окружения, по умолчанию - под небольшой сервер.
+# Приложение загружается в мастере до fork (preload_app): код и данные импорта делятся
+# между воркерами копированием при записи. Соединения с БД, кэши и фоновые потоки
+# создаются в каждом воркере после fork (server.init_worker).
+#
+# Перезапуск воркеров без простоя: kill -HUP <pid мастера> - новые воркеры стартуют,
+# старые дорабатывают текущие запросы (graceful_timeout). При preload_app код при HUP
+# не перечитывается; для выкладки нового кода: kill -USR2 <pid мастера> (новый мастер
+# рядом со старым), затем kill -QUIT <pid старого мастера>.
+import multiprocessing
+import os
+
+
+def env_int(name, default):
+    return int(os.environ.get(name, default))
+
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:8000')
+
+# Число процессов; WEB_CONCURRENCY - общепринятое имя переменной.
+# Запросы в основном ждут БД, а не процессор, поэтому не cpu_count() * 2 + 1: каждый
+# воркер держит свои соединения, и их общее число упирается в max_connections Postgres.
+workers = env_int('WEB_CONCURRENCY', multiprocessing.cpu_count() + 1)
+
+# gthread - потоки в каждом воркере; gevent - зеленые потоки (нужны gevent и psycogreen)
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+threads = env_int('GUNICORN_THREADS', 8) # Для gthread: одновременных запросов на воркер
+
+# Соединения с БД. Пул воркера по умолчанию - по соединению на поток (KPOP_DB_POOL_MAX_SIZE,
+# см. server.create_app; для gevent задайте его явно); фоновые потоки (скидки, остатки, продажи) берут соединения из
+# того же пула на миллисекунды. Сверх пула воркер открывает еще два: слушатель NOTIFY и
+# соединение EXPLAIN журнала медленных запросов. Всего:
+#     workers * (DB_POOL_MAX_SIZE + 2)
+# и это должно быть меньше max_connections Postgres (по умолчанию 100, из них 3 - для
+# суперпользователя) с запасом на миграции, CLI и сессии администраторов. При значениях
+# по умолчанию на 8 ядрах: 9 * (8 + 2) = 90. Больше воркеров или потоков - поднимите
+# max_connections или поставьте перед БД pgbouncer.
+os.environ.setdefault('KPOP_DB_POOL_MAX_SIZE', str(threads))
+worker_connections = env_int('GUNICORN_WORKER_CONNECTIONS', 1000) # Для gevent
+
+keepalive = env_int('GUNICORN_KEEPALIVE', 5) # Ожидание следующего запроса по соединению, сек
+timeout = env_int('GUNICORN_TIMEOUT', 60) # Зависший воркер перезапускается, сек
+graceful_timeout = env_int('GUNICORN_GRACEFUL_TIMEOUT', 30) # Доработка запросов при остановке, сек
+
+# Перезапуск воркера после N запросов (от утечек памяти); разброс, чтобы не все сразу
+max_requests = env_int('GUNICORN_MAX_REQUESTS', 10000)
+max_requests_jitter = env_int('GUNICORN_MAX_REQUESTS_JITTER', 1000)
+
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') != '0'
+
+accesslog = os.environ.get('GUNICORN_ACCESS_LOG', '-')
+errorlog = '-'
+
+
+def post_worker_init(worker):
+    # Вызывается в воркере после fork и после monkey-patching gevent, до приема запросов
+    if 'gevent' in worker.cfg.worker_class_str:
+        # psycopg2 ждет ответа БД через gevent, а не блокирует весь воркер
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+    import server
+    server.init_worker()
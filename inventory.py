@@ -0,0 +1,261 @@
+import logging
+import os
+import random
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+# Резервирование остатков при оформлении заказа.
+#
+# Остаток лимитированной версии (is_limited) хранится в нескольких корзинах-счетчиках
+# inventory_buckets. Параллельные покупатели начинают с разных корзин и пропускают
+# занятые (SKIP LOCKED), поэтому не выстраиваются в очередь за блокировкой одной строки.
+# album_versions.stock_quantity для таких версий - витринное значение, которое
+# периодически пересчитывается sync_display_stock().
+# Остальные версии (если их остатки отслеживаются) резервируются условным
+# UPDATE album_versions ... WHERE stock_quantity >= нужное количество.
+
+_RESERVE_SQL = '''
+    WITH wanted AS (
+        SELECT ci.album_version_id, SUM(ci.quantity)::int AS need,
+               EXISTS (
+                   SELECT 1 FROM inventory_buckets b WHERE b.album_version_id = ci.album_version_id
+               ) AS striped
+        FROM cart_items ci
+        JOIN cart c ON ci.cart_id = c.id
+        JOIN album_versions av ON av.id = ci.album_version_id
+        WHERE c.user_id = %(user_id)s AND (av.is_limited OR %(track_all)s)
+        GROUP BY ci.album_version_id
+    ),
+    candidates AS (
+        SELECT b.album_version_id, b.bucket, b.quantity,
+               (b.bucket + %(offset)s) %% %(stripes)s AS visit_order
+        FROM inventory_buckets b
+        WHERE b.album_version_id IN (SELECT album_version_id FROM wanted WHERE striped)
+          AND b.quantity > 0
+        ORDER BY b.album_version_id, visit_order
+        FOR UPDATE {lock_mode}
+    ),
+    running AS (
+        SELECT c.album_version_id, c.bucket, c.quantity, w.need,
+               SUM(c.quantity) OVER (
+                   PARTITION BY c.album_version_id ORDER BY c.visit_order, c.bucket
+               ) - c.quantity AS taken_before
+        FROM candidates c
+        JOIN wanted w USING (album_version_id)
+    ),
+    from_buckets AS (
+        UPDATE inventory_buckets b
+        SET quantity = b.quantity - LEAST(r.quantity, r.need - r.taken_before)
+        FROM running r
+        WHERE b.album_version_id = r.album_version_id
+          AND b.bucket = r.bucket
+          AND r.taken_before < r.need
+        RETURNING b.album_version_id, LEAST(r.quantity, r.need - r.taken_before) AS took
+    ),
+    from_versions AS (
+        UPDATE album_versions av
+        SET stock_quantity = av.stock_quantity - w.need
+        FROM wanted w
+        WHERE av.id = w.album_version_id
+          AND NOT w.striped
+          AND av.stock_quantity >= w.need
+        RETURNING av.id AS album_version_id, w.need AS took
+    ),
+    reserved AS (
+        SELECT album_version_id, took FROM from_buckets
+        UNION ALL
+        SELECT album_version_id, took FROM from_versions
+    )
+    SELECT w.album_version_id, w.need, COALESCE(SUM(r.took), 0)::int AS reserved
+    FROM wanted w
+    LEFT JOIN reserved r USING (album_version_id)
+    GROUP BY w.album_version_id, w.need
+'''
+
+
+def reserve_cart(conn, user_id, stripes, track_all=False):
+    """Резервирует остатки под корзину пользователя в текущей транзакции.
+
+    Возвращает список нехваток [{'version_id', 'requested', 'available'}]; если он не пуст,
+    транзакцию нужно откатить - частично списанные остатки вернутся.
+    Строка cart пользователя должна быть заблокирована (FOR UPDATE) до конца транзакции,
+    иначе корзина может измениться между резервированием и оформлением заказа.
+    """
+    params = {
+        'user_id': user_id,
+        'track_all': track_all,
+        'stripes': stripes,
+        'offset': random.randrange(stripes), # Разные покупатели начинают с разных корзин
+    }
+    with conn.cursor() as cur:
+        savepoint = False
+        # Сначала пропускаем занятые корзины. Если так не хватило, пробуем еще раз с ожиданием:
+        # занятая корзина могла принадлежать транзакции, которая откатится.
+        for lock_mode in ('SKIP LOCKED', ''):
+            if savepoint:
+                cur.execute('ROLLBACK TO SAVEPOINT inventory_reserve')
+            else:
+                cur.execute('SAVEPOINT inventory_reserve')
+                savepoint = True
+            cur.execute(_RESERVE_SQL.format(lock_mode=lock_mode), params)
+            shortfalls = [
+                {'version_id': version_id, 'requested': need, 'available': reserved}
+                for version_id, need, reserved in cur.fetchall()
+                if reserved < need
+            ]
+            if not shortfalls:
+                break
+        cur.execute('RELEASE SAVEPOINT inventory_reserve')
+    return shortfalls
+
+
+def release_order(conn, order_id, track_all=False):
+    """Возвращает остатки позиций заказа (например, при отмене).
+    Возвращает [(album_id, artist_id)] альбомов, у которых сразу изменился витринный остаток
+    (версии без корзин; разложенные по корзинам версии обновит sync_display_stock())."""
+    with conn.cursor() as cur:
+        cur.execute('''
+            WITH items AS (
+                SELECT oi.album_version_id, SUM(oi.quantity)::int AS quantity
+                FROM order_items oi
+                JOIN album_versions av ON av.id = oi.album_version_id
+                WHERE oi.order_id = %(order_id)s AND (av.is_limited OR %(track_all)s)
+                GROUP BY oi.album_version_id
+            ),
+            targets AS (
+                -- Одна случайная корзина на версию: выбирается один раз, до UPDATE
+                SELECT i.album_version_id, i.quantity, t.bucket
+                FROM items i
+                CROSS JOIN LATERAL (
+                    SELECT bucket FROM inventory_buckets
+                    WHERE album_version_id = i.album_version_id
+                    ORDER BY random()
+                    LIMIT 1
+                ) t
+            ),
+            to_buckets AS (
+                UPDATE inventory_buckets b
+                SET quantity = b.quantity + t.quantity
+                FROM targets t
+                WHERE b.album_version_id = t.album_version_id
+                  AND b.bucket = t.bucket
+                RETURNING b.album_version_id
+            ),
+            to_versions AS (
+                UPDATE album_versions av
+                SET stock_quantity = av.stock_quantity + i.quantity
+                FROM items i
+                WHERE av.id = i.album_version_id
+                  AND NOT EXISTS (SELECT 1 FROM inventory_buckets b WHERE b.album_version_id = i.album_version_id)
+                RETURNING av.album_id
+            )
+            SELECT id, artist_id FROM albums
+            WHERE id IN (SELECT album_id FROM to_versions)
+            ORDER BY id
+        ''', {'order_id': order_id, 'track_all': track_all})
+        return cur.fetchall()
+
+
+def stripe_versions(conn, stripes, album_id=None):
+    """Раскладывает остаток лимитированных версий (альбома или всех) по корзинам.
+    Уже разложенные версии не трогает."""
+    with conn.cursor() as cur:
+        cur.execute('''
+            INSERT INTO inventory_buckets (album_version_id, bucket, quantity)
+            SELECT av.id, s.bucket,
+                   GREATEST(av.stock_quantity, 0) / %(stripes)s
+                   + CASE WHEN s.bucket < GREATEST(av.stock_quantity, 0) %% %(stripes)s THEN 1 ELSE 0 END
+            FROM album_versions av
+            CROSS JOIN generate_series(0, %(stripes)s - 1) AS s(bucket)
+            WHERE av.is_limited
+              AND (%(album_id)s::int IS NULL OR av.album_id = %(album_id)s::int)
+              AND NOT EXISTS (SELECT 1 FROM inventory_buckets b WHERE b.album_version_id = av.id)
+            ON CONFLICT DO NOTHING
+        ''', {'stripes': stripes, 'album_id': album_id})
+        return cur.rowcount
+
+
+def unstripe_versions(conn, version_ids):
+    """Удаляет корзины версий. После этого stripe_versions() разложит заново их текущий
+    stock_quantity (если версия лимитированная) - так применяется остаток, заданный в админке."""
+    with conn.cursor() as cur:
+        cur.execute('DELETE FROM inventory_buckets WHERE album_version_id = ANY(%s)', (list(version_ids),))
+
+
+def sync_display_stock(conn):
+    """Переносит сумму корзин в album_versions.stock_quantity.
+    Возвращает [(album_id, artist_id)] альбомов, у которых изменился остаток."""
+    with conn.cursor() as cur:
+        cur.execute('''
+            WITH updated AS (
+                UPDATE album_versions av
+                SET stock_quantity = b.total
+                FROM (
+                    SELECT album_version_id, SUM(quantity)::int AS total
+                    FROM inventory_buckets
+                    GROUP BY album_version_id
+                ) b
+                WHERE av.id = b.album_version_id
+                  AND av.stock_quantity IS DISTINCT FROM b.total
+                RETURNING av.album_id
+            )
+            SELECT id, artist_id FROM albums
+            WHERE id IN (SELECT album_id FROM updated)
+            ORDER BY id
+        ''')
+        return cur.fetchall()
+
+
+class StockSync:
+    """Фоновый поток, периодически вызывающий sync_display_stock().
+    Из нескольких процессов за один проход синхронизирует только один (advisory lock)."""
+
+    LOCK_KEY = 0x1a7e57 # Ключ pg_try_advisory_xact_lock
+
+    def __init__(self, connect, interval=5.0, on_change=None):
+        self.connect = connect # Возвращает соединение; close() отдает его обратно
+        self.interval = interval
+        self.on_change = on_change # on_change(conn, albums) в той же транзакции
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='stock-sync', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def run_once(self):
+        conn = self.connect()
+        try:
+            with conn.cursor() as cur:
+                cur.execute('SELECT pg_try_advisory_xact_lock(%s)', (self.LOCK_KEY,))
+                if not cur.fetchone()[0]:
+                    conn.rollback()
+                    return []
+            albums = sync_display_stock(conn)
+            if albums and self.on_change is not None:
+                self.on_change(conn, albums)
+            conn.commit()
+            return albums
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception:
+                logger.exception('Stock sync failed')
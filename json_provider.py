@@ -0,0 +1,91 @@
+import re
+
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError: # Без orjson работает стандартный провайдер Flask
+    orjson = None
+
+
+# Быстрый JSON-провайдер на orjson. Вывод байт-в-байт совпадает с DefaultJSONProvider
+# (сортировка ключей, ensure_ascii, компактные разделители, Decimal -> строка,
+# даты в формате HTTP), поэтому фронтенд не замечает замены.
+
+_NON_ASCII = re.compile(r'[^\x00-\x7f]')
+
+
+def _escape_char(match):
+    code = ord(match.group())
+    if code < 0x10000:
+        return f'\\u{code:04x}'
+    # Символы вне BMP кодируются суррогатной парой, как в json.dumps
+    code -= 0x10000
+    return f'\\u{0xd800 | (code >> 10):04x}\\u{0xdc00 | (code & 0x3ff):04x}'
+
+
+# orjson и repr(float) по-разному записывают очень малые и очень большие числа
+# (0.00001 / 1e16 против 1e-05 / 1e+16). Такие числа переписываются через repr.
+_FLOAT_FORMAT_HINT = re.compile(rb'\de|0\.0000|\d{17}')
+_STRING_OR_NUMBER = re.compile(rb'"(?:[^"\\]|\\.)*"|-?\d+(?:\.\d+)?(?:e[+-]?\d+)?')
+
+
+def _repr_float(match):
+    token = match.group()
+    if token[:1] == b'"' or (b'.' not in token and b'e' not in token):
+        return token # Строки и целые не трогаем
+    return repr(float(token)).encode('ascii')
+
+
+def python_floats(data):
+    """Приводит запись чисел с плавающей точкой к формату repr(float), как у json."""
+    if not _FLOAT_FORMAT_HINT.search(data):
+        return data
+    return _STRING_OR_NUMBER.sub(_repr_float, data)
+
+
+def ascii_escape(data):
+    """Экранирует не-ASCII символы как json.dumps(ensure_ascii=True).
+    Вне строковых литералов JSON таких символов не бывает, поэтому замена безопасна."""
+    if data.isascii():
+        return data
+    return _NON_ASCII.sub(_escape_char, data.decode('utf-8')).encode('ascii')
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    def _orjson_option(self):
+        # datetime/date отдаются в default, чтобы форматироваться как у Flask (http_date)
+        # Нестроковые ключи не включаются: json сортирует их иначе, такие объекты уходят в fallback
+        option = orjson.OPT_PASSTHROUGH_DATETIME
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return option
+
+    def dumps_bytes(self, obj):
+        """Компактный JSON в байтах или None, если объект нужно отдать стандартному провайдеру."""
+        try:
+            data = orjson.dumps(obj, default=self.default, option=self._orjson_option())
+        except (orjson.JSONEncodeError, TypeError):
+            return None # Например, целые больше 64 бит - пусть разберется json
+        data = python_floats(data)
+        return ascii_escape(data) if self.ensure_ascii else data
+
+    def dumps(self, obj, **kwargs):
+        # orjson дает только компактный вывод; остальные варианты (отступы, разделители
+        # по умолчанию) формирует json из стандартной библиотеки
+        if orjson is None or kwargs != {'separators': (',', ':')}:
+            return super().dumps(obj, **kwargs)
+        data = self.dumps_bytes(obj)
+        if data is None:
+            return super().dumps(obj, **kwargs)
+        return data.decode('ascii' if self.ensure_ascii else 'utf-8')
+
+    def response(self, *args, **kwargs):
+        # В отладке Flask форматирует с отступами - оставляем это стандартному провайдеру
+        if orjson is None or self.compact is False or (self.compact is None and self._app.debug):
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        data = self.dumps_bytes(obj)
+        if data is None:
+            return super().response(*args, **kwargs)
+        return self._app.response_class(data + b'\n', mimetype=self.mimetype)
@@ -0,0 +1,76 @@
+# Пакетная загрузка связанных строк: один запрос на всю страницу родительских записей
+# вместо отдельного запроса на каждую строку (N+1).
+
+
+def group_related(parents, attr, parent_key='id'):
+    """Заводит пустые списки parents[i][attr]; возвращает {id родителя: список}."""
+    grouped = {}
+    for parent in parents:
+        parent[attr] = grouped.setdefault(parent[parent_key], [])
+    return grouped
+
+
+def assign_related(grouped, rows):
+    # Раскладывает строки с колонкой _parent_id по спискам group_related
+    for row in rows:
+        grouped[row.pop('_parent_id')].append(row)
+
+
+def attach_related(cur, parents, attr, query, parent_key='id'):
+    """Выполняет query для всех родителей сразу и раскладывает строки по parents[i][attr].
+
+    query принимает один параметр - массив id родителей (``= ANY(%s)``) и должен
+    возвращать id родителя в колонке ``_parent_id``; она удаляется из результата.
+    """
+    if not parents:
+        return parents
+
+    grouped = group_related(parents, attr, parent_key)
+    cur.execute(query, (list(grouped),))
+    assign_related(grouped, cur.fetchall())
+    return parents
+
+
+def attach_album_versions(cur, albums, columns='*', in_stock_only=False):
+    # Версии для всех альбомов страницы
+    stock_filter = 'AND stock_quantity > 0' if in_stock_only else ''
+    return attach_related(cur, albums, 'versions', f'''
+        SELECT album_id AS _parent_id, {columns}
+        FROM album_versions
+        WHERE album_id = ANY(%s) {stock_filter}
+        ORDER BY album_id, id
+    ''')
+
+
+# Поля товаров заказа для покупателя
+USER_ORDER_ITEM_COLUMNS = '''
+    oi.*,
+    av.version_name,
+    a.title as album_title,
+    a.main_image_url,
+    ar.name as artist_name
+'''
+
+# Поля товаров заказа для админки
+ADMIN_ORDER_ITEM_COLUMNS = '''
+    oi.*, av.version_name as current_version_name,
+    a.title as album_title, ar.name as artist_name
+'''
+
+
+def order_items_query(columns=USER_ORDER_ITEM_COLUMNS):
+    # Товары заказов по массиву id заказов
+    return f'''
+        SELECT oi.order_id AS _parent_id, {columns}
+        FROM order_items oi
+        JOIN album_versions av ON oi.album_version_id = av.id
+        JOIN albums a ON av.album_id = a.id
+        JOIN artists ar ON a.artist_id = ar.id
+        WHERE oi.order_id = ANY(%s)
+        ORDER BY oi.order_id, oi.id
+    '''
+
+
+def attach_order_items(cur, orders, columns=USER_ORDER_ITEM_COLUMNS):
+    # Товары для всех заказов страницы
+    return attach_related(cur, orders, 'items', order_items_query(columns))
@@ -0,0 +1,251 @@
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+
+from psycopg2 import extensions
+
+from json_provider import OrjsonProvider
+
+
+# Метрики HTTP-запросов: задержка, коды ответа, число и время SQL-запросов, время
+# сериализации JSON и ожидания соединения из пула - по каждому маршруту (endpoint).
+#
+# Счетчики текущего запроса (RequestStats) живут в ContextVar: курсоры соединений
+# InstrumentedConnection добавляют в них время своих запросов, не зная о Flask.
+# По завершении запроса значения одним захватом блокировки попадают в гистограммы
+# процесса, которые отдаются в текстовом формате Prometheus.
+#
+# Метрики - на процесс: при нескольких воркерах каждый отдает свои, с меткой worker=pid.
+#
+# Те же курсоры ведут трассу запроса - текст, параметры, время и число строк каждого
+# SQL-запроса - для журнала медленных запросов (slow_queries.py).
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+_current = ContextVar('request_stats', default=None)
+
+
+class RequestStats:
+    __slots__ = ('started', 'queries', 'sql_time', 'serialization_time', 'pool_wait',
+                 'trace', 'trace_limit', 'slow', 'slow_threshold')
+
+    def __init__(self, trace_limit=0, slow_threshold=None):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.sql_time = 0.0
+        self.serialization_time = 0.0
+        self.pool_wait = 0.0
+        self.trace = [] # (текст, параметры, сек, строк) первых trace_limit запросов
+        self.trace_limit = trace_limit
+        self.slow = [] # (текст, запрос с подставленными параметрами или None, сек)
+        self.slow_threshold = slow_threshold # Запрос дольше - медленный, сек; None - не отслеживать
+
+    def record_query(self, cursor, query, vars, duration):
+        self.queries += 1
+        self.sql_time += duration
+        if len(self.trace) >= self.trace_limit and (self.slow_threshold is None or duration < self.slow_threshold):
+            return
+        if not isinstance(query, str):
+            # bytes или psycopg2.sql.Composed
+            query = query.decode() if isinstance(query, bytes) else query.as_string(cursor)
+        if len(self.trace) < self.trace_limit:
+            self.trace.append((query, vars, duration, cursor.rowcount))
+        if self.slow_threshold is not None and duration >= self.slow_threshold:
+            try:
+                statement = cursor.mogrify(query, vars) # Для EXPLAIN; executemany, COPY - не подходят
+            except Exception:
+                statement = None
+            self.slow.append((query, statement, duration))
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def server_timing(self, duration):
+        """Значение заголовка Server-Timing (миллисекунды)."""
+        return (f'app;dur={duration * 1000:.2f}, '
+                f'db;dur={self.sql_time * 1000:.2f};desc="{self.queries} queries", '
+                f'ser;dur={self.serialization_time * 1000:.2f}, '
+                f'pool;dur={self.pool_wait * 1000:.2f}')
+
+
+def begin_request(trace_limit=0, slow_threshold=None):
+    """Начинает сбор для текущего запроса; токен передается в end_request."""
+    return _current.set(RequestStats(trace_limit, slow_threshold))
+
+
+def end_request(token):
+    _current.reset(token)
+
+
+def current_request_stats():
+    return _current.get()
+
+
+# ---- Курсоры с замером времени ----
+
+class _TimedCursor:
+    __slots__ = ()
+
+    def _timed(self, method, query, *args):
+        stats = _current.get()
+        if stats is None:
+            return method(query, *args)
+        started = time.perf_counter()
+        try:
+            return method(query, *args)
+        finally:
+            stats.record_query(self, query, args[0] if args else None, time.perf_counter() - started)
+
+    def execute(self, query, vars=None):
+        return self._timed(super().execute, query, vars)
+
+    def executemany(self, query, vars_list):
+        return self._timed(super().executemany, query, vars_list)
+
+    def callproc(self, procname, parameters=None):
+        return self._timed(super().callproc, procname, parameters)
+
+    def copy_expert(self, sql, file, size=8192):
+        return self._timed(super().copy_expert, sql, file, size)
+
+
+_timed_classes = {}
+
+
+def _timed_class(factory):
+    cls = _timed_classes.get(factory)
+    if cls is None:
+        cls = _timed_classes[factory] = type(f'Timed{factory.__name__}', (_TimedCursor, factory), {})
+    return cls
+
+
+class InstrumentedConnection(extensions.connection):
+    """Соединение, курсоры которого (любого cursor_factory) учитываются в RequestStats."""
+
+    def cursor(self, *args, **kwargs):
+        factory = kwargs.get('cursor_factory') or self.cursor_factory or extensions.cursor
+        kwargs['cursor_factory'] = _timed_class(factory)
+        return super().cursor(*args, **kwargs)
+
+
+class InstrumentedJsonProvider(OrjsonProvider):
+    """OrjsonProvider, время jsonify которого учитывается в RequestStats."""
+
+    def response(self, *args, **kwargs):
+        stats = _current.get()
+        if stats is None:
+            return super().response(*args, **kwargs)
+        started = time.perf_counter()
+        try:
+            return super().response(*args, **kwargs)
+        finally:
+            stats.serialization_time += time.perf_counter() - started
+
+
+# ---- Гистограммы процесса и формат Prometheus ----
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs.extend(f'{name}="{_escape(value)}"' for name, value in extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    def __init__(self, name, help, buckets, label_names):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.label_names = tuple(label_names)
+        self._series = {} # значения меток -> [счетчики по корзинам..., сумма, количество]
+
+    def observe(self, labels, value):
+        # Вызывается под блокировкой владельца
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self, extra):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        for labels, series in sorted(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), series):
+                cumulative += count
+                le = bound if bound == '+Inf' else _number(bound)
+                lines.append(f'{self.name}_bucket{_labels(self.label_names, labels, extra + (("le", le),))} {cumulative}')
+            lines.append(f'{self.name}_sum{_labels(self.label_names, labels, extra)} {series[-2]!r}')
+            lines.append(f'{self.name}_count{_labels(self.label_names, labels, extra)} {series[-1]}')
+        return lines
+
+
+class Counter:
+    def __init__(self, name, help, label_names):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self._series = {}
+
+    def inc(self, labels, value=1):
+        # Вызывается под блокировкой владельца
+        self._series[labels] = self._series.get(labels, 0) + value
+
+    def render(self, extra):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        for labels, value in sorted(self._series.items()):
+            lines.append(f'{self.name}{_labels(self.label_names, labels, extra)} {value}')
+        return lines
+
+
+class RequestMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = Counter('http_requests_total', 'HTTP requests by route, method and status.',
+                                ('endpoint', 'method', 'status'))
+        self.duration = Histogram('http_request_duration_seconds', 'Time to build the response.',
+                                  LATENCY_BUCKETS, ('endpoint', 'method'))
+        self.queries = Histogram('http_request_queries', 'SQL statements executed per request.',
+                                 QUERY_COUNT_BUCKETS, ('endpoint',))
+        self.sql_time = Histogram('http_request_sql_seconds', 'Time spent executing SQL per request.',
+                                  LATENCY_BUCKETS, ('endpoint',))
+        self.serialization_time = Histogram('http_request_serialization_seconds',
+                                            'Time spent serializing JSON per request.',
+                                            LATENCY_BUCKETS, ('endpoint',))
+        self.pool_wait = Histogram('http_request_pool_wait_seconds',
+                                   'Time spent waiting for a pooled DB connection per request.',
+                                   LATENCY_BUCKETS, ('endpoint',))
+
+    def observe(self, endpoint, method, status, stats, duration):
+        with self._lock:
+            self.requests.inc((endpoint, method, str(status)))
+            self.duration.observe((endpoint, method), duration)
+            self.queries.observe((endpoint,), stats.queries)
+            self.sql_time.observe((endpoint,), stats.sql_time)
+            self.serialization_time.observe((endpoint,), stats.serialization_time)
+            self.pool_wait.observe((endpoint,), stats.pool_wait)
+
+    def render(self, gauges=()):
+        """Текст в формате Prometheus. gauges - [(имя, описание, значение), ...] на момент выборки."""
+        extra = (('worker', os.getpid()),)
+        lines = []
+        with self._lock:
+            for metric in (self.requests, self.duration, self.queries, self.sql_time,
+                           self.serialization_time, self.pool_wait):
+                lines.extend(metric.render(extra))
+        for name, help, value in gauges:
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name}{_labels((), (), extra)} {_number(value)}')
+        return '\n'.join(lines) + '\n'
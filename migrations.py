@@ -0,0 +1,34 @@
+import os
+
+
+# Применение SQL-миграций из каталога migrations/ по порядку имен файлов.
+# Примененные версии запоминаются в таблице schema_migrations.
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+
+
+def pending_migrations(cur, directory=MIGRATIONS_DIR):
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version TEXT PRIMARY KEY,
+            applied_at TIMESTAMP NOT NULL DEFAULT NOW()
+        )
+    ''')
+    cur.execute('SELECT version FROM schema_migrations')
+    applied = {row[0] for row in cur.fetchall()}
+    names = sorted(name for name in os.listdir(directory) if name.endswith('.sql'))
+    return [name for name in names if name[:-4] not in applied]
+
+
+def apply_migrations(conn, directory=MIGRATIONS_DIR, log=print):
+    """Применяет все новые миграции, каждую в своей транзакции. Возвращает их список."""
+    with conn.cursor() as cur:
+        pending = pending_migrations(cur, directory)
+        conn.commit()
+        for name in pending:
+            with open(os.path.join(directory, name), encoding='utf-8') as f:
+                cur.execute(f.read())
+            cur.execute('INSERT INTO schema_migrations (version) VALUES (%s)', (name[:-4],))
+            conn.commit()
+            log(f'Applied migration {name}')
+    return pending
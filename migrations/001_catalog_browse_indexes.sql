@@ -0,0 +1,27 @@
+-- Индексы для фильтров и keyset-пагинации каталога (/api/albums).
+-- Каждая сортировка имеет индекс по (ключ, id), поэтому глубокая страница
+-- стоит столько же, сколько первая.
+
+CREATE INDEX IF NOT EXISTS idx_albums_release_date_id
+    ON albums ((COALESCE(release_date, DATE '0001-01-01')) DESC, id DESC);
+
+CREATE INDEX IF NOT EXISTS idx_albums_base_price_id
+    ON albums (base_price, id);
+
+CREATE INDEX IF NOT EXISTS idx_albums_title_id
+    ON albums (title, id);
+
+CREATE INDEX IF NOT EXISTS idx_albums_artist_release_date
+    ON albums (artist_id, (COALESCE(release_date, DATE '0001-01-01')) DESC, id DESC);
+
+CREATE INDEX IF NOT EXISTS idx_albums_status
+    ON albums (status);
+
+CREATE INDEX IF NOT EXISTS idx_artists_category
+    ON artists (category);
+
+CREATE INDEX IF NOT EXISTS idx_album_versions_album_id
+    ON album_versions (album_id);
+
+CREATE INDEX IF NOT EXISTS idx_album_versions_in_stock
+    ON album_versions (album_id) WHERE stock_quantity > 0;
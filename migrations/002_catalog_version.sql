@@ -0,0 +1,10 @@
+-- Версия каталога для ETag / Last-Modified. Увеличивается в той же транзакции,
+-- что и любая админская запись в каталог (см. invalidate_catalog в server.py).
+
+CREATE TABLE IF NOT EXISTS catalog_version (
+    id SMALLINT PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+    version BIGINT NOT NULL DEFAULT 1,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+INSERT INTO catalog_version (id) VALUES (1) ON CONFLICT (id) DO NOTHING;
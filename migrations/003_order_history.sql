@@ -0,0 +1,40 @@
+-- История заказов: индексы под выборку страницы заказов и пакетную загрузку
+-- их товаров, плюс счетчик заказов пользователя, поддерживаемый триггером
+-- (вместо COUNT(*) по orders на каждый запрос).
+
+CREATE INDEX IF NOT EXISTS idx_orders_user_created
+    ON orders (user_id, created_at DESC, id DESC);
+
+CREATE INDEX IF NOT EXISTS idx_orders_created
+    ON orders (created_at DESC, id DESC);
+
+CREATE INDEX IF NOT EXISTS idx_order_items_order_id
+    ON order_items (order_id);
+
+CREATE TABLE IF NOT EXISTS user_order_stats (
+    user_id INTEGER PRIMARY KEY,
+    order_count BIGINT NOT NULL DEFAULT 0
+);
+
+CREATE OR REPLACE FUNCTION maintain_user_order_stats() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        UPDATE user_order_stats SET order_count = order_count - 1 WHERE user_id = OLD.user_id;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO user_order_stats (user_id, order_count) VALUES (NEW.user_id, 1)
+        ON CONFLICT (user_id) DO UPDATE SET order_count = user_order_stats.order_count + 1;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_user_order_stats ON orders;
+CREATE TRIGGER trg_user_order_stats
+    AFTER INSERT OR DELETE OR UPDATE OF user_id ON orders
+    FOR EACH ROW EXECUTE FUNCTION maintain_user_order_stats();
+
+-- Начальное заполнение по существующим заказам
+INSERT INTO user_order_stats (user_id, order_count)
+SELECT user_id, COUNT(*) FROM orders GROUP BY user_id
+ON CONFLICT (user_id) DO UPDATE SET order_count = EXCLUDED.order_count;
@@ -0,0 +1,4 @@
+-- Keyset-пагинация списка пользователей в админке по (created_at, id).
+
+CREATE INDEX IF NOT EXISTS idx_users_created
+    ON users (created_at DESC, id DESC);
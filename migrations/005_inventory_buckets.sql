@@ -0,0 +1,21 @@
+-- Остатки лимитированных версий, разложенные по корзинам-счетчикам (см. inventory.py).
+-- Резервирование при оформлении заказа списывает из корзин, а не из одной строки
+-- album_versions, поэтому параллельные покупки одной версии не ждут одну блокировку.
+
+CREATE TABLE IF NOT EXISTS inventory_buckets (
+    album_version_id INTEGER NOT NULL REFERENCES album_versions (id) ON DELETE CASCADE,
+    bucket SMALLINT NOT NULL,
+    quantity INTEGER NOT NULL CHECK (quantity >= 0),
+    PRIMARY KEY (album_version_id, bucket)
+);
+
+-- Уже существующие лимитированные версии раскладываются по 8 корзинам
+-- (как INVENTORY_STRIPES по умолчанию; потом можно довыполнить flask inventory-stripe)
+INSERT INTO inventory_buckets (album_version_id, bucket, quantity)
+SELECT av.id, s.bucket,
+       GREATEST(av.stock_quantity, 0) / 8
+       + CASE WHEN s.bucket < GREATEST(av.stock_quantity, 0) % 8 THEN 1 ELSE 0 END
+FROM album_versions av
+CROSS JOIN generate_series(0, 7) AS s(bucket)
+WHERE av.is_limited
+ON CONFLICT DO NOTHING;
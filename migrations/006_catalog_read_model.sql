@@ -0,0 +1,253 @@
+-- Денормализованная модель каталога: одна строка на альбом с данными артиста,
+-- версиями, диапазоном цен со скидкой, общим остатком и действующей скидкой.
+-- Публичные эндпоинты читают только ее. Строки пересчитываются триггерами в той же
+-- транзакции, что и запись в albums / album_versions / artists / discounts / album_discounts,
+-- и только для затронутых альбомов.
+
+CREATE TABLE IF NOT EXISTS catalog_read_model (
+    id INTEGER PRIMARY KEY, -- id альбома
+    artist_id INTEGER NOT NULL,
+    artist TEXT, -- имя артиста
+    artist_image TEXT,
+    category TEXT,
+    title TEXT,
+    base_price NUMERIC,
+    main_image_url TEXT,
+    status TEXT,
+    release_date DATE,
+    is_preorder BOOLEAN,
+    album JSONB NOT NULL, -- строка albums целиком
+    versions JSONB NOT NULL, -- строки album_versions по возрастанию id
+    min_price NUMERIC, -- цены версий с действующей скидкой, NULL без версий
+    max_price NUMERIC,
+    total_stock INTEGER NOT NULL,
+    discount JSONB, -- действующая скидка: наибольший процент, при равенстве - меньший id
+    discount_changes_at TIMESTAMPTZ, -- ближайшее начало / окончание скидки альбома
+    refreshed_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_catalog_read_model_release_date_id
+    ON catalog_read_model ((COALESCE(release_date, DATE '0001-01-01')) DESC, id DESC);
+
+CREATE INDEX IF NOT EXISTS idx_catalog_read_model_base_price_id
+    ON catalog_read_model (base_price, id);
+
+CREATE INDEX IF NOT EXISTS idx_catalog_read_model_title_id
+    ON catalog_read_model (title, id);
+
+CREATE INDEX IF NOT EXISTS idx_catalog_read_model_artist_release_date
+    ON catalog_read_model (artist_id, (COALESCE(release_date, DATE '0001-01-01')) DESC, id DESC);
+
+CREATE INDEX IF NOT EXISTS idx_catalog_read_model_category
+    ON catalog_read_model (category);
+
+CREATE INDEX IF NOT EXISTS idx_catalog_read_model_status
+    ON catalog_read_model (status);
+
+CREATE INDEX IF NOT EXISTS idx_catalog_read_model_discount_changes_at
+    ON catalog_read_model (discount_changes_at) WHERE discount_changes_at IS NOT NULL;
+
+CREATE INDEX IF NOT EXISTS idx_album_discounts_album_id
+    ON album_discounts (album_id);
+
+CREATE INDEX IF NOT EXISTS idx_album_discounts_discount_id
+    ON album_discounts (discount_id);
+
+-- Эталонное содержимое модели, вычисленное из исходных таблиц
+CREATE OR REPLACE VIEW catalog_read_model_source AS
+SELECT
+    a.id,
+    a.artist_id,
+    ar.name AS artist,
+    ar.image_url AS artist_image,
+    ar.category,
+    a.title,
+    a.base_price,
+    a.main_image_url,
+    a.status,
+    a.release_date,
+    a.is_preorder,
+    to_jsonb(a) AS album,
+    COALESCE(v.versions, '[]'::jsonb) AS versions,
+    v.min_price,
+    v.max_price,
+    COALESCE(v.total_stock, 0)::int AS total_stock,
+    CASE WHEN d.id IS NOT NULL THEN jsonb_build_object(
+        'id', d.id,
+        'name', d.name,
+        'discount_percent', d.discount_percent,
+        'start_date', d.start_date,
+        'end_date', d.end_date
+    ) END AS discount,
+    c.changes_at AS discount_changes_at
+FROM albums a
+JOIN artists ar ON ar.id = a.artist_id
+LEFT JOIN LATERAL (
+    SELECT dd.id, dd.name, dd.discount_percent, dd.start_date, dd.end_date
+    FROM album_discounts ad
+    JOIN discounts dd ON dd.id = ad.discount_id
+    WHERE ad.album_id = a.id
+      AND dd.is_active = TRUE
+      AND CURRENT_TIMESTAMP BETWEEN dd.start_date AND dd.end_date
+    ORDER BY dd.discount_percent DESC, dd.id
+    LIMIT 1
+) d ON TRUE
+LEFT JOIN LATERAL (
+    SELECT
+        jsonb_agg(to_jsonb(av) ORDER BY av.id) AS versions,
+        MIN(ROUND((a.base_price + av.price_diff) * (1 - COALESCE(d.discount_percent, 0) / 100.0), 2)) AS min_price,
+        MAX(ROUND((a.base_price + av.price_diff) * (1 - COALESCE(d.discount_percent, 0) / 100.0), 2)) AS max_price,
+        SUM(av.stock_quantity) AS total_stock
+    FROM album_versions av
+    WHERE av.album_id = a.id
+) v ON TRUE
+LEFT JOIN LATERAL (
+    -- Скидка действует и в сам момент end_date, поэтому сменится сразу после него
+    SELECT MIN(b.at) AS changes_at
+    FROM album_discounts ad
+    JOIN discounts dd ON dd.id = ad.discount_id
+    CROSS JOIN LATERAL (
+        VALUES (dd.start_date::timestamptz), (dd.end_date::timestamptz + INTERVAL '1 microsecond')
+    ) AS b(at)
+    WHERE ad.album_id = a.id
+      AND dd.is_active = TRUE
+      AND b.at > CURRENT_TIMESTAMP
+) c ON TRUE;
+
+-- Пересчет строк модели для перечисленных альбомов
+CREATE OR REPLACE FUNCTION refresh_catalog_read_model(album_ids INTEGER[]) RETURNS VOID AS $$
+    DELETE FROM catalog_read_model m
+    WHERE m.id = ANY(album_ids)
+      AND NOT EXISTS (SELECT 1 FROM catalog_read_model_source s WHERE s.id = m.id);
+
+    INSERT INTO catalog_read_model (
+        id, artist_id, artist, artist_image, category, title, base_price, main_image_url,
+        status, release_date, is_preorder, album, versions, min_price, max_price,
+        total_stock, discount, discount_changes_at, refreshed_at
+    )
+    SELECT
+        id, artist_id, artist, artist_image, category, title, base_price, main_image_url,
+        status, release_date, is_preorder, album, versions, min_price, max_price,
+        total_stock, discount, discount_changes_at, NOW()
+    FROM catalog_read_model_source
+    WHERE id = ANY(album_ids)
+    ON CONFLICT (id) DO UPDATE SET
+        artist_id = EXCLUDED.artist_id,
+        artist = EXCLUDED.artist,
+        artist_image = EXCLUDED.artist_image,
+        category = EXCLUDED.category,
+        title = EXCLUDED.title,
+        base_price = EXCLUDED.base_price,
+        main_image_url = EXCLUDED.main_image_url,
+        status = EXCLUDED.status,
+        release_date = EXCLUDED.release_date,
+        is_preorder = EXCLUDED.is_preorder,
+        album = EXCLUDED.album,
+        versions = EXCLUDED.versions,
+        min_price = EXCLUDED.min_price,
+        max_price = EXCLUDED.max_price,
+        total_stock = EXCLUDED.total_stock,
+        discount = EXCLUDED.discount,
+        discount_changes_at = EXCLUDED.discount_changes_at,
+        refreshed_at = EXCLUDED.refreshed_at;
+$$ LANGUAGE sql;
+
+-- Пересчет альбомов, у которых наступила граница скидки. Возвращает их id.
+CREATE OR REPLACE FUNCTION refresh_due_catalog_read_model() RETURNS SETOF INTEGER AS $$
+DECLARE
+    due INTEGER[];
+BEGIN
+    SELECT ARRAY(
+        SELECT id FROM catalog_read_model
+        WHERE discount_changes_at <= NOW()
+        FOR UPDATE SKIP LOCKED
+    ) INTO due;
+    PERFORM refresh_catalog_read_model(due);
+    RETURN QUERY SELECT unnest(due);
+END;
+$$ LANGUAGE plpgsql;
+
+-- Триггер на уровне оператора: TG_ARGV[0] - запрос id затронутых альбомов,
+-- %s в нем заменяется на таблицу переходов (new_rows / old_rows)
+CREATE OR REPLACE FUNCTION sync_catalog_read_model() RETURNS TRIGGER AS $$
+DECLARE
+    album_ids INTEGER[] := '{}';
+    part INTEGER[];
+BEGIN
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        EXECUTE format('SELECT ARRAY(' || TG_ARGV[0] || ')', 'new_rows') INTO part;
+        album_ids := album_ids || part;
+    END IF;
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        EXECUTE format('SELECT ARRAY(' || TG_ARGV[0] || ')', 'old_rows') INTO part;
+        album_ids := album_ids || part;
+    END IF;
+    IF cardinality(album_ids) > 0 THEN
+        PERFORM refresh_catalog_read_model(ARRAY(SELECT DISTINCT unnest(album_ids)));
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Таблицы переходов допускаются только в триггерах на одно событие - по три триггера на таблицу
+DROP TRIGGER IF EXISTS trg_catalog_read_model_albums_ins ON albums;
+CREATE TRIGGER trg_catalog_read_model_albums_ins
+    AFTER INSERT ON albums REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION sync_catalog_read_model('SELECT id FROM %s');
+DROP TRIGGER IF EXISTS trg_catalog_read_model_albums_upd ON albums;
+CREATE TRIGGER trg_catalog_read_model_albums_upd
+    AFTER UPDATE ON albums REFERENCING NEW TABLE AS new_rows OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION sync_catalog_read_model('SELECT id FROM %s');
+DROP TRIGGER IF EXISTS trg_catalog_read_model_albums_del ON albums;
+CREATE TRIGGER trg_catalog_read_model_albums_del
+    AFTER DELETE ON albums REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION sync_catalog_read_model('SELECT id FROM %s');
+
+DROP TRIGGER IF EXISTS trg_catalog_read_model_versions_ins ON album_versions;
+CREATE TRIGGER trg_catalog_read_model_versions_ins
+    AFTER INSERT ON album_versions REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION sync_catalog_read_model('SELECT album_id FROM %s');
+DROP TRIGGER IF EXISTS trg_catalog_read_model_versions_upd ON album_versions;
+CREATE TRIGGER trg_catalog_read_model_versions_upd
+    AFTER UPDATE ON album_versions REFERENCING NEW TABLE AS new_rows OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION sync_catalog_read_model('SELECT album_id FROM %s');
+DROP TRIGGER IF EXISTS trg_catalog_read_model_versions_del ON album_versions;
+CREATE TRIGGER trg_catalog_read_model_versions_del
+    AFTER DELETE ON album_versions REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION sync_catalog_read_model('SELECT album_id FROM %s');
+
+DROP TRIGGER IF EXISTS trg_catalog_read_model_artists_upd ON artists;
+CREATE TRIGGER trg_catalog_read_model_artists_upd
+    AFTER UPDATE ON artists REFERENCING NEW TABLE AS new_rows OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION sync_catalog_read_model(
+        'SELECT a.id FROM albums a WHERE a.artist_id IN (SELECT id FROM %s)'
+    );
+
+DROP TRIGGER IF EXISTS trg_catalog_read_model_album_discounts_ins ON album_discounts;
+CREATE TRIGGER trg_catalog_read_model_album_discounts_ins
+    AFTER INSERT ON album_discounts REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION sync_catalog_read_model('SELECT album_id FROM %s');
+DROP TRIGGER IF EXISTS trg_catalog_read_model_album_discounts_upd ON album_discounts;
+CREATE TRIGGER trg_catalog_read_model_album_discounts_upd
+    AFTER UPDATE ON album_discounts REFERENCING NEW TABLE AS new_rows OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION sync_catalog_read_model('SELECT album_id FROM %s');
+DROP TRIGGER IF EXISTS trg_catalog_read_model_album_discounts_del ON album_discounts;
+CREATE TRIGGER trg_catalog_read_model_album_discounts_del
+    AFTER DELETE ON album_discounts REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION sync_catalog_read_model('SELECT album_id FROM %s');
+
+DROP TRIGGER IF EXISTS trg_catalog_read_model_discounts_upd ON discounts;
+CREATE TRIGGER trg_catalog_read_model_discounts_upd
+    AFTER UPDATE ON discounts REFERENCING NEW TABLE AS new_rows OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION sync_catalog_read_model(
+        'SELECT ad.album_id FROM album_discounts ad WHERE ad.discount_id IN (SELECT id FROM %s)'
+    );
+DROP TRIGGER IF EXISTS trg_catalog_read_model_discounts_del ON discounts;
+CREATE TRIGGER trg_catalog_read_model_discounts_del
+    AFTER DELETE ON discounts REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION sync_catalog_read_model(
+        'SELECT ad.album_id FROM album_discounts ad WHERE ad.discount_id IN (SELECT id FROM %s)'
+    );
+
+-- Начальное заполнение
+SELECT refresh_catalog_read_model(ARRAY(SELECT id FROM albums));
@@ -0,0 +1,12 @@
+-- Естественные ключи каталога для массового импорта (upsert по имени артиста,
+-- названию альбома у артиста и названию версии у альбома).
+-- Если в данных уже есть дубликаты, их нужно объединить до применения миграции.
+
+CREATE UNIQUE INDEX IF NOT EXISTS uq_artists_name
+    ON artists (name);
+
+CREATE UNIQUE INDEX IF NOT EXISTS uq_albums_artist_title
+    ON albums (artist_id, title);
+
+CREATE UNIQUE INDEX IF NOT EXISTS uq_album_versions_album_version_name
+    ON album_versions (album_id, version_name);
@@ -0,0 +1,177 @@
+-- Аналитика продаж: дневные агрегаты штук, выручки и суммы скидок по версии альбома,
+-- альбому, артисту и категории артиста. Агрегаты обновляются триггерами на order_items
+-- и orders приращениями, отчеты читают только sales_daily.
+--
+-- В продажи входят заказы в любом статусе, кроме cancelled; день - дата created_at заказа.
+-- Сумма скидки - (цена по прайсу - уплаченная цена) * количество. Цена по прайсу
+-- запоминается в order_items.list_price в момент покупки.
+
+ALTER TABLE order_items ADD COLUMN IF NOT EXISTS list_price NUMERIC(10, 2);
+
+CREATE OR REPLACE FUNCTION fill_order_item_list_price() RETURNS TRIGGER AS $$
+BEGIN
+    IF NEW.list_price IS NULL THEN
+        SELECT a.base_price + av.price_diff INTO NEW.list_price
+        FROM album_versions av
+        JOIN albums a ON a.id = av.album_id
+        WHERE av.id = NEW.album_version_id;
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_order_items_list_price ON order_items;
+CREATE TRIGGER trg_order_items_list_price
+    BEFORE INSERT ON order_items
+    FOR EACH ROW EXECUTE FUNCTION fill_order_item_list_price();
+
+-- Для старых заказов цена на момент покупки неизвестна - берется текущая
+UPDATE order_items oi
+SET list_price = a.base_price + av.price_diff
+FROM album_versions av
+JOIN albums a ON a.id = av.album_id
+WHERE av.id = oi.album_version_id AND oi.list_price IS NULL;
+
+-- dimension: version | album | artist | category; key - id (или категория) в виде текста
+CREATE TABLE IF NOT EXISTS sales_daily (
+    dimension TEXT NOT NULL,
+    key TEXT NOT NULL,
+    day DATE NOT NULL,
+    units BIGINT NOT NULL DEFAULT 0,
+    revenue NUMERIC(14, 2) NOT NULL DEFAULT 0,
+    discount_amount NUMERIC(14, 2) NOT NULL DEFAULT 0,
+    PRIMARY KEY (dimension, key, day)
+);
+
+-- Топ-N за период: все ключи измерения по диапазону дней
+CREATE INDEX IF NOT EXISTS idx_sales_daily_dimension_day
+    ON sales_daily (dimension, day);
+
+-- Позиции продаж (day, album_version_id, quantity, price_per_unit, list_price) ->
+-- строки sales_daily по всем измерениям. %s - запрос позиций.
+-- Строки сортируются, чтобы параллельные заказы блокировали их в одном порядке.
+CREATE OR REPLACE FUNCTION sales_rollup_sql(source TEXT) RETURNS TEXT AS $$
+    SELECT format($sql$
+        SELECT d.dimension, d.key, s.day,
+               SUM(s.quantity) AS units,
+               SUM(s.price_per_unit * s.quantity) AS revenue,
+               SUM(GREATEST(COALESCE(s.list_price, s.price_per_unit) - s.price_per_unit, 0) * s.quantity)
+                   AS discount_amount
+        FROM (%s) s
+        LEFT JOIN album_versions av ON av.id = s.album_version_id
+        LEFT JOIN albums a ON a.id = av.album_id
+        LEFT JOIN artists ar ON ar.id = a.artist_id
+        CROSS JOIN LATERAL (VALUES
+            ('version', s.album_version_id::text),
+            ('album', a.id::text),
+            ('artist', ar.id::text),
+            ('category', ar.category)
+        ) AS d(dimension, key)
+        WHERE d.key IS NOT NULL
+        GROUP BY d.dimension, d.key, s.day
+        ORDER BY d.dimension, d.key, s.day
+    $sql$, source)
+$$ LANGUAGE sql IMMUTABLE;
+
+-- Триггер уровня оператора; TG_ARGV[0] - запрос позиций с %1$s вместо таблицы переходов.
+-- Новые строки прибавляются, старые вычитаются.
+CREATE OR REPLACE FUNCTION sync_sales_rollup() RETURNS TRIGGER AS $$
+DECLARE
+    tables TEXT[] := '{}';
+    signs INTEGER[] := '{}';
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        tables := tables || 'old_rows'::text;
+        signs := signs || -1;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        tables := tables || 'new_rows'::text;
+        signs := signs || 1;
+    END IF;
+    FOR i IN 1 .. cardinality(tables) LOOP
+        EXECUTE format($sql$
+            INSERT INTO sales_daily AS t (dimension, key, day, units, revenue, discount_amount)
+            SELECT dimension, key, day, $1 * units, $1 * revenue, $1 * discount_amount
+            FROM (%s) r
+            ON CONFLICT (dimension, key, day) DO UPDATE SET
+                units = t.units + EXCLUDED.units,
+                revenue = t.revenue + EXCLUDED.revenue,
+                discount_amount = t.discount_amount + EXCLUDED.discount_amount
+        $sql$, sales_rollup_sql(format(TG_ARGV[0], tables[i])))
+        USING signs[i];
+    END LOOP;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Позиции заказа. Заказ удаляется после своих позиций (как в delete_order),
+-- поэтому при удалении позиций заказ еще виден.
+DROP TRIGGER IF EXISTS trg_sales_rollup_items_ins ON order_items;
+CREATE TRIGGER trg_sales_rollup_items_ins
+    AFTER INSERT ON order_items REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION sync_sales_rollup($q$
+        SELECT o.created_at::date AS day, i.album_version_id, i.quantity, i.price_per_unit, i.list_price
+        FROM %1$s i JOIN orders o ON o.id = i.order_id
+        WHERE o.status <> 'cancelled'
+    $q$);
+DROP TRIGGER IF EXISTS trg_sales_rollup_items_upd ON order_items;
+CREATE TRIGGER trg_sales_rollup_items_upd
+    AFTER UPDATE ON order_items REFERENCING NEW TABLE AS new_rows OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION sync_sales_rollup($q$
+        SELECT o.created_at::date AS day, i.album_version_id, i.quantity, i.price_per_unit, i.list_price
+        FROM %1$s i JOIN orders o ON o.id = i.order_id
+        WHERE o.status <> 'cancelled'
+    $q$);
+DROP TRIGGER IF EXISTS trg_sales_rollup_items_del ON order_items;
+CREATE TRIGGER trg_sales_rollup_items_del
+    AFTER DELETE ON order_items REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION sync_sales_rollup($q$
+        SELECT o.created_at::date AS day, i.album_version_id, i.quantity, i.price_per_unit, i.list_price
+        FROM %1$s i JOIN orders o ON o.id = i.order_id
+        WHERE o.status <> 'cancelled'
+    $q$);
+
+-- Смена статуса (отмена или ее снятие) или даты заказа: его позиции переносятся целиком.
+-- Заказы, у которых ни то ни другое не изменилось (paid -> shipped), не затрагиваются.
+DROP TRIGGER IF EXISTS trg_sales_rollup_orders_upd ON orders;
+CREATE TRIGGER trg_sales_rollup_orders_upd
+    AFTER UPDATE ON orders REFERENCING NEW TABLE AS new_rows OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION sync_sales_rollup($q$
+        SELECT o.created_at::date AS day, i.album_version_id, i.quantity, i.price_per_unit, i.list_price
+        FROM %1$s o JOIN order_items i ON i.order_id = o.id
+        WHERE o.status <> 'cancelled'
+          AND o.id IN (
+              SELECT n.id FROM new_rows n JOIN old_rows p ON p.id = n.id
+              WHERE (n.status = 'cancelled') <> (p.status = 'cancelled')
+                 OR n.created_at::date <> p.created_at::date
+          )
+    $q$);
+
+-- Пересчет агрегатов за период из истории заказов (NULL - без ограничения).
+-- Блокировка таблицы дожидается транзакций, уже внесших приращения, а новые приращения
+-- ждут конца пересчета и ложатся поверх него - ничего не теряется и не учитывается дважды.
+CREATE OR REPLACE FUNCTION rebuild_sales_rollup(date_from DATE, date_to DATE) RETURNS BIGINT AS $$
+DECLARE
+    row_count BIGINT;
+BEGIN
+    LOCK TABLE sales_daily IN EXCLUSIVE MODE;
+    DELETE FROM sales_daily
+    WHERE (date_from IS NULL OR day >= date_from) AND (date_to IS NULL OR day <= date_to);
+    EXECUTE format($sql$
+        INSERT INTO sales_daily (dimension, key, day, units, revenue, discount_amount)
+        %s
+    $sql$, sales_rollup_sql($q$
+        SELECT o.created_at::date AS day, i.album_version_id, i.quantity, i.price_per_unit, i.list_price
+        FROM orders o JOIN order_items i ON i.order_id = o.id
+        WHERE o.status <> 'cancelled'
+          AND ($1 IS NULL OR o.created_at >= $1)
+          AND ($2 IS NULL OR o.created_at < $2 + 1)
+    $q$))
+    USING date_from, date_to;
+    GET DIAGNOSTICS row_count = ROW_COUNT;
+    RETURN row_count;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Начальное заполнение по всей истории
+SELECT rebuild_sales_rollup(NULL, NULL);
@@ -0,0 +1,121 @@
+-- Приращения продаж без общих блокировок.
+--
+-- Раньше триггеры на order_items и orders сразу прибавляли приращения к строкам sales_daily
+-- в транзакции заказа: в день релиза все оформления ждали блокировки одних и тех же строк
+-- (сегодня x категория / артист / альбом / версия), а пересчет блокировал всю таблицу.
+-- Теперь триггеры только дописывают строки в sales_delta - вставки не конфликтуют друг
+-- с другом. Фоновый процесс (analytics.SalesDeltaFold) переносит их в sales_daily
+-- пачками, по одному процессу за раз (advisory lock 371173). Отчеты читают sales_daily_live -
+-- sales_daily вместе с еще не перенесенными приращениями, поэтому видят продажи сразу.
+--
+-- Таблица обычная, не UNLOGGED: после аварийного перезапуска приращения не теряются.
+
+CREATE TABLE IF NOT EXISTS sales_delta (
+    id BIGSERIAL PRIMARY KEY,
+    dimension TEXT NOT NULL,
+    key TEXT NOT NULL,
+    day DATE NOT NULL,
+    units BIGINT NOT NULL,
+    revenue NUMERIC(14, 2) NOT NULL,
+    discount_amount NUMERIC(14, 2) NOT NULL
+) WITH (autovacuum_vacuum_scale_factor = 0.01); -- Строки живут секунды, таблица постоянно чистится
+
+CREATE OR REPLACE VIEW sales_daily_live AS
+    SELECT dimension, key, day, units, revenue, discount_amount FROM sales_daily
+    UNION ALL
+    SELECT dimension, key, day, units, revenue, discount_amount FROM sales_delta;
+
+-- Триггеры те же (migrations/008_sales_rollups.sql), меняется только функция: вставка в sales_delta
+CREATE OR REPLACE FUNCTION sync_sales_rollup() RETURNS TRIGGER AS $$
+DECLARE
+    tables TEXT[] := '{}';
+    signs INTEGER[] := '{}';
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        tables := tables || 'old_rows'::text;
+        signs := signs || -1;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        tables := tables || 'new_rows'::text;
+        signs := signs || 1;
+    END IF;
+    FOR i IN 1 .. cardinality(tables) LOOP
+        EXECUTE format($sql$
+            INSERT INTO sales_delta (dimension, key, day, units, revenue, discount_amount)
+            SELECT dimension, key, day, $1 * units, $1 * revenue, $1 * discount_amount
+            FROM (%s) r
+        $sql$, sales_rollup_sql(format(TG_ARGV[0], tables[i])))
+        USING signs[i];
+    END LOOP;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Перенос до batch_size самых старых приращений в sales_daily. Возвращает число
+-- перенесенных строк или NULL, если перенос уже идет в другом процессе. Строки sales_daily
+-- обновляются в порядке ключа, а писать в них, кроме переноса и пересчета, больше некому.
+CREATE OR REPLACE FUNCTION fold_sales_delta(batch_size INTEGER) RETURNS BIGINT AS $$
+DECLARE
+    moved_count BIGINT;
+BEGIN
+    IF NOT pg_try_advisory_xact_lock(371173) THEN
+        RETURN NULL;
+    END IF;
+    WITH moved AS (
+        DELETE FROM sales_delta
+        WHERE id IN (SELECT id FROM sales_delta ORDER BY id LIMIT batch_size)
+        RETURNING dimension, key, day, units, revenue, discount_amount
+    ),
+    folded AS (
+        INSERT INTO sales_daily AS t (dimension, key, day, units, revenue, discount_amount)
+        SELECT dimension, key, day, SUM(units), SUM(revenue), SUM(discount_amount)
+        FROM moved
+        GROUP BY dimension, key, day
+        ORDER BY dimension, key, day
+        ON CONFLICT (dimension, key, day) DO UPDATE SET
+            units = t.units + EXCLUDED.units,
+            revenue = t.revenue + EXCLUDED.revenue,
+            discount_amount = t.discount_amount + EXCLUDED.discount_amount
+    )
+    SELECT COUNT(*) INTO moved_count FROM moved;
+    RETURN moved_count;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Пересчет агрегатов за период из истории заказов (NULL - без ограничения) без блокировки
+-- таблицы. Перенос приращений на это время останавливается (тот же advisory lock).
+-- Новые агрегаты считаются в промежуточную таблицу тем же запросом, что удаляет приращения
+-- периода: в одном снимке данных заказы, уже учтенные пересчетом, и их приращения совпадают,
+-- а приращения заказов, оформленных позже, остаются в sales_delta. Затем строки периода
+-- в sales_daily заменяются содержимым промежуточной таблицы. Оформление заказов не ждет:
+-- оно пишет только в sales_delta.
+CREATE OR REPLACE FUNCTION rebuild_sales_rollup(date_from DATE, date_to DATE) RETURNS BIGINT AS $$
+DECLARE
+    row_count BIGINT;
+BEGIN
+    PERFORM pg_advisory_xact_lock(371173);
+    CREATE TEMP TABLE sales_rebuild (LIKE sales_daily) ON COMMIT DROP;
+    EXECUTE format($sql$
+        WITH dropped AS (
+            DELETE FROM sales_delta
+            WHERE ($1 IS NULL OR day >= $1) AND ($2 IS NULL OR day <= $2)
+        )
+        INSERT INTO sales_rebuild (dimension, key, day, units, revenue, discount_amount)
+        %s
+    $sql$, sales_rollup_sql($q$
+        SELECT o.created_at::date AS day, i.album_version_id, i.quantity, i.price_per_unit, i.list_price
+        FROM orders o JOIN order_items i ON i.order_id = o.id
+        WHERE o.status <> 'cancelled'
+          AND ($1 IS NULL OR o.created_at >= $1)
+          AND ($2 IS NULL OR o.created_at < $2 + 1)
+    $q$))
+    USING date_from, date_to;
+    GET DIAGNOSTICS row_count = ROW_COUNT;
+    DELETE FROM sales_daily
+    WHERE (date_from IS NULL OR day >= date_from) AND (date_to IS NULL OR day <= date_to);
+    INSERT INTO sales_daily (dimension, key, day, units, revenue, discount_amount)
+    SELECT dimension, key, day, units, revenue, discount_amount FROM sales_rebuild;
+    DROP TABLE pg_temp.sales_rebuild; -- Повторный пересчет в той же транзакции создаст ее заново
+    RETURN row_count;
+END;
+$$ LANGUAGE plpgsql;
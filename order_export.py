@@ -0,0 +1,155 @@
+import csv
+import io
+import json
+from datetime import date, datetime, time, timedelta
+from decimal import Decimal
+
+
+# Потоковая выгрузка заказов с товарами для бухгалтерии (CSV или NDJSON).
+#
+# Строки читаются серверным (именованным) курсором порциями по itersize и сразу
+# превращаются в куски ответа, поэтому память процесса не зависит от размера выгрузки.
+# Заказы идут по (created_at, id), товары заказа - подряд, так что NDJSON-объект заказа
+# собирается из соседних строк без накопления.
+#
+# CSV - одна строка на позицию заказа (заказ без товаров - одна строка с пустыми полями
+# позиции). NDJSON - один заказ на строку с массивом items.
+
+FORMATS = ('csv', 'ndjson')
+MIMETYPES = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+
+ORDER_FIELDS = ('order_id', 'created_at', 'status', 'user_id', 'user_email', 'user_full_name',
+                'total_amount')
+ITEM_FIELDS = ('item_id', 'album_version_id', 'artist_name', 'album_title', 'version_name',
+               'quantity', 'price_per_unit', 'line_total')
+CSV_FIELDS = ORDER_FIELDS + ITEM_FIELDS
+
+_EXPORT_SQL = '''
+    SELECT o.id, o.created_at, o.status, o.user_id, u.email,
+           CONCAT(u.first_name, ' ', u.last_name), o.total_amount,
+           oi.id, oi.album_version_id, ar.name, a.title, oi.version_name,
+           oi.quantity, oi.price_per_unit, oi.price_per_unit * oi.quantity
+    FROM orders o
+    JOIN users u ON u.id = o.user_id
+    LEFT JOIN order_items oi ON oi.order_id = o.id
+    LEFT JOIN album_versions av ON av.id = oi.album_version_id
+    LEFT JOIN albums a ON a.id = av.album_id
+    LEFT JOIN artists ar ON ar.id = a.artist_id
+    {where}
+    ORDER BY o.created_at, o.id, oi.id
+'''
+
+
+def _parse_moment(value, name, end=False):
+    # Дата (YYYY-MM-DD) - весь день: date_to включает его целиком
+    try:
+        if len(value) == 10:
+            day = date.fromisoformat(value)
+            return datetime.combine(day + timedelta(days=1) if end else day, time.min), end
+        return datetime.fromisoformat(value), False
+    except ValueError:
+        raise ValueError(f'Invalid {name}')
+
+
+def export_filters(date_from=None, date_to=None, statuses=None, valid_statuses=None):
+    """WHERE-условия и параметры выгрузки. Даты - ISO (дата или дата со временем),
+    date_to включительно; statuses - список статусов. Ошибки - ValueError."""
+    clauses, params = [], []
+    if date_from:
+        moment, _ = _parse_moment(date_from, 'date_from')
+        clauses.append('o.created_at >= %s')
+        params.append(moment)
+    if date_to:
+        moment, exclusive = _parse_moment(date_to, 'date_to', end=True)
+        clauses.append('o.created_at < %s' if exclusive else 'o.created_at <= %s')
+        params.append(moment)
+    if statuses:
+        if valid_statuses is not None:
+            invalid = [status for status in statuses if status not in valid_statuses]
+            if invalid:
+                raise ValueError(f"Invalid status: {', '.join(invalid)}")
+        clauses.append('o.status = ANY(%s)')
+        params.append(list(statuses))
+    return clauses, params
+
+
+def _json_default(value):
+    if isinstance(value, Decimal):
+        return str(value)
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def _csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    return value
+
+
+def _iter_rows(conn, clauses, params, itersize):
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ''
+    # Именованный курсор живет в транзакции соединения; по выходу она откатывается
+    cur = conn.cursor(name='order_export')
+    cur.itersize = itersize
+    try:
+        cur.execute(_EXPORT_SQL.format(where=where), params)
+        yield from cur
+    finally:
+        cur.close()
+        conn.rollback()
+
+
+def _csv_chunks(rows, chunk_size):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(CSV_FIELDS)
+    # Заголовок уходит сразу - клиент получает первый байт до первой порции строк
+    yield buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate()
+    for row in rows:
+        writer.writerow([_csv_value(value) for value in row])
+        if buffer.tell() >= chunk_size:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def _ndjson_chunks(rows, chunk_size):
+    parts, size = [], 0
+    order = None
+    for row in rows:
+        if order is None or order['order_id'] != row[0]:
+            if order is not None:
+                line = json.dumps(order, default=_json_default, ensure_ascii=False) + '\n'
+                parts.append(line)
+                size += len(line)
+                if size >= chunk_size:
+                    yield ''.join(parts)
+                    parts, size = [], 0
+            order = dict(zip(ORDER_FIELDS, row[:len(ORDER_FIELDS)]))
+            order['items'] = []
+        if row[len(ORDER_FIELDS)] is not None:
+            order['items'].append(dict(zip(ITEM_FIELDS, row[len(ORDER_FIELDS):])))
+    if order is not None:
+        parts.append(json.dumps(order, default=_json_default, ensure_ascii=False) + '\n')
+    if parts:
+        yield ''.join(parts)
+
+
+def export_orders(conn, fmt, clauses=(), params=(), itersize=2000, chunk_size=64 * 1024):
+    """Генератор кусков выгрузки (str). Соединение занято, пока генератор не исчерпан
+    или не закрыт; закрывать само соединение - забота вызывающего."""
+    if fmt not in FORMATS:
+        raise ValueError(f'Unsupported format: {fmt}')
+    rows = _iter_rows(conn, list(clauses), list(params), itersize)
+    chunks = _csv_chunks if fmt == 'csv' else _ndjson_chunks
+    try:
+        yield from chunks(rows, chunk_size)
+    finally:
+        rows.close()
@@ -0,0 +1,111 @@
+import base64
+import json
+
+
+# Непрозрачные курсоры для keyset-пагинации: значения ключа сортировки последней
+# строки страницы упаковываются в base64(JSON).
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(*values):
+    raw = json.dumps(values, default=str, separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(token):
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (ValueError, TypeError) as e:
+        raise InvalidCursor('Invalid cursor') from e
+    if not isinstance(values, list):
+        raise InvalidCursor('Invalid cursor')
+    return values
+
+
+def keyset_query(select_sql, where, params, key_columns, limit, cursor=None, offset=None,
+                 parse_key=None):
+    """Запрос страницы для keyset_page: (sql, params, direction).
+    parse_key - приведение значений ключа из курсора (по умолчанию - как есть)."""
+    where = list(where)
+    params = list(params)
+    direction = 'next'
+    key_sql = f"({', '.join(key_columns)})"
+
+    if cursor:
+        values = decode_cursor(cursor)
+        if len(values) != len(key_columns) + 1 or values[0] not in ('next', 'prev'):
+            raise InvalidCursor('Invalid cursor')
+        direction = values[0]
+        key_values = values[1:]
+        if parse_key is not None:
+            try:
+                key_values = parse_key(key_values)
+            except (TypeError, ValueError) as e:
+                raise InvalidCursor('Invalid cursor') from e
+        placeholders = ', '.join(['%s'] * len(key_columns))
+        where.append(f"{key_sql} {'<' if direction == 'next' else '>'} ({placeholders})")
+        params.extend(key_values)
+
+    order = 'DESC' if direction == 'next' else 'ASC'
+    sql = select_sql
+    if where:
+        sql += f" WHERE {' AND '.join(where)}"
+    sql += f" ORDER BY {', '.join(f'{column} {order}' for column in key_columns)} LIMIT %s"
+    params.append(limit + 1)
+    if offset and not cursor:
+        sql += ' OFFSET %s'
+        params.append(offset)
+    return sql, params, direction
+
+
+def keyset_result(rows, direction, key_fields, limit, cursor=None, offset=None):
+    """Строки запроса keyset_query -> (rows, next_cursor, prev_cursor)."""
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if direction == 'prev':
+        rows.reverse() # Страница всегда отдается в порядке убывания ключа
+
+    def cursor_for(kind, row):
+        return encode_cursor(kind, *(row[field] for field in key_fields))
+
+    if direction == 'next':
+        has_next, has_prev = has_more, bool(cursor or offset)
+    else:
+        has_next, has_prev = True, has_more # Назад пришли со страницы, которая идет следом
+
+    next_cursor = cursor_for('next', rows[-1]) if rows and has_next else None
+    prev_cursor = cursor_for('prev', rows[0]) if rows and has_prev else None
+    return rows, next_cursor, prev_cursor
+
+
+def keyset_page(cur, select_sql, where, params, key_columns, key_fields, limit,
+                cursor=None, offset=None):
+    """Страница строк по убыванию составного ключа (например, created_at, id).
+
+    select_sql - SELECT ... FROM ... без WHERE/ORDER BY; where - список условий;
+    key_columns - выражения ключа в SQL, key_fields - те же поля в строках результата.
+    cursor - курсор из next_cursor / prev_cursor предыдущего ответа. offset - старый
+    постраничный режим, курсоры для него тоже возвращаются.
+    Возвращает (rows, next_cursor, prev_cursor).
+    """
+    sql, params, direction = keyset_query(select_sql, where, params, key_columns, limit, cursor, offset)
+    cur.execute(sql, params)
+    return keyset_result(cur.fetchall(), direction, key_fields, limit, cursor, offset)
+
+
+def estimated_count(cur, table, exact_threshold):
+    """Точный COUNT(*) для небольших таблиц, оценка планировщика (pg_class.reltuples) - для больших.
+    Возвращает (count, is_estimate)."""
+    cur.execute('SELECT reltuples::bigint AS estimate FROM pg_class WHERE oid = %s::regclass', (table,))
+    row = cur.fetchone()
+    estimate = row['estimate'] if isinstance(row, dict) else row[0]
+    if estimate is not None and estimate >= exact_threshold:
+        return estimate, True
+    # reltuples = -1, пока таблицу ни разу не анализировали
+    cur.execute(f'SELECT COUNT(*) AS count FROM {table}')
+    row = cur.fetchone()
+    return (row['count'] if isinstance(row, dict) else row[0]), False
@@ -0,0 +1,177 @@
+import multiprocessing
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+from admission import AdmissionController, AdmissionRejected
+
+
+# Хеширование и проверка паролей в пуле процессов.
+#
+# Хеш пароля намеренно дорогой по CPU; в потоке запроса всплеск входов занимает процессор
+# воркера и тормозит все остальные маршруты. Здесь эта работа уходит в ограниченный пул
+# процессов, а число одновременных операций на воркер ограничено очередью FIFO
+# (AdmissionController): лишние запросы ждут или получают 429, а не копятся.
+# Не дождавшийся результата от пула запрос тоже получает AdmissionRejected (reason 'timeout').
+# Уже запущенную в процессе задачу отменить нельзя, поэтому ее место в AdmissionController
+# освобождается, только когда задача действительно закончится: допуск отражает занятость пула,
+# а не время жизни запроса, и брошенные задачи не копятся поверх лимита.
+#
+# Параметры хеша задаются строкой метода werkzeug (например, 'scrypt:32768:8:1' или
+# 'pbkdf2:sha256:600000'). Если сохраненный хеш сделан с другими параметрами, при успешном
+# входе verify() возвращает новый хеш - вызывающий сохраняет его вместо старого.
+
+def _method_of(password_hash):
+    return password_hash.split('$', 1)[0]
+
+
+# Функции ниже выполняются в дочерних процессах и должны импортироваться по имени
+
+def _hash(password, method, salt_length):
+    started = time.monotonic()
+    return generate_password_hash(password, method=method, salt_length=salt_length), started
+
+
+def _verify(password_hash, password, method, salt_length, canonical_method):
+    started = time.monotonic()
+    if not check_password_hash(password_hash, password):
+        return False, None, started
+    if _method_of(password_hash) == canonical_method:
+        return True, None, started
+    return True, generate_password_hash(password, method=method, salt_length=salt_length), started
+
+
+class PasswordHasher:
+    def __init__(self, method, salt_length=16, workers=2, max_concurrent=4, max_queue=100,
+                 max_wait=5.0, timeout=30.0):
+        self.method = method
+        self.salt_length = salt_length
+        self.workers = workers # 0 - хешировать в потоке запроса (только для разработки и сравнения)
+        self.timeout = timeout # Ожидание результата от пула, сек
+        self.pid = os.getpid()
+        self.admission = AdmissionController('passwords', max_concurrent, max_queue, max_wait)
+        self._lock = threading.Lock()
+        self._executor = None
+        # Полная строка метода, как она записывается в хеш ('scrypt' -> 'scrypt:32768:8:1')
+        self.canonical_method = _method_of(generate_password_hash('', method=method, salt_length=1))
+
+        self._queue_times = deque(maxlen=1024) # Ожидание в пуле, сек
+        self._run_times = deque(maxlen=1024) # Само хеширование, сек
+        self.hashed = 0
+        self.verified = 0
+        self.rehashed = 0
+        self.pool_restarts = 0
+        self.abandoned = 0 # Задачи, результата которых не дождались
+        self._abandoned_running = 0 # Из них еще выполняются в пуле
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                # Новый процесс вместо fork: воркер многопоточный, а fork копирует только текущий поток
+                methods = multiprocessing.get_all_start_methods()
+                context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+            return self._executor
+
+    def _abandon(self, future, admission):
+        # Место освобождается вместе с процессом пула: сразу, если задача еще не начиналась,
+        # иначе - когда она закончится
+        with self._lock:
+            self.abandoned += 1
+            if future.cancel():
+                admission.release()
+                return
+            self._abandoned_running += 1
+
+        def finished(_):
+            with self._lock:
+                self._abandoned_running -= 1
+            admission.release()
+
+        future.add_done_callback(finished)
+
+    def _run(self, fn, *args):
+        requested = time.monotonic()
+        admission = self.admission.enter()
+        try:
+            if not self.workers:
+                result = fn(*args)
+            else:
+                try:
+                    future = self._get_executor().submit(fn, *args)
+                    result = future.result(self.timeout)
+                except FutureTimeout:
+                    position, eta = self.admission.estimate()
+                    self._abandon(future, admission)
+                    admission = None
+                    raise AdmissionRejected(self.admission.name, 'timeout', position, eta) from None
+                except BrokenProcessPool:
+                    # Дочерний процесс умер (например, OOM) - пул пересоздается при следующем вызове
+                    with self._lock:
+                        self._executor = None
+                        self.pool_restarts += 1
+                    raise
+            finished = time.monotonic()
+        finally:
+            if admission is not None:
+                admission.release()
+        started = result[-1]
+        # Очередь - и ожидание допуска, и ожидание свободного процесса
+        self._queue_times.append(max(0.0, started - requested))
+        self._run_times.append(finished - started)
+        return result[:-1]
+
+    def hash(self, password):
+        password_hash, = self._run(_hash, password, self.method, self.salt_length)
+        self.hashed += 1
+        return password_hash
+
+    def verify(self, password_hash, password):
+        """(верен ли пароль, новый хеш или None). Новый хеш - когда параметры хеша изменились."""
+        ok, new_hash = self._run(
+            _verify, password_hash, password, self.method, self.salt_length, self.canonical_method
+        )
+        self.verified += 1
+        if new_hash is not None:
+            self.rehashed += 1
+        return ok, new_hash
+
+    def needs_rehash(self, password_hash):
+        return _method_of(password_hash) != self.canonical_method
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+    @staticmethod
+    def _summary(values):
+        if not values:
+            return None
+        values = sorted(values)
+
+        def ms(q):
+            return round(values[min(len(values) - 1, int(q * (len(values) - 1)))] * 1000, 2)
+
+        return {'p50_ms': ms(0.5), 'p95_ms': ms(0.95), 'p99_ms': ms(0.99), 'max_ms': ms(1.0)}
+
+    def stats(self):
+        return {
+            'method': self.canonical_method,
+            'workers': self.workers,
+            'hashed': self.hashed,
+            'verified': self.verified,
+            'rehashed': self.rehashed,
+            'pool_restarts': self.pool_restarts,
+            'abandoned': self.abandoned,
+            'abandoned_running': self._abandoned_running,
+            'queue_time': self._summary(list(self._queue_times)),
+            'hash_time': self._summary(list(self._run_times)),
+            'admission': self.admission.stats(),
+        }
@@ -0,0 +1,87 @@
+import logging
+import os
+import select
+import threading
+
+import psycopg2
+from psycopg2 import extensions
+
+
+# Фоновый LISTEN на отдельном соединении: доставляет NOTIFY-сообщения из БД
+# подписчикам внутри процесса. Так изменения, сделанные одним воркером,
+# становятся видны кэшам всех остальных воркеров.
+
+logger = logging.getLogger(__name__)
+
+
+class PgListener:
+    def __init__(self, dsn_kwargs, poll_interval=5.0, reconnect_delay=1.0):
+        self.dsn_kwargs = dict(dsn_kwargs)
+        self.poll_interval = poll_interval
+        self.reconnect_delay = reconnect_delay
+        self.pid = os.getpid()
+        self._handlers = {} # канал -> список обработчиков payload
+        self._reconnect_handlers = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def subscribe(self, channel, handler, on_reconnect=None):
+        """handler(payload) вызывается на каждое сообщение канала. on_reconnect() - после
+        переподключения, когда часть сообщений могла быть потеряна."""
+        with self._lock:
+            self._handlers.setdefault(channel, []).append(handler)
+            if on_reconnect is not None:
+                self._reconnect_handlers.append(on_reconnect)
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='pg-listener', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _connect(self):
+        conn = psycopg2.connect(**self.dsn_kwargs)
+        conn.set_isolation_level(extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        with conn.cursor() as cur:
+            for channel in list(self._handlers):
+                cur.execute(f'LISTEN "{channel}"')
+        return conn
+
+    def _dispatch(self, notify):
+        for handler in list(self._handlers.get(notify.channel, ())):
+            try:
+                handler(notify.payload)
+            except Exception:
+                logger.exception('Notification handler failed for channel %s', notify.channel)
+
+    def _run(self):
+        first = True
+        while not self._stop.is_set():
+            conn = None
+            try:
+                conn = self._connect()
+                if not first:
+                    for handler in list(self._reconnect_handlers):
+                        handler()
+                first = False
+                while not self._stop.is_set():
+                    if select.select([conn], [], [], self.poll_interval) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        self._dispatch(conn.notifies.pop(0))
+            except Exception:
+                logger.exception('LISTEN connection lost, reconnecting')
+                first = False
+                self._stop.wait(self.reconnect_delay)
+            finally:
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except psycopg2.Error:
+                        pass
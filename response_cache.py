@@ -0,0 +1,154 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+# LRU-кэш ответов с TTL, stale-while-revalidate и инвалидацией по тегам.
+
+
+class _Entry:
+    __slots__ = ('value', 'tags', 'fresh_until', 'stale_until', 'refreshing')
+
+    def __init__(self, value, tags, fresh_until, stale_until):
+        self.value = value
+        self.tags = tags
+        self.fresh_until = fresh_until
+        self.stale_until = stale_until
+        self.refreshing = False
+
+
+FRESH = 'fresh'
+STALE = 'stale'
+MISS = 'miss'
+
+
+class ResponseCache:
+    def __init__(self, max_entries=1024, ttl=60, stale_ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl # Сколько запись считается свежей, сек
+        self.stale_ttl = stale_ttl # Сколько еще можно отдавать устаревшую запись, обновляя ее в фоне
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._tags = {} # тег -> множество ключей
+        self._generation = 0 # Растет при каждой инвалидации
+
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @property
+    def generation(self):
+        return self._generation
+
+    def lookup(self, key):
+        """Возвращает (value, state). Для STALE вызывающий должен запустить обновление
+        только если claim_refresh(key) вернул True."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or now >= entry.stale_until:
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None, MISS
+            self._entries.move_to_end(key)
+            if now < entry.fresh_until:
+                self.hits += 1
+                return entry.value, FRESH
+            self.stale_hits += 1
+            return entry.value, STALE
+
+    def get_fresh(self, key):
+        """Значение свежей записи или None. Промах не учитывается в статистике: вызывающий
+        затем идет обычным путем через lookup()."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or now >= entry.fresh_until:
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry.value
+
+    def is_fresh(self, key):
+        """Есть ли свежая запись - без учета в статистике и порядке LRU."""
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and time.monotonic() < entry.fresh_until
+
+    def claim_refresh(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.refreshing:
+                return False
+            entry.refreshing = True
+            return True
+
+    def release_refresh(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry.refreshing = False
+
+    def store(self, key, value, tags=(), generation=None):
+        """Сохраняет значение. Если с момента generation была инвалидация,
+        значение могло устареть еще до записи - тогда оно не сохраняется."""
+        now = time.monotonic()
+        tags = frozenset(tags)
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    entry.refreshing = False
+                return False
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = _Entry(value, tags, now + self.ttl, now + self.ttl + self.stale_ttl)
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+            return True
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for tag in entry.tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+    def invalidate_tags(self, tags):
+        with self._lock:
+            self._generation += 1
+            for tag in tags:
+                for key in list(self._tags.get(tag, ())):
+                    self._remove(key)
+                    self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+            self._tags.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.stale_hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'stale_hits': self.stale_hits,
+                'misses': self.misses,
+                'hit_ratio': round((self.hits + self.stale_hits) / lookups, 4) if lookups else None,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
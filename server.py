@@ -1,11 +1,45 @@
-from flask import Flask, jsonify, request, make_response
+from flask import (
+    Flask, Response, jsonify, request, make_response, g, has_request_context,
+    copy_current_request_context
+)
 from flask_cors import CORS
 import psycopg2
-from psycopg2.extras import RealDictCursor
-from werkzeug.security import generate_password_hash, check_password_hash
+from psycopg2.extras import RealDictCursor, execute_values
 from functools import wraps
-from datetime import timedelta
+from datetime import date, datetime, timedelta, timezone
+from decimal import Decimal
+import click
+import json
 import logging
+import math
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
+from db_pool import ConnectionPool, PoolExhausted
+from admission import AdmissionController, AdmissionRejected
+from passwords import PasswordHasher
+from loaders import attach_album_versions, attach_order_items, ADMIN_ORDER_ITEM_COLUMNS
+from pagination import encode_cursor, decode_cursor, InvalidCursor, keyset_page, estimated_count
+from migrations import apply_migrations
+from inventory import reserve_cart, release_order, stripe_versions, unstripe_versions, StockSync
+from discounts import DiscountIndex, discounted_price
+from catalog_read_model import decode_row, pick, refresh_due, check_read_model
+from catalog_import import import_catalog, FORMATS as IMPORT_FORMATS
+from analytics import DIMENSIONS, METRICS, date_range, sales_series, top_sales, rebuild_sales, SalesDeltaFold
+from order_export import export_orders, export_filters, FORMATS as EXPORT_FORMATS, MIMETYPES as EXPORT_MIMETYPES
+from metrics import (
+    InstrumentedConnection, InstrumentedJsonProvider, RequestMetrics,
+    begin_request, end_request, current_request_stats
+)
+from response_cache import ResponseCache, MISS, STALE
+from pg_listener import PgListener
+from slow_queries import SlowQueryLog
+from compression import (
+    EncodedBody, ETAG_SUFFIXES, available_encodings, compress, compress_stream, iter_chunks
+)
 from flask_jwt_extended import (
     JWTManager, create_access_token, 
     jwt_required, get_jwt_identity,
@@ -13,6 +47,7 @@ from flask_jwt_extended import (
 )
 
 app = Flask(__name__)
+app.json = InstrumentedJsonProvider(app) # Быстрая сериализация (orjson), вывод совпадает со стандартным
 
 # Настройка логирования
 logging.basicConfig(
@@ -33,9 +68,538 @@ DB_CONFIG = {
     'password': '12345',
     'port': '5432'
 }
+app.config['DB_CONFIG'] = DB_CONFIG # Тот же словарь: переопределяется через KPOP_DB_CONFIG__host и т.п.
+
+# Настройки пула соединений
+app.config['DB_POOL_MIN_SIZE'] = 2 # Соединений, открываемых при старте
+app.config['DB_POOL_MAX_SIZE'] = 20 # Максимум соединений на процесс
+app.config['DB_POOL_TIMEOUT'] = 0.5 # Сколько ждать свободное соединение, сек
+app.config['DB_POOL_MAX_LIFETIME'] = 1800 # Пересоздавать соединения старше, сек
+app.config['DB_POOL_HEALTH_CHECK_AFTER'] = 30 # Проверять SELECT 1 после простоя, сек
+app.config['DB_POOL_RETRY_AFTER'] = 1 # Значение Retry-After при исчерпании пула, сек
+
+_db_pool = None
+_db_pool_lock = threading.Lock()
+
+def get_db_pool():
+    # Пул создается лениво и заново в каждом процессе (соединения нельзя делить между форками)
+    global _db_pool
+    if _db_pool is None or _db_pool.pid != os.getpid():
+        with _db_pool_lock:
+            if _db_pool is None or _db_pool.pid != os.getpid():
+                _db_pool = ConnectionPool(
+                    DB_CONFIG,
+                    min_size=app.config['DB_POOL_MIN_SIZE'],
+                    max_size=app.config['DB_POOL_MAX_SIZE'],
+                    timeout=app.config['DB_POOL_TIMEOUT'],
+                    max_lifetime=app.config['DB_POOL_MAX_LIFETIME'],
+                    health_check_after=app.config['DB_POOL_HEALTH_CHECK_AFTER'],
+                    retry_after=app.config['DB_POOL_RETRY_AFTER'],
+                    connection_factory=InstrumentedConnection # Время запросов - в метрики (metrics.py)
+                )
+    return _db_pool
 
 def get_db_connection():
-    return psycopg2.connect(**DB_CONFIG) # Создает и возвращает соединение с базой данных
+    # Выдает соединение из пула. В рамках запроса используется одно соединение,
+    # которое возвращается в пул вызовом close() или по завершении запроса.
+    if not has_request_context():
+        return get_db_pool().getconn()
+    conn = g.get('db_conn')
+    if conn is None or conn.closed:
+        started = time.perf_counter()
+        conn = g.db_conn = get_db_pool().getconn()
+        stats = current_request_stats()
+        if stats is not None:
+            stats.pool_wait += time.perf_counter() - started
+    return conn
+
+@app.teardown_request
+def release_db_connection(exc):
+    conn = g.pop('db_conn', None)
+    if conn is not None:
+        conn.close()
+
+def release_request_connection():
+    # Досрочно возвращает соединение запроса в пул (незавершенная транзакция откатывается),
+    # например перед долгим ожиданием без БД; следующий get_db_connection() возьмет новое
+    conn = g.pop('db_conn', None)
+    if conn is not None:
+        conn.close()
+
+# Метрики запросов (metrics.py): задержка, SQL, сериализация, ожидание пула - по маршрутам
+app.config['METRICS_ENABLED'] = True
+app.config['METRICS_SERVER_TIMING'] = True # Заголовок Server-Timing с разбивкой времени ответа
+
+# Журнал медленных SQL-запросов (slow_queries.py)
+app.config['SLOW_QUERY_LOG_ENABLED'] = True
+app.config['SLOW_QUERY_THRESHOLD'] = 0.2 # SQL-запрос дольше - медленный, сек
+app.config['SLOW_QUERY_TRACE_MAX_STATEMENTS'] = 200 # Запросов в трассе одного HTTP-запроса
+app.config['SLOW_QUERY_MAX_TRACES'] = 100 # Трасс в памяти процесса
+app.config['SLOW_QUERY_EXPLAIN_SAMPLE'] = 0.2 # Доля медленных запросов с EXPLAIN (ANALYZE, BUFFERS)
+app.config['SLOW_QUERY_EXPLAIN_PER_MINUTE'] = 6 # Не больше EXPLAIN в минуту на процесс
+app.config['SLOW_QUERY_EXPLAIN_TIMEOUT'] = 5 # statement_timeout для EXPLAIN ANALYZE, сек
+app.config['SLOW_QUERY_PLAN_TTL'] = 300 # План одного запроса снимается не чаще, сек
+
+request_metrics = RequestMetrics()
+
+_slow_query_log = None
+_slow_query_log_lock = threading.Lock()
+
+def get_slow_query_log():
+    # Свой журнал и поток EXPLAIN в каждом процессе
+    global _slow_query_log
+    if _slow_query_log is None or _slow_query_log.pid != os.getpid():
+        with _slow_query_log_lock:
+            if _slow_query_log is None or _slow_query_log.pid != os.getpid():
+                _slow_query_log = SlowQueryLog(
+                    DB_CONFIG,
+                    max_traces=app.config['SLOW_QUERY_MAX_TRACES'],
+                    explain_sample=app.config['SLOW_QUERY_EXPLAIN_SAMPLE'],
+                    explain_per_minute=app.config['SLOW_QUERY_EXPLAIN_PER_MINUTE'],
+                    explain_timeout=app.config['SLOW_QUERY_EXPLAIN_TIMEOUT'],
+                    plan_ttl=app.config['SLOW_QUERY_PLAN_TTL']
+                )
+    return _slow_query_log
+
+@app.before_request
+def start_request_metrics():
+    if app.config['SLOW_QUERY_LOG_ENABLED']:
+        g.request_metrics_token = begin_request(
+            app.config['SLOW_QUERY_TRACE_MAX_STATEMENTS'], app.config['SLOW_QUERY_THRESHOLD']
+        )
+    elif app.config['METRICS_ENABLED']:
+        g.request_metrics_token = begin_request()
+
+# Зарегистрирован раньше остальных after_request, поэтому выполняется последним
+# и учитывает их время (сжатие, CORS). Тело потоковых ответов не учитывается.
+@app.after_request
+def record_request_metrics(response):
+    stats = current_request_stats()
+    if stats is None or 'request_metrics_token' not in g:
+        return response
+    duration = stats.elapsed()
+    endpoint = request.url_rule.endpoint if request.url_rule is not None else 'unmatched'
+    if stats.slow:
+        get_slow_query_log().add(request.method, request.path, endpoint, response.status_code, duration, stats)
+    if not app.config['METRICS_ENABLED']:
+        return response
+    request_metrics.observe(endpoint, request.method, response.status_code, stats, duration)
+    if app.config['METRICS_SERVER_TIMING']:
+        response.headers['Server-Timing'] = stats.server_timing(duration)
+    return response
+
+@app.teardown_request
+def end_request_metrics(exc):
+    token = g.pop('request_metrics_token', None)
+    if token is not None:
+        end_request(token)
+
+# Кэш публичных ответов каталога
+app.config['CATALOG_CACHE_MAX_ENTRIES'] = 1024 # Максимум записей (LRU)
+app.config['CATALOG_CACHE_TTL'] = 60 # Запись свежая, сек
+app.config['CATALOG_CACHE_STALE_TTL'] = 300 # Устаревшая запись отдается с фоновым обновлением, сек
+
+CATALOG_CHANNEL = 'catalog_invalidate' # Канал NOTIFY для инвалидации кэша во всех воркерах
+
+catalog_cache = ResponseCache(
+    max_entries=app.config['CATALOG_CACHE_MAX_ENTRIES'],
+    ttl=app.config['CATALOG_CACHE_TTL'],
+    stale_ttl=app.config['CATALOG_CACHE_STALE_TTL']
+)
+
+# Кэш состояния пользователей для проверки токенов: существует, активен, админ
+app.config['USER_STATE_CACHE_MAX_ENTRIES'] = 10000 # Максимум пользователей (LRU)
+app.config['USER_STATE_CACHE_TTL'] = 30 # Запись свежая, сек; изменения из админки приходят сразу через NOTIFY
+
+USER_STATE_CHANNEL = 'user_state_invalidate' # Канал NOTIFY с id измененного пользователя
+
+user_state_cache = ResponseCache(
+    max_entries=app.config['USER_STATE_CACHE_MAX_ENTRIES'],
+    ttl=app.config['USER_STATE_CACHE_TTL'],
+    stale_ttl=0 # Устаревшее состояние не отдается
+)
+
+_pg_listener = None
+_pg_listener_lock = threading.Lock()
+
+# Версия каталога (version, updated_at) для ETag / Last-Modified; None - еще не загружена
+_catalog_stamp = None
+_catalog_stamp_lock = threading.Lock()
+
+def set_catalog_stamp(version, updated_at):
+    global _catalog_stamp
+    with _catalog_stamp_lock:
+        if _catalog_stamp is None or version > _catalog_stamp[0]:
+            _catalog_stamp = (version, updated_at)
+
+def load_catalog_stamp():
+    global _catalog_stamp
+    conn = get_db_pool().getconn()
+    try:
+        with conn.cursor() as cur:
+            cur.execute('SELECT version, EXTRACT(EPOCH FROM updated_at) FROM catalog_version WHERE id = 1')
+            row = cur.fetchone()
+        conn.commit()
+    except psycopg2.Error as e:
+        # Без миграции 002 условные запросы просто не обрабатываются
+        app.logger.warning(f"Catalog version is unavailable: {str(e)}")
+        row = None
+    finally:
+        conn.close()
+    with _catalog_stamp_lock:
+        _catalog_stamp = (row[0], float(row[1])) if row else None
+
+def apply_catalog_invalidation(tags):
+    if '*' in tags:
+        catalog_cache.clear()
+    else:
+        catalog_cache.invalidate_tags(tags)
+    if any(tag == '*' or tag.startswith('discounts:') for tag in tags):
+        reload_discount_index()
+
+def on_catalog_notify(payload):
+    message = json.loads(payload)
+    if message.get('version') is not None:
+        set_catalog_stamp(message['version'], message['updated_at'])
+    apply_catalog_invalidation(message['tags'])
+
+def on_user_state_notify(payload):
+    user_state_cache.invalidate_tags([int(payload)])
+
+def on_catalog_listener_reconnect():
+    # Пока соединения не было, часть сообщений могла потеряться
+    catalog_cache.clear()
+    load_catalog_stamp()
+    reload_discount_index()
+
+def get_pg_listener():
+    # Слушатель NOTIFY запускается один раз в каждом процессе
+    global _pg_listener
+    if _pg_listener is None or _pg_listener.pid != os.getpid():
+        with _pg_listener_lock:
+            if _pg_listener is None or _pg_listener.pid != os.getpid():
+                # Записи, унаследованные от родительского процесса, могли пропустить инвалидации
+                catalog_cache.clear()
+                user_state_cache.clear()
+                listener = PgListener(DB_CONFIG)
+                listener.subscribe(CATALOG_CHANNEL, on_catalog_notify, on_reconnect=on_catalog_listener_reconnect)
+                listener.subscribe(USER_STATE_CHANNEL, on_user_state_notify, on_reconnect=user_state_cache.clear)
+                listener.start()
+                _pg_listener = listener
+                load_catalog_stamp()
+                # Индекс скидок следит за границами скидок и в модели каталога
+                get_discount_index()
+    return _pg_listener
+
+def invalidate_catalog(cur, *tags):
+    # Увеличивает версию каталога и отправляет NOTIFY с тегами и новой версией.
+    # Сообщение доставляется всем воркерам в момент коммита транзакции (и не доставляется при откате).
+    # Свой процесс чистит кэш сразу после ответа, не дожидаясь сообщения.
+    tags = sorted({str(tag) for tag in tags})
+    if len(json.dumps(tags)) > 7000: # Лимит payload у NOTIFY - 8000 байт
+        tags = ['*']
+    with cur.connection.cursor() as stamp_cur:
+        stamp_cur.execute('''
+            WITH stamp AS (
+                UPDATE catalog_version
+                SET version = version + 1, updated_at = NOW()
+                WHERE id = 1
+                RETURNING version, updated_at
+            )
+            SELECT pg_notify(%s, json_build_object(
+                'tags', %s::json,
+                'version', version,
+                'updated_at', EXTRACT(EPOCH FROM updated_at)
+            )::text)
+            FROM stamp
+        ''', (CATALOG_CHANNEL, json.dumps(tags)))
+    if has_request_context():
+        g.setdefault('catalog_invalidations', set()).update(tags)
+
+@app.after_request
+def apply_local_catalog_invalidations(response):
+    tags = g.pop('catalog_invalidations', None)
+    if tags:
+        apply_catalog_invalidation(tags)
+    return response
+
+# Сжатие ответов (gzip / brotli по Accept-Encoding)
+app.config['COMPRESS_MIMETYPES'] = {'application/json', 'application/x-ndjson', 'text/csv'}
+app.config['COMPRESS_MIN_SIZE'] = 1024 # Меньшие ответы не сжимаются, байт
+app.config['COMPRESS_GZIP_LEVEL'] = 6 # 1-9
+app.config['COMPRESS_BROTLI_LEVEL'] = 5 # 0-11
+app.config['COMPRESS_STREAM_MIN_SIZE'] = 1024 * 1024 # Большие тела сжимаются и отдаются по кускам, байт
+app.config['COMPRESS_STREAM_CHUNK_SIZE'] = 64 * 1024
+
+def compression_level(encoding):
+    return app.config['COMPRESS_BROTLI_LEVEL'] if encoding == 'br' else app.config['COMPRESS_GZIP_LEVEL']
+
+def negotiate_encoding(response):
+    # Кодировка, которой нужно сжать ответ, или None
+    if (response.mimetype not in app.config['COMPRESS_MIMETYPES']
+            or response.status_code < 200 or response.status_code in (204, 304)
+            or 'Content-Encoding' in response.headers):
+        return None
+    return request.accept_encodings.best_match(available_encodings())
+
+def mark_encoded(response, encoding):
+    response.headers['Content-Encoding'] = encoding
+    response.headers.pop('Content-Length', None)
+    # Сжатое представление - другие байты, поэтому у него свой строгий ETag
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag(etag + ETAG_SUFFIXES[encoding], weak)
+
+@app.after_request
+def compress_response(response):
+    if response.mimetype in app.config['COMPRESS_MIMETYPES']:
+        response.vary.add('Accept-Encoding')
+    encoding = negotiate_encoding(response)
+    if encoding is None:
+        return response
+    level = compression_level(encoding)
+
+    if response.is_streamed:
+        # Каждый кусок генератора уходит клиенту сразу, а не копится в компрессоре
+        response.response = compress_stream(response.response, encoding, level, flush=True)
+    else:
+        data = response.get_data()
+        if len(data) < app.config['COMPRESS_MIN_SIZE']:
+            return response
+        if len(data) >= app.config['COMPRESS_STREAM_MIN_SIZE']:
+            chunks = iter_chunks(data, app.config['COMPRESS_STREAM_CHUNK_SIZE'])
+            response.response = compress_stream(chunks, encoding, level)
+        else:
+            response.set_data(compress(data, encoding, level))
+    mark_encoded(response, encoding)
+    return response
+
+def cached_body_response(entry):
+    # Ответ из закэшированного тела; сжатый вариант считается один раз и хранится в записи кэша
+    response = app.response_class(entry.body, mimetype=entry.mimetype)
+    encoding = negotiate_encoding(response)
+    if encoding is not None and len(entry.body) >= app.config['COMPRESS_MIN_SIZE']:
+        response.set_data(entry.encoded(encoding, compression_level(encoding)))
+        mark_encoded(response, encoding)
+    return response
+
+def cached_response(*tag_templates):
+    # Кэширует успешные ответы GET-маршрута. Теги форматируются аргументами маршрута,
+    # например cached_response('album:{album_id}'), и используются для инвалидации.
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(**kwargs):
+            get_pg_listener()
+            key = request.full_path
+            tags = [template.format(**kwargs) for template in tag_templates]
+
+            def load():
+                generation = catalog_cache.generation
+                response = make_response(fn(**kwargs))
+                if response.status_code != 200:
+                    return response, None
+                entry = EncodedBody(response.get_data(), response.mimetype)
+                catalog_cache.store(key, entry, tags, generation)
+                return response, entry
+
+            value, state = catalog_cache.lookup(key)
+            if state == MISS:
+                response, entry = load()
+                if entry is not None:
+                    response = cached_body_response(entry)
+                response.headers['X-Cache'] = 'MISS'
+                return response
+
+            if state == STALE and catalog_cache.claim_refresh(key):
+                @copy_current_request_context
+                def refresh():
+                    try:
+                        load()
+                    except Exception as e:
+                        app.logger.error(f"Cache refresh error for {key}: {str(e)}")
+                    finally:
+                        catalog_cache.release_refresh(key)
+                threading.Thread(target=refresh, daemon=True).start()
+
+            response = cached_body_response(value)
+            response.headers['X-Cache'] = 'HIT' if state != STALE else 'STALE'
+            return response
+        return wrapper
+    return decorator
+
+# Политика Cache-Control для условных GET по имени обработчика
+app.config['CACHE_CONTROL'] = {
+    'get_albums': 'public, no-cache',
+    'get_album': 'public, no-cache',
+    'get_artists_by_category': 'public, max-age=60',
+    'get_artist': 'public, no-cache'
+}
+app.config['CACHE_CONTROL_DEFAULT'] = 'no-cache'
+
+def conditional_response(fn):
+    # ETag / Last-Modified из версии каталога. На If-None-Match с актуальной версией
+    # отвечает 304, не выполняя запросы обработчика.
+    @wraps(fn)
+    def wrapper(**kwargs):
+        get_pg_listener()
+        stamp = _catalog_stamp # Читается до обработчика: ответ не может оказаться новее своей версии
+        if stamp is None:
+            return fn(**kwargs)
+        return catalog_conditional(stamp, fn.__name__, lambda: fn(**kwargs))
+    return wrapper
+
+def catalog_conditional(stamp, endpoint, build):
+    # 304 или ответ build() с ETag / Last-Modified версии каталога stamp
+    version, updated_at = stamp
+    etag = f'catalog-{version}'
+    # Last-Modified - только для информации, с округлением вверх до секунды. Проверка
+    # If-Modified-Since не выполняется: две записи каталога в одну секунду дают одинаковое
+    # значение, и клиент получил бы 304 на устаревшую версию. Валидатор - только ETag.
+    last_modified = datetime.fromtimestamp(math.ceil(updated_at), timezone.utc)
+
+    # ETag сжатого представления отличается суффиксом кодировки
+    candidates = [etag + suffix for suffix in ('', *ETAG_SUFFIXES.values())]
+    if request.if_none_match:
+        matched = next((tag for tag in candidates if request.if_none_match.contains_weak(tag)), None)
+    else:
+        matched = None
+
+    if matched is not None:
+        response = app.response_class(status=304)
+        response.set_etag(matched)
+    else:
+        response = make_response(build())
+        if response.status_code != 200:
+            return response
+        response.set_etag(etag + ETAG_SUFFIXES.get(response.headers.get('Content-Encoding'), ''))
+
+    response.last_modified = last_modified
+    response.headers['Cache-Control'] = app.config['CACHE_CONTROL'].get(
+        endpoint, app.config['CACHE_CONTROL_DEFAULT']
+    )
+    return response
+
+def cached_catalog_response(endpoint):
+    # Ответ маршрута каталога (conditional_response + cached_response) только из памяти
+    # процесса: слушатель запущен, версия каталога загружена и запись кэша свежая.
+    # Иначе None - нужен обычный обработчик, который может обращаться к БД.
+    # Асинхронный режим (asgi.py) вызывает ее в цикле событий, поэтому здесь нет запросов к БД.
+    listener = _pg_listener
+    stamp = _catalog_stamp
+    if listener is None or listener.pid != os.getpid() or stamp is None:
+        return None
+    entry = catalog_cache.get_fresh(request.full_path)
+    if entry is None:
+        return None
+
+    def build():
+        response = cached_body_response(entry)
+        response.headers['X-Cache'] = 'HIT'
+        return response
+    return catalog_conditional(stamp, endpoint, build)
+
+# Пул исчерпан: быстро отказываем вместо накопления очереди запросов к БД
+@app.errorhandler(PoolExhausted)
+def handle_pool_exhausted(e):
+    response = jsonify({'message': 'Service is busy, please retry later'})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response
+
+# Контроль допуска к оформлению заказа и записи в корзину (admission.py).
+# Лимиты - на процесс; вместе они должны оставлять в пуле соединения для чтения каталога.
+app.config['ADMISSION_CHECKOUT_MAX_CONCURRENT'] = 8 # Одновременных оформлений заказа
+app.config['ADMISSION_CHECKOUT_MAX_QUEUE'] = 200 # Больше ожидающих - сразу 429
+app.config['ADMISSION_CHECKOUT_MAX_WAIT'] = 10 # Максимальное ожидание в очереди, сек
+app.config['ADMISSION_CART_MAX_CONCURRENT'] = 8
+app.config['ADMISSION_CART_MAX_QUEUE'] = 200
+app.config['ADMISSION_CART_MAX_WAIT'] = 5
+
+admission_controllers = {
+    name: AdmissionController(
+        name,
+        app.config[f'ADMISSION_{name.upper()}_MAX_CONCURRENT'],
+        app.config[f'ADMISSION_{name.upper()}_MAX_QUEUE'],
+        app.config[f'ADMISSION_{name.upper()}_MAX_WAIT']
+    )
+    for name in ('checkout', 'cart')
+}
+
+def admission_controlled(name, methods=('POST',)):
+    # Обработчик выполняется только после допуска; ожидание в очереди - строго по порядку прихода
+    controller = admission_controllers[name]
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if request.method not in methods:
+                return fn(*args, **kwargs)
+            with controller.enter() as admission:
+                response = make_response(fn(*args, **kwargs))
+            if admission.position:
+                response.headers['X-Queue-Position'] = str(admission.position)
+                response.headers['X-Queue-Wait'] = f'{admission.waited:.3f}'
+            return response
+        return wrapper
+    return decorator
+
+# Очередь переполнена или ожидание слишком долгое: 429 с позицией и оценкой ожидания
+@app.errorhandler(AdmissionRejected)
+def handle_admission_rejected(e):
+    response = jsonify({
+        'message': 'Too many requests, please retry later',
+        'reason': e.reason,
+        'queue_position': e.position,
+        'eta_seconds': round(e.eta, 1)
+    })
+    response.status_code = 429
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response
+
+# Хеширование паролей в пуле процессов (passwords.py)
+app.config['PASSWORD_HASH_METHOD'] = 'scrypt:32768:8:1' # Метод werkzeug; при смене хеши обновляются при входе
+app.config['PASSWORD_SALT_LENGTH'] = 16
+app.config['PASSWORD_POOL_WORKERS'] = 2 # Процессов хеширования на воркер; 0 - в потоке запроса
+app.config['PASSWORD_MAX_CONCURRENT'] = 2 # Одновременных хеширований на воркер
+# Ожидающие занимают потоки воркера: вместе с PASSWORD_MAX_CONCURRENT меньше потоков
+# gunicorn (gunicorn.conf.py, threads), чтобы остальным маршрутам оставались потоки
+app.config['PASSWORD_MAX_QUEUE'] = 4 # Больше ожидающих - сразу 429
+app.config['PASSWORD_MAX_WAIT'] = 5 # Максимальное ожидание в очереди, сек
+app.config['PASSWORD_TIMEOUT'] = 30 # Ожидание результата от пула, сек
+
+_password_hasher = None
+_password_hasher_lock = threading.Lock()
+
+def get_password_hasher():
+    # Пул процессов хеширования - свой в каждом воркере
+    global _password_hasher
+    if _password_hasher is None or _password_hasher.pid != os.getpid():
+        with _password_hasher_lock:
+            if _password_hasher is None or _password_hasher.pid != os.getpid():
+                _password_hasher = PasswordHasher(
+                    app.config['PASSWORD_HASH_METHOD'],
+                    salt_length=app.config['PASSWORD_SALT_LENGTH'],
+                    workers=app.config['PASSWORD_POOL_WORKERS'],
+                    max_concurrent=app.config['PASSWORD_MAX_CONCURRENT'],
+                    max_queue=app.config['PASSWORD_MAX_QUEUE'],
+                    max_wait=app.config['PASSWORD_MAX_WAIT'],
+                    timeout=app.config['PASSWORD_TIMEOUT']
+                )
+    return _password_hasher
+
+def hash_password(password):
+    # Хеш ждет очереди пула процессов - соединение запроса на это время возвращается в пул.
+    # Вызывается до того, как обработчик возьмет свое соединение.
+    release_request_connection()
+    return get_password_hasher().hash(password)
+
+# Текущая очередь для страницы ожидания: позиция и оценка ожидания для нового запроса
+@app.route('/api/queue', methods=['GET'])
+def queue_status():
+    status = {}
+    for name, controller in admission_controllers.items():
+        position, eta = controller.estimate()
+        status[name] = {'queue_position': position, 'eta_seconds': round(eta, 1)}
+    return jsonify(status)
 
 # Универсальный обработчик CORS, добавляет CORS-заголовки ко всем ответам сервера.
 @app.after_request
@@ -44,6 +608,7 @@ def add_cors_headers(response):
     response.headers['Access-Control-Allow-Credentials'] = 'true'
     response.headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization'
     response.headers['Access-Control-Allow-Methods'] = 'GET, POST, PUT, DELETE, OPTIONS'
+    response.headers['Access-Control-Expose-Headers'] = 'Retry-After, X-Queue-Position, X-Queue-Wait'
     return response
 
 # Обработчики предварительных OPTIONS-запросов для CORS.
@@ -114,9 +679,12 @@ def register():
         cur.execute("SELECT id FROM users WHERE email = %s", (email,))
         if cur.fetchone():
             return jsonify({'message': 'Email already exists!'}), 400
+        cur.close()
         
-        hashed_password = generate_password_hash(password) # Хеширование пароля
+        hashed_password = hash_password(password) # Хеширование пароля (в пуле процессов, без соединения)
         
+        conn = get_db_connection()
+        cur = conn.cursor()
         cur.execute(
             "INSERT INTO users (email, password_hash, first_name, last_name, is_admin) "
             "VALUES (%s, %s, %s, %s, %s) RETURNING id",
@@ -137,8 +705,11 @@ def register():
             'cart_id': cart_id
         }), 201
         
+    except AdmissionRejected:
+        raise # 429 (handle_admission_rejected)
     except Exception as e:
-        conn.rollback() # Откат изменений при ошибке
+        if not conn.closed:
+            conn.rollback() # Откат изменений при ошибке
         app.logger.error(f"Registration error: {str(e)}", exc_info=True)
         return jsonify({'message': 'Registration failed. Please try again.'}), 500
     finally:
@@ -167,9 +738,24 @@ def login():
         
         if not user:
             return jsonify({'message': 'User not found!'}), 404
+        cur.close()
         
-        if not check_password_hash(user['password_hash'], password):
+        # Проверка может ждать очереди пула хеширования - соединение на это время
+        # возвращается в пул, а не простаивает в открытой транзакции
+        release_request_connection()
+        password_ok, new_hash = get_password_hasher().verify(user['password_hash'], password)
+        if not password_ok:
             return jsonify({'message': 'Wrong password!'}), 401
+        
+        # Параметры хеша изменились - сохраняем пересчитанный хеш, если пароль не сменили параллельно
+        if new_hash is not None:
+            conn = get_db_connection()
+            cur = conn.cursor(cursor_factory=RealDictCursor)
+            cur.execute(
+                'UPDATE users SET password_hash = %s WHERE id = %s AND password_hash = %s',
+                (new_hash, user['id'], user['password_hash'])
+            )
+            conn.commit()
          
         identity = str(user['id'])
          
@@ -194,6 +780,8 @@ def login():
         'user': user_data
         }), 200
         
+    except AdmissionRejected:
+        raise # 429 (handle_admission_rejected)
     except Exception as e:
         app.logger.error(f"Login error: {str(e)}", exc_info=True)
         return jsonify({'message': 'Login failed. Please try again.'}), 500
@@ -201,6 +789,67 @@ def login():
         cur.close()
         conn.close()
 
+# Состояние пользователя из токена. Проверяется при каждом jwt_required, поэтому берется
+# из кэша процесса; запрос к БД - только при промахе. update_user / delete_user сбрасывают
+# запись во всех воркерах, так что токены удаленных и деактивированных отклоняются сразу.
+USER_STATE_SQL = 'SELECT COALESCE(is_active, true) AS is_active, is_admin FROM users WHERE id = %s'
+
+def user_id_of(identity):
+    # identity - строка id (см. login) или словарь с id; None - не похоже на пользователя
+    try:
+        return int(identity['id'] if isinstance(identity, dict) else identity)
+    except (KeyError, TypeError, ValueError):
+        return None
+
+def cache_user_state(user_id, row, generation):
+    # row - результат USER_STATE_SQL или None, если пользователя нет
+    state = {
+        'exists': row is not None,
+        'is_active': row is not None and bool(row['is_active']),
+        'is_admin': row is not None and bool(row['is_admin'])
+    }
+    user_state_cache.store(user_id, state, (user_id,), generation)
+    return state
+
+def get_user_state(user_id):
+    get_pg_listener() # Без слушателя изменения из других воркеров не дойдут до кэша
+    state, cache_state = user_state_cache.lookup(user_id)
+    if cache_state != MISS:
+        return state
+    generation = user_state_cache.generation
+    conn = get_db_connection() # В запросе - то же соединение, что получит обработчик
+    with conn.cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute(USER_STATE_SQL, (user_id,))
+        row = cur.fetchone()
+    conn.commit()
+    return cache_user_state(user_id, row, generation)
+
+def invalidate_user_state(cur, user_id):
+    # Сообщение доставляется всем воркерам в момент коммита; свой процесс сбрасывает запись после ответа
+    cur.execute('SELECT pg_notify(%s, %s)', (USER_STATE_CHANNEL, str(user_id)))
+    if has_request_context():
+        g.setdefault('user_state_invalidations', set()).add(user_id)
+
+@app.after_request
+def apply_local_user_state_invalidations(response):
+    user_ids = g.pop('user_state_invalidations', None)
+    if user_ids:
+        user_state_cache.invalidate_tags(user_ids)
+    return response
+
+@jwt.token_in_blocklist_loader
+def is_token_revoked(jwt_header, jwt_payload):
+    user_id = user_id_of(jwt_payload[app.config['JWT_IDENTITY_CLAIM']])
+    if user_id is None:
+        return True
+    state = get_user_state(user_id)
+    g.user_state = state
+    return not (state['exists'] and state['is_active'])
+
+@jwt.revoked_token_loader
+def revoked_token_response(jwt_header, jwt_payload):
+    return jsonify({'message': 'User not found or deactivated!'}), 401
+
 # Декоратор для проверки админских прав
 
 def admin_required(fn):
@@ -210,15 +859,16 @@ def admin_required(fn):
             # Получаем claims из токена
             claims = get_jwt() 
             
-            # Проверяем is_admin в claims
-            if not claims.get('is_admin', False):
+            # Проверяем is_admin в claims и в текущем состоянии (права могли отозвать после выдачи токена)
+            state = g.get('user_state')
+            if not claims.get('is_admin', False) or (state is not None and not state['is_admin']):
                 return jsonify({'message': 'Admin access required!'}), 403
                 
-            return fn(*args, **kwargs)
-            
         except Exception as e:
             app.logger.error(f"Admin check error: {str(e)}")
             return jsonify({'message': 'Authorization failed'}), 401
+        # Вне try: PoolExhausted и AdmissionRejected доходят до своих обработчиков (503/429)
+        return fn(*args, **kwargs)
     return wrapper
 
 # Проверяет валидность токена и возвращает информацию о пользователе.
@@ -233,6 +883,22 @@ def check_auth():
         'is_admin': claims.get('is_admin', False)
     })
 
+# Запросы и формирование ответов, общие для синхронных обработчиков и асинхронного режима (asgi.py)
+PROFILE_SQL = '''
+    SELECT id, email, first_name, last_name, is_admin 
+    FROM users 
+    WHERE id = %s
+'''
+
+def profile_payload(user):
+    return {
+        'id': user['id'],
+        'email': user['email'],
+        'firstName': user['first_name'],
+        'lastName': user['last_name'],
+        'isAdmin': user['is_admin']
+    }
+
 # Возвращает профиль текущего пользователя.
 @app.route('/api/profile', methods=['GET'])
 @jwt_required()
@@ -242,23 +908,13 @@ def get_profile():
     cur = conn.cursor(cursor_factory=RealDictCursor)
     
     try:
-        cur.execute('''
-            SELECT id, email, first_name, last_name, is_admin 
-            FROM users 
-            WHERE id = %s
-        ''', (current_user['id'],))
+        cur.execute(PROFILE_SQL, (current_user['id'],))
         user = cur.fetchone()
         
         if not user:
             return jsonify({'message': 'User not found'}), 404
             
-        return jsonify({
-            'id': user['id'],
-            'email': user['email'],
-            'firstName': user['first_name'],
-            'lastName': user['last_name'],
-            'isAdmin': user['is_admin']
-        })
+        return jsonify(profile_payload(user))
         
     except Exception as e:
         return jsonify({'message': str(e)}), 500
@@ -282,32 +938,201 @@ def validate_token():
 # ---- АРТИСТЫ И АЛЬБОМЫ ---- 
 
 
+ARTIST_CATEGORIES = ['female_group', 'male_group', 'solo']
+ALBUM_STATUSES = ['in_stock', 'pre_order', 'out_of_stock']
+
+# Параметры серверного просмотра каталога. Без них /api/albums отдает прежний полный список.
+ALBUM_BROWSE_PARAMS = {
+    'category', 'artist_id', 'min_price', 'max_price', 'status',
+    'is_preorder', 'in_stock', 'sort', 'limit', 'cursor'
+}
+
+# Сортировка: выражение ключа, направление и тип ключа в курсоре. Для каждой есть индекс по (ключ, id).
+ALBUM_BROWSE_SORTS = {
+    'release_date_desc': ("COALESCE(a.release_date, DATE '0001-01-01')", 'DESC', date.fromisoformat),
+    'release_date_asc': ("COALESCE(a.release_date, DATE '0001-01-01')", 'ASC', date.fromisoformat),
+    'price_asc': ('a.base_price', 'ASC', Decimal),
+    'price_desc': ('a.base_price', 'DESC', Decimal),
+    'title_asc': ('a.title', 'ASC', str),
+    'title_desc': ('a.title', 'DESC', str)
+}
+
+# Публичные эндпоинты читают catalog_read_model (catalog_read_model.py): одна строка на альбом
+# с артистом и версиями, без JOIN и агрегации при чтении
+CATALOG_VERSION_KEYS = ('id', 'version_name', 'price_diff', 'stock_quantity') # Версии в списках альбомов
+CATALOG_ALBUM_COLUMNS = 'artist, artist_image, album::text AS album, versions::text AS versions'
+
+def catalog_album(row):
+    # Строка albums с артистом и всеми полями версий - как в карточке альбома
+    row = decode_row(row)
+    return {
+        **row['album'],
+        'artist_name': row['artist'],
+        'artist_image': row['artist_image'],
+        'versions': row['versions']
+    }
+
+ALBUM_BROWSE_DEFAULT_LIMIT = 24
+ALBUM_BROWSE_MAX_LIMIT = 100
+
+def parse_bool_arg(name):
+    value = request.args.get(name)
+    if value is None or value == '':
+        return None
+    if value.lower() in ('1', 'true', 'yes'):
+        return True
+    if value.lower() in ('0', 'false', 'no'):
+        return False
+    raise ValueError(f'Invalid {name}')
+
+def album_browse_filters(skip=None):
+    # WHERE-условия из параметров запроса. skip - фасет, собственный фильтр которого не применяется.
+    clauses, params = [], []
+
+    category = request.args.get('category')
+    if category and skip != 'category':
+        if category not in ARTIST_CATEGORIES:
+            raise ValueError('Invalid category')
+        clauses.append('a.category = %s')
+        params.append(category)
+
+    artist_id = request.args.get('artist_id', type=int)
+    if artist_id is not None:
+        clauses.append('a.artist_id = %s')
+        params.append(artist_id)
+
+    min_price = request.args.get('min_price', type=float)
+    if min_price is not None:
+        clauses.append('a.base_price >= %s')
+        params.append(min_price)
+
+    max_price = request.args.get('max_price', type=float)
+    if max_price is not None:
+        clauses.append('a.base_price <= %s')
+        params.append(max_price)
+
+    if skip != 'status':
+        statuses = [st for st in request.args.get('status', '').split(',') if st]
+        if statuses:
+            clauses.append('a.status = ANY(%s)')
+            params.append(statuses)
+        else:
+            clauses.append("a.status != 'out_of_stock'")
+
+    is_preorder = parse_bool_arg('is_preorder')
+    if is_preorder is not None:
+        clauses.append('a.is_preorder = %s')
+        params.append(is_preorder)
+
+    if parse_bool_arg('in_stock'):
+        clauses.append('a.total_stock > 0')
+
+    return clauses, params
+
+def browse_albums(cur):
+    # Страница каталога с фильтрами, keyset-пагинацией и фасетами.
+    # Запросов всегда три, все к catalog_read_model: страница (с версиями) и два фасета.
+    sort = request.args.get('sort', 'release_date_desc')
+    if sort not in ALBUM_BROWSE_SORTS:
+        raise ValueError('Invalid sort')
+    key_expr, direction, key_type = ALBUM_BROWSE_SORTS[sort]
+    limit = request.args.get('limit', ALBUM_BROWSE_DEFAULT_LIMIT, type=int)
+    limit = max(1, min(limit, ALBUM_BROWSE_MAX_LIMIT))
+
+    clauses, params = album_browse_filters()
+
+    cursor = request.args.get('cursor')
+    if cursor:
+        values = decode_cursor(cursor)
+        if len(values) != 3 or values[0] != sort:
+            raise InvalidCursor('Cursor does not match sort')
+        # Ключ приводится здесь: неразбираемое значение - 400, а не ошибка БД
+        try:
+            key_values = [key_type(values[1]), int(values[2])]
+        except (TypeError, ValueError, ArithmeticError) as e:
+            raise InvalidCursor('Invalid cursor') from e
+        comparison = '<' if direction == 'DESC' else '>'
+        clauses.append(f'({key_expr}, a.id) {comparison} (%s, %s)')
+        params.extend(key_values)
+
+    cur.execute(f'''
+        SELECT a.id, a.artist, a.title, a.base_price,
+               a.main_image_url, a.status, a.release_date, a.is_preorder,
+               a.artist_id, a.category, a.min_price, a.max_price,
+               a.discount::text AS discount, a.versions::text AS versions,
+               {key_expr} AS _sort_key
+        FROM catalog_read_model a
+        WHERE {' AND '.join(clauses)}
+        ORDER BY {key_expr} {direction}, a.id {direction}
+        LIMIT %s
+    ''', params + [limit + 1])
+    albums = [decode_row(album) for album in cur.fetchall()]
+
+    next_cursor = None
+    if len(albums) > limit:
+        albums = albums[:limit]
+        last = albums[-1]
+        next_cursor = encode_cursor(sort, last['_sort_key'], last['id'])
+    for album in albums:
+        album.pop('_sort_key')
+
+    in_stock_only = bool(parse_bool_arg('in_stock'))
+    for album in albums:
+        album['versions'] = [
+            pick(version, CATALOG_VERSION_KEYS) for version in album['versions']
+            if not in_stock_only or version['stock_quantity'] > 0
+        ]
+
+    facets = {}
+    for facet, column in (('category', 'a.category'), ('status', 'a.status')):
+        facet_clauses, facet_params = album_browse_filters(skip=facet)
+        where = f"WHERE {' AND '.join(facet_clauses)}" if facet_clauses else ''
+        cur.execute(f'''
+            SELECT {column} AS value, COUNT(*) AS count
+            FROM catalog_read_model a
+            {where}
+            GROUP BY {column}
+        ''', facet_params)
+        facets[facet] = {row['value']: row['count'] for row in cur.fetchall()}
+
+    return {
+        'albums': albums,
+        'facets': facets,
+        'next_cursor': next_cursor,
+        'limit': limit
+    }
+
 # Список всех альбомов с версиями (кроме отсутствующих).
+# С параметрами фильтрации/пагинации - страница каталога с фасетами.
 @app.route('/api/albums', methods=['GET'])
+@conditional_response
+@cached_response('albums')
 def get_albums(): # Возвращает список всех доступных альбомов с их версиями
     conn = get_db_connection()
     cur = conn.cursor(cursor_factory=RealDictCursor)
+
+    if ALBUM_BROWSE_PARAMS.intersection(request.args):
+        try:
+            return jsonify(browse_albums(cur))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        finally:
+            cur.close()
+            conn.close()
      
       # Основной запрос альбомов
     cur.execute('''
-        SELECT a.id, ar.name as artist, a.title, a.base_price, 
-               a.main_image_url, a.status, a.release_date
-        FROM albums a
-        JOIN artists ar ON a.artist_id = ar.id
-        WHERE a.status != 'out_of_stock'
-        ORDER BY a.release_date DESC
+        SELECT id, artist, title, base_price, 
+               main_image_url, status, release_date, versions::text AS versions
+        FROM catalog_read_model
+        WHERE status != 'out_of_stock'
+        ORDER BY release_date DESC
     ''')
-    albums = cur.fetchall()
-    
-    # Добавляем информацию о версиях для каждого альбома
+    albums = [decode_row(album) for album in cur.fetchall()]
     
+    # Версии уже лежат в строке модели
     for album in albums:
-        cur.execute('''
-            SELECT id, version_name, price_diff, stock_quantity
-            FROM album_versions
-            WHERE album_id = %s
-        ''', (album['id'],))
-        album['versions'] = cur.fetchall()
+        album['versions'] = [pick(version, CATALOG_VERSION_KEYS) for version in album['versions']]
     
     cur.close()
     conn.close()
@@ -315,23 +1140,23 @@ def get_albums(): # Возвращает список всех доступны
 
 # Детальная информация об альбоме.
 @app.route('/api/albums/<int:album_id>', methods=['GET'])
+@conditional_response
+@cached_response('album:{album_id}')
 def get_album(album_id):
     conn = get_db_connection()
     cur = conn.cursor(cursor_factory=RealDictCursor)
     
-    cur.execute('''
-        SELECT a.*, ar.name as artist_name, ar.image_url as artist_image
-        FROM albums a
-        JOIN artists ar ON a.artist_id = ar.id
-        WHERE a.id = %s
+    cur.execute(f'''
+        SELECT {CATALOG_ALBUM_COLUMNS}
+        FROM catalog_read_model
+        WHERE id = %s
     ''', (album_id,))
-    album = cur.fetchone()
+    row = cur.fetchone()
     
-    if not album:
+    if not row:
         return jsonify({'message': 'Album not found!'}), 404
     
-    cur.execute('SELECT * FROM album_versions WHERE album_id = %s', (album_id,))
-    album['versions'] = cur.fetchall()
+    album = catalog_album(row)
     
     cur.close()
     conn.close()
@@ -339,12 +1164,13 @@ def get_album(album_id):
 
 # Список артистов по категории (female_group, male_group, solo).
 @app.route('/api/artists/<category>', methods=['GET'])
+@conditional_response
+@cached_response('artists')
 def get_artists_by_category(category):
     conn = get_db_connection()
     cur = conn.cursor(cursor_factory=RealDictCursor)
     
-    valid_categories = ['female_group', 'male_group', 'solo']
-    if category not in valid_categories:
+    if category not in ARTIST_CATEGORIES:
         return jsonify({'error': 'Invalid category'}), 400
     
     cur.execute('SELECT * FROM artists WHERE category = %s', (category,))
@@ -365,6 +1191,8 @@ def get_artist_categories():
 
 # Информация об артисте и его альбомах.
 @app.route('/api/artists/<int:artist_id>', methods=['GET'])
+@conditional_response
+@cached_response('artist:{artist_id}')
 def get_artist(artist_id):
     conn = get_db_connection()
     cur = conn.cursor(cursor_factory=RealDictCursor)
@@ -376,18 +1204,13 @@ def get_artist(artist_id):
         if not artist:
             return jsonify({'error': 'Artist not found'}), 404
             
-        cur.execute('''
-            SELECT a.*, ar.name as artist_name, ar.image_url as artist_image
-            FROM albums a
-            JOIN artists ar ON a.artist_id = ar.id
-            WHERE a.artist_id = %s
-            ORDER BY a.release_date DESC
+        cur.execute(f'''
+            SELECT {CATALOG_ALBUM_COLUMNS}
+            FROM catalog_read_model
+            WHERE artist_id = %s
+            ORDER BY release_date DESC
         ''', (artist_id,))
-        albums = cur.fetchall()
-        
-        for album in albums:
-            cur.execute('SELECT * FROM album_versions WHERE album_id = %s', (album['id'],))
-            album['versions'] = cur.fetchall()
+        albums = [catalog_album(row) for row in cur.fetchall()]
         
         return jsonify({
             'artist': artist,
@@ -430,23 +1253,20 @@ def get_artist_albums(artist_id):
 
         # Основной запрос
         cur.execute(f'''
-            SELECT a.*, ar.name as artist_name
-            FROM albums a
-            JOIN artists ar ON a.artist_id = ar.id
+            SELECT a.artist, a.album::text AS album, a.versions::text AS versions
+            FROM catalog_read_model a
             WHERE a.artist_id = %s
             ORDER BY {order_by}
             LIMIT %s OFFSET %s
         ''', (artist_id, limit, offset))
-        albums = cur.fetchall()
-        
-        # Версии альбомов
-        for album in albums:
-            cur.execute('''
-                SELECT id, version_name, price_diff, stock_quantity
-                FROM album_versions
-                WHERE album_id = %s
-            ''', (album['id'],))
-            album['versions'] = cur.fetchall()
+        albums = []
+        for row in cur.fetchall():
+            row = decode_row(row)
+            albums.append({
+                **row['album'],
+                'artist_name': row['artist'],
+                'versions': [pick(version, CATALOG_VERSION_KEYS) for version in row['versions']]
+            })
         
         return jsonify({
             'albums': albums
@@ -462,42 +1282,116 @@ def get_artist_albums(artist_id):
 
 # ---- СКИДКИ ---- 
 
+# Индекс действующих скидок в памяти (discounts.py): цены в корзине и при оформлении
+# заказа берут скидку из словаря, а не из JOIN с album_discounts / discounts
+app.config['DISCOUNT_INDEX_REFRESH_INTERVAL'] = 300 # Полная перезагрузка на случай потерянных NOTIFY, сек
+
+_discount_index = None
+_discount_index_lock = threading.Lock()
+
+def get_discount_index():
+    # Индекс загружается один раз в каждом процессе; изменения скидок приходят через NOTIFY каталога
+    global _discount_index
+    if _discount_index is None or _discount_index.pid != os.getpid():
+        get_pg_listener() # До блокировки: слушатель сам создает индекс при запуске
+        with _discount_index_lock:
+            if _discount_index is None or _discount_index.pid != os.getpid():
+                index = DiscountIndex(
+                    lambda: get_db_pool().getconn(),
+                    app.config['DISCOUNT_INDEX_REFRESH_INTERVAL'],
+                    on_discount_refresh
+                )
+                index.load()
+                index.start()
+                _discount_index = index
+    return _discount_index
+
+def on_discount_refresh():
+    # Началась или закончилась скидка - пересчитываем строки модели каталога с наступившей границей.
+    # Из нескольких процессов строку пересчитает один (SKIP LOCKED), остальные ее пропустят.
+    conn = get_db_pool().getconn()
+    try:
+        album_ids = refresh_due(conn)
+        if album_ids:
+            with conn.cursor() as cur:
+                cur.execute('SELECT id, artist_id FROM catalog_read_model WHERE id = ANY(%s)', (album_ids,))
+                on_display_stock_change(conn, cur.fetchall())
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+def reload_discount_index():
+    # Только если индекс уже загружен в этом процессе
+    index = _discount_index
+    if index is not None and index.pid == os.getpid():
+        index.request_reload()
+
 
 # Активные скидки для альбома       
 @app.route('/api/albums/<int:album_id>/discounts', methods=['GET'])
 def get_album_discounts(album_id):
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    
     try:
-        # Получаем активные скидки для альбома
-        cur.execute('''
-            SELECT d.* 
-            FROM discounts d
-            JOIN album_discounts ad ON d.id = ad.discount_id
-            WHERE ad.album_id = %s 
-            AND d.is_active = TRUE
-            AND d.start_date <= NOW() 
-            AND d.end_date >= NOW()
-        ''', (album_id,))
-        
-        discounts = cur.fetchall()
-        return jsonify(discounts)
+        # Активные скидки альбома из индекса в памяти, без обращения к БД
+        return jsonify(get_discount_index().active(album_id))
         
     except Exception as e:
         app.logger.error(f"Get album discounts error: {str(e)}")
         return jsonify({'message': str(e)}), 500
-    finally:
-        cur.close()
-        conn.close()        
  
 
 # ---- КОРЗИНА ----  
   
 
 # Получить содержимое корзины текущего пользователя.| Добавить товар в корзину или увеличить количество.
+CART_ITEMS_SQL = '''
+    SELECT 
+        ci.id,
+        ci.quantity,
+        ci.cart_id,
+        av.id AS version_id, 
+        av.version_name,
+        a.id AS album_id, 
+        a.title AS album_title, 
+        (a.base_price + av.price_diff) AS base_price,
+        a.main_image_url
+    FROM cart_items ci
+    JOIN album_versions av ON ci.album_version_id = av.id
+    JOIN albums a ON av.album_id = a.id
+    JOIN cart c ON ci.cart_id = c.id
+    WHERE c.user_id = %s
+    ORDER BY ci.id
+'''
+
+def cart_payload(items):
+    # Одна эффективная скидка на альбом из индекса; цена округляется как при оформлении
+    discount_index = get_discount_index()
+    for item in items:
+        discount = discount_index.effective(item['album_id'])
+        item['final_price'] = discounted_price(item['base_price'], discount)
+        item['discount_id'] = discount['id'] if discount else None
+        item['discount_percent'] = discount['discount_percent'] if discount else None
+        item['discount_name'] = discount['name'] if discount else None
+
+    # Рассчитываем итоги
+    base_total = sum(float(item['base_price']) * int(item['quantity']) for item in items)
+    final_total = sum(float(item['final_price']) * int(item['quantity']) for item in items)
+
+    return {
+        'items': items,
+        'totals': {
+            'base_total': round(base_total, 2),
+            'final_total': round(final_total, 2),
+            'total_discount': round(base_total - final_total, 2)
+        },
+        'cart_id': items[0]['cart_id'] if items else None
+    }
+
 @app.route('/api/cart', methods=['GET', 'POST'])
 @jwt_required()
+@admission_controlled('cart')
 def cart_operations():
     # Получаем ID пользователя из JWT токена
     user_id = get_jwt_identity()  # Это будет строка или число, а не словарь
@@ -505,53 +1399,10 @@ def cart_operations():
     cur = conn.cursor(cursor_factory=RealDictCursor)
 
     try:
-        # Проверяем существование пользователя
-        cur.execute('SELECT id FROM users WHERE id = %s', (user_id,))
-        if not cur.fetchone():
-            return jsonify({'message': 'User not found!'}), 404
-
+        # Существование пользователя уже проверено вместе с токеном (is_token_revoked)
         if request.method == 'GET':
-            cur.execute('''
-            SELECT 
-                ci.id,
-                ci.quantity,
-                ci.cart_id,
-                av.id AS version_id, 
-                av.version_name,
-                a.id AS album_id, 
-                a.title AS album_title, 
-                (a.base_price + av.price_diff) AS base_price,
-                (a.base_price + av.price_diff) * (1 - COALESCE(d.discount_percent, 0) / 100.0) AS final_price,
-                a.main_image_url,
-                d.id AS discount_id,
-                d.discount_percent,
-                d.name AS discount_name
-            FROM cart_items ci
-            JOIN album_versions av ON ci.album_version_id = av.id
-            JOIN albums a ON av.album_id = a.id
-            JOIN cart c ON ci.cart_id = c.id
-            LEFT JOIN album_discounts ad ON a.id = ad.album_id
-            LEFT JOIN discounts d ON ad.discount_id = d.id 
-                AND d.is_active = true 
-                AND CURRENT_TIMESTAMP BETWEEN d.start_date AND d.end_date
-            WHERE c.user_id = %s
-        ''', (user_id,))
-        
-            items = cur.fetchall()
-        
-            # Рассчитываем итоги
-            base_total = sum(float(item['base_price']) * int(item['quantity']) for item in items)
-            final_total = sum(float(item['final_price']) * int(item['quantity']) for item in items)
-        
-            return jsonify({
-                'items': items,
-             'totals': {
-                    'base_total': round(base_total, 2),
-                  'final_total': round(final_total, 2),
-                  'total_discount': round(base_total - final_total, 2)
-                },
-                'cart_id': items[0]['cart_id'] if items else None
-            })
+            cur.execute(CART_ITEMS_SQL, (user_id,))
+            return jsonify(cart_payload(cur.fetchall()))
 
         elif request.method == 'POST':
             data = request.get_json()
@@ -561,8 +1412,9 @@ def cart_operations():
                     'received_data': data
                 }), 400
 
-            # Получаем или создаем корзину
-            cur.execute('SELECT id FROM cart WHERE user_id = %s', (user_id,))
+            # Получаем или создаем корзину. Блокировка - та же, что при оформлении заказа:
+            # пока заказ оформляется, корзина не меняется
+            cur.execute('SELECT id FROM cart WHERE user_id = %s FOR UPDATE', (user_id,))
             cart = cur.fetchone()
             
             if not cart:
@@ -614,16 +1466,13 @@ def remove_from_cart(item_id):
     cur = conn.cursor(cursor_factory=RealDictCursor)  
     
     try:
-        # 1. Проверяем существование пользователя
-        cur.execute('SELECT id FROM users WHERE id = %s', (user_id,))
-        if not cur.fetchone():
-            return jsonify({'message': 'User not found!'}), 404
-
+        # 1. Существование пользователя уже проверено вместе с токеном (is_token_revoked)
         # 2. Удаляем товар только если он принадлежит текущему пользователю
+        #    (корзина блокируется, как при оформлении заказа)
         cur.execute('''
             DELETE FROM cart_items 
             WHERE id = %s AND cart_id IN (
-                SELECT id FROM cart WHERE user_id = %s
+                SELECT id FROM cart WHERE user_id = %s FOR UPDATE
             )
             RETURNING *
         ''', (item_id, user_id))
@@ -661,84 +1510,177 @@ def remove_from_cart(item_id):
 
 # ---- Оформление заказа ----
 
+# Резервирование остатков (inventory.py)
+app.config['INVENTORY_STRIPES'] = 8 # Корзин-счетчиков на лимитированную версию
+app.config['INVENTORY_TRACK_ALL'] = False # Резервировать остатки и нелимитированных версий
+app.config['INVENTORY_SYNC_INTERVAL'] = 5 # Как часто витринный остаток догоняет корзины, сек
+
+_stock_sync = None
+_stock_sync_lock = threading.Lock()
+
+def on_display_stock_change(conn, albums):
+    # Витринный остаток виден в каталоге - сбрасываем кэш затронутых альбомов
+    tags = ['albums']
+    for album_id, artist_id in albums:
+        tags += [f'album:{album_id}', f'artist:{artist_id}']
+    with conn.cursor() as cur:
+        invalidate_catalog(cur, *tags)
+
+def get_stock_sync():
+    # Синхронизация витринных остатков запускается один раз в каждом процессе
+    global _stock_sync
+    if _stock_sync is None or _stock_sync.pid != os.getpid():
+        with _stock_sync_lock:
+            if _stock_sync is None or _stock_sync.pid != os.getpid():
+                sync = StockSync(
+                    lambda: get_db_pool().getconn(),
+                    app.config['INVENTORY_SYNC_INTERVAL'],
+                    on_display_stock_change
+                )
+                sync.start()
+                _stock_sync = sync
+    return _stock_sync
+
+# Перенос приращений продаж (sales_delta) в дневные агрегаты (analytics.py)
+app.config['SALES_FOLD_INTERVAL'] = 5 # Как часто приращения переносятся в sales_daily, сек
+app.config['SALES_FOLD_BATCH'] = 10000 # Строк приращений за одну транзакцию
+
+_sales_fold = None
+_sales_fold_lock = threading.Lock()
+
+def get_sales_fold():
+    # Перенос запускается один раз в каждом процессе; работает из них только один
+    global _sales_fold
+    if _sales_fold is None or _sales_fold.pid != os.getpid():
+        with _sales_fold_lock:
+            if _sales_fold is None or _sales_fold.pid != os.getpid():
+                fold = SalesDeltaFold(
+                    lambda: get_db_pool().getconn(),
+                    app.config['SALES_FOLD_INTERVAL'],
+                    app.config['SALES_FOLD_BATCH']
+                )
+                fold.start()
+                _sales_fold = fold
+    return _sales_fold
+
 # Добавить содершимое корзины в заказ.
 @app.route('/api/orders', methods=['POST'])
 @jwt_required()
+@admission_controlled('checkout')
 def create_order():
     user_id = get_jwt_identity()
     conn = get_db_connection()
     cur = conn.cursor(cursor_factory=RealDictCursor)
 
     try:
-        # 1. Получаем содержимое корзины с учетом скидок
+        get_stock_sync()
+        get_sales_fold()
+        # Блокировка корзины до конца транзакции: изменения корзины (cart_operations,
+        # remove_from_cart) ждут оформления, поэтому резервирование и заказ видят одни и те же строки
+        cur.execute('SELECT id FROM cart WHERE user_id = %s FOR UPDATE', (user_id,))
+        if not cur.fetchone():
+            conn.rollback()
+            return jsonify({'message': 'Cart is empty'}), 400
+
+        # Резервирование остатков в той же транзакции: при нехватке заказ не создается
+        shortfalls = reserve_cart(
+            conn, user_id, app.config['INVENTORY_STRIPES'], app.config['INVENTORY_TRACK_ALL']
+        )
+        if shortfalls:
+            conn.rollback()
+            return jsonify({'message': 'Not enough stock', 'shortfalls': shortfalls}), 409
+
+        # Строки корзины и их альбомы: в запрос передаются скидки только этих альбомов.
+        # stock_changed - остаток списан прямо в album_versions (версия без корзин)
         cur.execute('''
-            SELECT 
-                ci.quantity,
-                av.id as version_id,
-                av.version_name,
-                (a.base_price + av.price_diff) as base_price,
-                (a.base_price + av.price_diff) * (1 - COALESCE(d.discount_percent, 0)/100) as final_price,
-                d.discount_percent
+            SELECT ci.id, av.album_id, a.artist_id,
+                   (av.is_limited OR %s) AND NOT EXISTS (
+                       SELECT 1 FROM inventory_buckets b WHERE b.album_version_id = av.id
+                   ) AS stock_changed
             FROM cart_items ci
+            JOIN cart c ON ci.cart_id = c.id
             JOIN album_versions av ON ci.album_version_id = av.id
             JOIN albums a ON av.album_id = a.id
-            JOIN cart c ON ci.cart_id = c.id
-            LEFT JOIN album_discounts ad ON a.id = ad.album_id
-            LEFT JOIN discounts d ON ad.discount_id = d.id 
-                AND d.is_active = true 
-                AND CURRENT_TIMESTAMP BETWEEN d.start_date AND d.end_date
             WHERE c.user_id = %s
-        ''', (user_id,))
-        
-        cart_items = cur.fetchall()
-        
-        if not cart_items:
+        ''', (app.config['INVENTORY_TRACK_ALL'], user_id))
+        cart_lines = cur.fetchall()
+        if not cart_lines:
+            conn.rollback()
             return jsonify({'message': 'Cart is empty'}), 400
+        discounts = get_discount_index().effective_percents({line['album_id'] for line in cart_lines})
 
-        # 2. Рассчитываем итоговую сумму со скидкой
-        total_amount = sum(float(item['final_price']) * int(item['quantity']) for item in cart_items)
-
-        # 3. Создаем заказ
+        # Оформление одним запросом: строки корзины с ценой по скидке -> заказ -> товары заказа
+        # -> очистка корзины. Суммы считаются в numeric без округлений float, цена за единицу
+        # округляется до копеек, итог - сумма строк. Число обращений к БД не зависит от размера корзины.
         cur.execute('''
-            INSERT INTO orders (user_id, total_amount, status)
-            VALUES (%s, %s, 'created')
-            RETURNING id
-        ''', (user_id, total_amount))
+            WITH lines AS (
+                SELECT
+                    ci.id AS cart_item_id,
+                    ci.quantity,
+                    av.id AS version_id,
+                    av.version_name,
+                    a.base_price + av.price_diff AS list_price,
+                    ROUND((a.base_price + av.price_diff) * (1 - COALESCE(d.discount_percent, 0) / 100.0), 2) AS final_price,
+                    d.discount_percent
+                FROM cart_items ci
+                JOIN cart c ON ci.cart_id = c.id
+                JOIN album_versions av ON ci.album_version_id = av.id
+                JOIN albums a ON av.album_id = a.id
+                -- Эффективные скидки альбомов корзины (одна на альбом) передаются из индекса массивами
+                LEFT JOIN unnest(%(discount_album_ids)s::int[], %(discount_percents)s::numeric[])
+                    AS d(album_id, discount_percent) ON d.album_id = a.id
+                WHERE c.user_id = %(user_id)s
+                  AND ci.id = ANY(%(cart_item_ids)s)
+            ),
+            new_order AS (
+                INSERT INTO orders (user_id, total_amount, status)
+                SELECT %(user_id)s, SUM(final_price * quantity), 'created'
+                FROM lines
+                HAVING COUNT(*) > 0
+                RETURNING id, total_amount
+            ),
+            new_items AS (
+                INSERT INTO order_items (order_id, album_version_id, quantity, price_per_unit, version_name, list_price)
+                SELECT new_order.id, lines.version_id, lines.quantity, lines.final_price, lines.version_name, lines.list_price
+                FROM new_order, lines
+            ),
+            cleared AS (
+                -- Удаляются только оформленные строки
+                DELETE FROM cart_items
+                WHERE id IN (SELECT cart_item_id FROM lines)
+                  AND EXISTS (SELECT 1 FROM new_order)
+            )
+            SELECT
+                new_order.id AS order_id,
+                new_order.total_amount,
+                EXISTS (SELECT 1 FROM lines WHERE COALESCE(discount_percent, 0) > 0) AS discount_applied
+            FROM new_order
+        ''', {
+            'user_id': user_id,
+            'cart_item_ids': [line['id'] for line in cart_lines],
+            'discount_album_ids': list(discounts),
+            'discount_percents': list(discounts.values())
+        })
         
-        order_id = cur.fetchone()['id']
-
-        # 4. Добавляем товары в заказ (фиксируем цену со скидкой)
-        for item in cart_items:
-            cur.execute('''
-                INSERT INTO order_items (
-                    order_id, 
-                    album_version_id, 
-                    quantity, 
-                    price_per_unit,
-                    version_name
-                )
-                VALUES (%s, %s, %s, %s, %s)
-            ''', (
-                order_id,
-                item['version_id'],
-                item['quantity'],
-                item['final_price'],  # Записываем цену со скидкой
-                item['version_name']
-            ))
+        order = cur.fetchone()
+        
+        if not order:
+            conn.rollback()
+            return jsonify({'message': 'Cart is empty'}), 400
 
-        # 5. Очищаем корзину
-        cur.execute('''
-            DELETE FROM cart_items 
-            WHERE cart_id IN (SELECT id FROM cart WHERE user_id = %s)
-        ''', (user_id,))
+        # Остаток версий без корзин уже изменился - сбрасываем кэш их альбомов (NOTIFY уйдет при коммите).
+        # Версии в корзинах обновит StockSync
+        restocked = {(line['album_id'], line['artist_id']) for line in cart_lines if line['stock_changed']}
+        if restocked:
+            on_display_stock_change(conn, sorted(restocked))
         
         conn.commit()
 
         return jsonify({
             'message': 'Order created successfully',
-            'order_id': order_id,
-            'total_amount': total_amount,
-            'discount_applied': any(item['discount_percent'] for item in cart_items)
+            'order_id': order['order_id'],
+            'total_amount': float(order['total_amount']),
+            'discount_applied': order['discount_applied']
         }), 201
 
     except Exception as e:
@@ -751,6 +1693,21 @@ def create_order():
 
 # ---- История заказов ----
 
+MAX_PER_PAGE = 100
+app.config['EXACT_COUNT_THRESHOLD'] = 10000 # Больше строк - total по оценке планировщика
+
+def pagination_args():
+    # per_page, курсор и (для старого режима ?page=N) смещение
+    per_page = min(max(request.args.get('per_page', 10, type=int), 1), MAX_PER_PAGE)
+    cursor = request.args.get('cursor')
+    page = max(request.args.get('page', 1, type=int), 1)
+    offset = (page - 1) * per_page if 'page' in request.args and not cursor else None
+    return per_page, cursor, offset, page
+
+USER_ORDERS_SELECT = 'SELECT o.* FROM orders o'
+USER_ORDERS_KEY = (('o.created_at', 'o.id'), ('created_at', 'id'))
+USER_ORDER_COUNT_SQL = 'SELECT order_count FROM user_order_stats WHERE user_id = %s'
+
 # Получить список заказов текущего пользователя
 @app.route('/api/orders', methods=['GET'])
 @jwt_required()
@@ -760,49 +1717,34 @@ def get_user_orders():
     cur = conn.cursor(cursor_factory=RealDictCursor)
     
     try:
-        # Получаем параметры пагинации
-        page = request.args.get('page', 1, type=int)
-        per_page = request.args.get('per_page', 10, type=int)
-        offset = (page - 1) * per_page
+        # Параметры пагинации: курсор (next_cursor / prev_cursor) или старый ?page=N
+        per_page, cursor, offset, page = pagination_args()
         
-        # Основной запрос заказов пользователя
-        cur.execute('''
-            SELECT o.*
-            FROM orders o
-            WHERE o.user_id = %s
-            ORDER BY o.created_at DESC
-            LIMIT %s OFFSET %s
-        ''', (user_id, per_page, offset))
-        orders = cur.fetchall()
+        # Основной запрос заказов пользователя (индекс idx_orders_user_created)
+        orders, next_cursor, prev_cursor = keyset_page(
+            cur, USER_ORDERS_SELECT, ['o.user_id = %s'], [user_id],
+            *USER_ORDERS_KEY, per_page, cursor, offset
+        )
         
-        # Получаем товары для каждого заказа
-        for order in orders:
-            cur.execute('''
-                SELECT 
-                    oi.*, 
-                    av.version_name,
-                    a.title as album_title, 
-                    a.main_image_url,
-                    ar.name as artist_name
-                FROM order_items oi
-                JOIN album_versions av ON oi.album_version_id = av.id
-                JOIN albums a ON av.album_id = a.id
-                JOIN artists ar ON a.artist_id = ar.id
-                WHERE oi.order_id = %s
-            ''', (order['id'],))
-            order['items'] = cur.fetchall()
+        # Получаем товары для всех заказов страницы одним запросом
+        attach_order_items(cur, orders)
         
-        # Получаем общее количество заказов пользователя
-        cur.execute('SELECT COUNT(*) FROM orders WHERE user_id = %s', (user_id,))
-        total_orders = cur.fetchone()['count']
+        # Количество заказов поддерживается триггером, пересчитывать orders не нужно
+        cur.execute(USER_ORDER_COUNT_SQL, (user_id,))
+        stats = cur.fetchone()
+        total_orders = stats['order_count'] if stats else 0
         
         return jsonify({
             'orders': orders,
             'total': total_orders,
             'page': page,
-            'per_page': per_page
+            'per_page': per_page,
+            'next_cursor': next_cursor,
+            'prev_cursor': prev_cursor
         })
         
+    except InvalidCursor as e:
+        return jsonify({'message': str(e)}), 400
     except Exception as e:
         app.logger.error(f"Get user orders error: {str(e)}")
         return jsonify({'message': str(e)}), 500
@@ -810,6 +1752,26 @@ def get_user_orders():
         cur.close()
         conn.close()
 
+USER_ORDER_SQL = '''
+    SELECT o.*
+    FROM orders o
+    WHERE o.id = %s AND o.user_id = %s
+'''
+
+USER_ORDER_ITEMS_SQL = '''
+    SELECT 
+        oi.*, 
+        av.version_name,
+        a.title as album_title, 
+        a.main_image_url,
+        ar.name as artist_name
+    FROM order_items oi
+    JOIN album_versions av ON oi.album_version_id = av.id
+    JOIN albums a ON av.album_id = a.id
+    JOIN artists ar ON a.artist_id = ar.id
+    WHERE oi.order_id = %s
+'''
+
 # Получить детальную информацию о заказе пользователя
 @app.route('/api/orders/<int:order_id>', methods=['GET'])
 @jwt_required()
@@ -820,30 +1782,14 @@ def get_user_order(order_id):
     
     try:
         # Проверяем, что заказ принадлежит пользователю
-        cur.execute('''
-            SELECT o.*
-            FROM orders o
-            WHERE o.id = %s AND o.user_id = %s
-        ''', (order_id, user_id))
+        cur.execute(USER_ORDER_SQL, (order_id, user_id))
         order = cur.fetchone()
         
         if not order:
             return jsonify({'message': 'Order not found or access denied'}), 404
         
         # Получаем товары в заказе
-        cur.execute('''
-            SELECT 
-                oi.*, 
-                av.version_name,
-                a.title as album_title, 
-                a.main_image_url,
-                ar.name as artist_name
-            FROM order_items oi
-            JOIN album_versions av ON oi.album_version_id = av.id
-            JOIN albums a ON av.album_id = a.id
-            JOIN artists ar ON a.artist_id = ar.id
-            WHERE oi.order_id = %s
-        ''', (order_id,))
+        cur.execute(USER_ORDER_ITEMS_SQL, (order_id,))
         order['items'] = cur.fetchall()
         
         return jsonify(order)
@@ -894,6 +1840,7 @@ def admin_artists(): # Управление артистами: GET - списо
                 (data['name'], data['category'], data.get('description'), data.get('image_url'))
             )
             new_artist = cur.fetchone()
+            invalidate_catalog(cur, 'artists')
             conn.commit()
             return jsonify(new_artist), 201
             
@@ -932,10 +1879,16 @@ def admin_artist(id):
                 (data['name'], data['category'], data.get('description'), data.get('image_url'), id)
             )
             updated_artist = cur.fetchone()
-            conn.commit()
             
             if not updated_artist:
+                conn.rollback()
                 return jsonify({'message': 'Artist not found'}), 404
+            
+            # Имя и фото артиста входят в ответы по его альбомам
+            cur.execute('SELECT id FROM albums WHERE artist_id = %s', (id,))
+            album_tags = [f"album:{row['id']}" for row in cur.fetchall()]
+            invalidate_catalog(cur, 'artists', 'albums', f'artist:{id}', *album_tags)
+            conn.commit()
                 
             return jsonify(updated_artist)
             
@@ -956,12 +1909,14 @@ def delete_artist(id):
     cur = conn.cursor()
     
     try:
-        # Сначала удаляем все альбомы артиста (и их версии)
         cur.execute('SELECT id FROM albums WHERE artist_id = %s', (id,))
         album_ids = [row[0] for row in cur.fetchall()]
         
-        for album_id in album_ids:
-            cur.execute('DELETE FROM album_versions WHERE album_id = %s', (album_id,))
+        # Сначала удаляем все альбомы артиста (и их версии)
+        cur.execute('''
+            DELETE FROM album_versions
+            WHERE album_id IN (SELECT id FROM albums WHERE artist_id = %s)
+        ''', (id,))
         
         cur.execute('DELETE FROM albums WHERE artist_id = %s', (id,))
         
@@ -972,7 +1927,12 @@ def delete_artist(id):
         if not deleted:
             conn.rollback()
             return jsonify({'message': 'Artist not found'}), 404
-            
+        
+        invalidate_catalog(
+            cur, 'artists', 'albums', f'artist:{id}',
+            *[f'album:{album_id}' for album_id in album_ids],
+            *[f'discounts:{album_id}' for album_id in album_ids]
+        )
         conn.commit()
         return jsonify({'message': 'Artist and all related albums deleted successfully'}), 200
         
@@ -987,6 +1947,97 @@ def delete_artist(id):
 
 # ---- АЛЬБОМЫ ----
 
+# Редактируемые поля версии в порядке колонок album_versions
+VERSION_FIELDS = ('version_name', 'price_diff', 'packaging_details', 'stock_quantity', 'is_limited')
+
+def version_values(version):
+    # Значения полей версии из запроса, приведенные к типам колонок
+    return (
+        version.get('version_name', ''),
+        Decimal(str(version.get('price_diff', 0))),
+        version.get('packaging_details', ''),
+        int(version.get('stock_quantity', 0)),
+        bool(version.get('is_limited', False))
+    )
+
+def insert_album_versions(cur, album_id, versions):
+    # Все новые версии одним INSERT
+    if not versions:
+        return []
+    return execute_values(cur, f'''
+        INSERT INTO album_versions (album_id, {', '.join(VERSION_FIELDS)})
+        VALUES %s
+        RETURNING id
+    ''', [(album_id, *version_values(version)) for version in versions], fetch=True)
+
+def stock_set_explicitly(version):
+    # Если клиент прислал original_stock_quantity (остаток, который он загрузил), остаток меняется,
+    # только когда stock_quantity от него отличается: иначе присланное значение - устаревшая
+    # витрина, продажи после загрузки формы уже уменьшили остаток в БД.
+    # Без original_stock_quantity присланный stock_quantity задает остаток, как и раньше.
+    if 'original_stock_quantity' not in version:
+        return 'stock_quantity' in version
+    return int(version.get('stock_quantity', 0)) != int(version['original_stock_quantity'])
+
+def save_album_versions(cur, album_id, versions):
+    # Сравнивает присланные версии с текущими: измененные обновляются на месте (id не меняются,
+    # строки корзин остаются рабочими), новые (без id) вставляются одним запросом,
+    # отсутствующие в запросе удаляются. Возвращает id версий, у которых менялся остаток.
+    cur.execute(f'''
+        SELECT id, {', '.join(VERSION_FIELDS)}
+        FROM album_versions
+        WHERE album_id = %s
+        FOR UPDATE
+    ''', (album_id,))
+    existing = {row['id']: tuple(row[field] for field in VERSION_FIELDS) for row in cur.fetchall()}
+
+    stock_index = VERSION_FIELDS.index('stock_quantity')
+    changed, new, kept = [], [], set()
+    for version in versions:
+        if version.get('id') is None:
+            new.append(version)
+            continue
+        version_id = int(version['id'])
+        if version_id not in existing:
+            raise ValueError(f'Version {version_id} does not belong to album {album_id}')
+        kept.add(version_id)
+        values = version_values(version)
+        stock_set = stock_set_explicitly(version)
+        if not stock_set:
+            values = values[:stock_index] + (existing[version_id][stock_index],) + values[stock_index + 1:]
+        if values != existing[version_id]:
+            changed.append((version_id, *values, stock_set))
+
+    removed = [version_id for version_id in existing if version_id not in kept]
+    if removed:
+        # Удаленные версии больше нельзя купить - убираем их и из корзин
+        cur.execute('DELETE FROM cart_items WHERE album_version_id = ANY(%s)', (removed,))
+        cur.execute('DELETE FROM album_versions WHERE id = ANY(%s)', (removed,))
+
+    if changed:
+        # Без явной смены остатка stock_quantity не трогается; если у версии есть корзины
+        # резервирования, в него переносится их сумма - она точнее витринного значения
+        # и сохранится, если корзины пересоздаются из-за смены is_limited
+        execute_values(cur, f'''
+            UPDATE album_versions av SET
+                {', '.join(f'{field} = v.{field}' for field in VERSION_FIELDS if field != 'stock_quantity')},
+                stock_quantity = CASE WHEN v.stock_set THEN v.stock_quantity ELSE COALESCE(
+                    (SELECT SUM(b.quantity)::int FROM inventory_buckets b WHERE b.album_version_id = av.id),
+                    av.stock_quantity
+                ) END
+            FROM (VALUES %s) AS v(id, {', '.join(VERSION_FIELDS)}, stock_set)
+            WHERE av.id = v.id
+        ''', changed, template='(%s::int, %s, %s::numeric, %s, %s::int, %s::boolean, %s::boolean)')
+
+    insert_album_versions(cur, album_id, new)
+
+    # Остаток явно изменен или сменился признак лимитированности - корзины резервирования
+    # пересоздаются. Правка только названия, цены или описания корзины не трогает.
+    limited_index = VERSION_FIELDS.index('is_limited') + 1
+    return [
+        row[0] for row in changed
+        if row[-1] or row[limited_index] != existing[row[0]][limited_index - 1]
+    ]
 
 # Список всех альбомов с версиями. | Создать новый альбом с версиями.
 @app.route('/api/admin/albums', methods=['GET', 'POST'])
@@ -1005,10 +2056,7 @@ def admin_albums():
                 JOIN artists ar ON a.artist_id = ar.id
             ''')
             albums = cur.fetchall()
-            
-            for album in albums:
-                cur.execute('SELECT * FROM album_versions WHERE album_id = %s', (album['id'],))
-                album['versions'] = cur.fetchall()
+            attach_album_versions(cur, albums)
             
             return jsonify(albums)
         
@@ -1039,29 +2087,18 @@ def admin_albums():
             ))
             album_id = cur.fetchone()['id']
             
-            # Вставка версий (только существующие в БД поля)
-            for version in data.get('versions', []):
-                cur.execute('''
-                    INSERT INTO album_versions (
-                        album_id, version_name, price_diff, packaging_details,
-                        stock_quantity, is_limited
-                    )
-                    VALUES (%s, %s, %s, %s, %s, %s)
-                ''', (
-                    album_id,
-                    version.get('version_name', ''),
-                    float(version.get('price_diff', 0)),
-                    version.get('packaging_details', ''),
-                    int(version.get('stock_quantity', 0)),
-                    bool(version.get('is_limited', False))
-                ))
+            # Вставка версий одним запросом
+            insert_album_versions(cur, album_id, data.get('versions', []))
             
+            # Остаток лимитированных версий раскладывается по корзинам для резервирования
+            stripe_versions(conn, app.config['INVENTORY_STRIPES'], album_id)
+            invalidate_catalog(cur, 'albums', f"artist:{data['artist_id']}")
             conn.commit()
             
             # Возвращаем созданный альбом
             cur.execute('SELECT * FROM albums WHERE id = %s', (album_id,))
             album = cur.fetchone()
-            cur.execute('SELECT * FROM album_versions WHERE album_id = %s', (album_id,))
+            cur.execute('SELECT * FROM album_versions WHERE album_id = %s ORDER BY id', (album_id,))
             album['versions'] = cur.fetchall()
             
             return jsonify(album), 201
@@ -1096,7 +2133,7 @@ def admin_album(id):
             if not album:
                 return jsonify({'message': 'Album not found'}), 404
                 
-            cur.execute('SELECT * FROM album_versions WHERE album_id = %s', (id,))
+            cur.execute('SELECT * FROM album_versions WHERE album_id = %s ORDER BY id', (id,))
             album['versions'] = cur.fetchall()
             
             return jsonify(album)
@@ -1108,6 +2145,10 @@ def admin_album(id):
             if not data or 'artist_id' not in data or 'title' not in data or 'base_price' not in data:
                 return jsonify({'message': 'Missing required fields'}), 400
                 
+            # Прежний артист: альбом пропадает из его карточки
+            cur.execute('SELECT artist_id FROM albums WHERE id = %s', (id,))
+            previous = cur.fetchone()
+            
             # Обновление альбома
             cur.execute('''
                 UPDATE albums SET
@@ -1137,29 +2178,24 @@ def admin_album(id):
             if not updated_album:
                 return jsonify({'message': 'Album not found'}), 404
                 
-            # Удаляем старые версии и добавляем новые
-            cur.execute('DELETE FROM album_versions WHERE album_id = %s', (id,))
-            
-            for version in data.get('versions', []):
-                cur.execute('''
-                    INSERT INTO album_versions (
-                        album_id, version_name, price_diff, packaging_details,
-                        stock_quantity, is_limited
-                    )
-                    VALUES (%s, %s, %s, %s, %s, %s)
-                ''', (
-                    id,
-                    version.get('version_name', ''),
-                    float(version.get('price_diff', 0)),
-                    version.get('packaging_details', ''),
-                    int(version.get('stock_quantity', 0)),
-                    bool(version.get('is_limited', False))
-                ))
-            
+            # Версии: обновление измененных, вставка новых, удаление убранных.
+            # Остаток меняется, если stock_quantity прислан без original_stock_quantity или отличается от него
+            try:
+                restock_ids = save_album_versions(cur, id, data.get('versions', []))
+            except ValueError as e:
+                conn.rollback()
+                return jsonify({'message': str(e)}), 400
+            
+            unstripe_versions(conn, restock_ids)
+            stripe_versions(conn, app.config['INVENTORY_STRIPES'], id)
+            invalidate_catalog(
+                cur, 'albums', f'album:{id}',
+                f"artist:{updated_album['artist_id']}", f"artist:{previous['artist_id']}"
+            )
             conn.commit()
             
             # Возвращаем обновленный альбом
-            cur.execute('SELECT * FROM album_versions WHERE album_id = %s', (id,))
+            cur.execute('SELECT * FROM album_versions WHERE album_id = %s ORDER BY id', (id,))
             updated_album['versions'] = cur.fetchall()
             
             return jsonify(updated_album)
@@ -1186,13 +2222,14 @@ def delete_album(id):
         cur.execute('DELETE FROM album_versions WHERE album_id = %s', (id,))
         
         # Удаляем сам альбом
-        cur.execute('DELETE FROM albums WHERE id = %s RETURNING id', (id,))
+        cur.execute('DELETE FROM albums WHERE id = %s RETURNING id, artist_id', (id,))
         deleted = cur.fetchone()
         
         if not deleted:
             conn.rollback()
             return jsonify({'message': 'Album not found'}), 404
-            
+        
+        invalidate_catalog(cur, 'albums', f'album:{id}', f'discounts:{id}', f'artist:{deleted[1]}')
         conn.commit()
         return jsonify({'message': 'Album and all versions deleted successfully'}), 200
         
@@ -1204,6 +2241,85 @@ def delete_album(id):
         cur.close()
         conn.close()
    
+
+# ---- МАССОВЫЙ ИМПОРТ ----
+
+# Импорт каталога из CSV / NDJSON (catalog_import.py)
+app.config['IMPORT_BATCH_SIZE'] = 10000 # Строк на один COPY
+app.config['IMPORT_MAX_REPORTED_ERRORS'] = 1000 # Больше ошибок в отчете не перечисляется
+
+IMPORT_MIMETYPES = {'text/csv': 'csv', 'application/x-ndjson': 'ndjson', 'application/jsonl': 'ndjson'}
+
+def finish_catalog_import(conn, restock_ids):
+    # В транзакции импорта: пересоздать корзины резервирования и сбросить кэш каталога
+    unstripe_versions(conn, restock_ids)
+    stripe_versions(conn, app.config['INVENTORY_STRIPES'])
+    with conn.cursor() as cur:
+        invalidate_catalog(cur, '*')
+
+def run_catalog_import(conn, stream, fmt, dry_run, on_error, progress):
+    return import_catalog(
+        conn, stream, fmt, ARTIST_CATEGORIES, ALBUM_STATUSES,
+        dry_run=dry_run,
+        on_error=on_error,
+        batch_size=app.config['IMPORT_BATCH_SIZE'],
+        max_reported_errors=app.config['IMPORT_MAX_REPORTED_ERRORS'],
+        progress=progress,
+        before_commit=finish_catalog_import
+    )
+
+# Импорт артистов, альбомов и версий. Тело - файл CSV / NDJSON (или multipart-поле file).
+# Параметры: format=csv|ndjson (иначе по Content-Type), dry_run=1, on_error=skip|abort.
+# Ответ - NDJSON: события прогресса, последней строкой - сводка с ошибками по строкам.
+@app.route('/api/admin/import', methods=['POST'])
+@jwt_required()
+@admin_required
+def import_catalog_endpoint():
+    upload = request.files.get('file')
+    fmt = request.args.get('format') or IMPORT_MIMETYPES.get(
+        upload.mimetype if upload else request.mimetype
+    )
+    if fmt not in IMPORT_FORMATS:
+        return jsonify({'message': 'format must be csv or ndjson'}), 400
+    on_error = request.args.get('on_error', 'skip')
+    if on_error not in ('skip', 'abort'):
+        return jsonify({'message': 'on_error must be skip or abort'}), 400
+    try:
+        dry_run = bool(parse_bool_arg('dry_run'))
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+
+    # Тело сохраняется во временный файл: импорт идет в фоне, пока клиенту отдается прогресс
+    spooled = tempfile.TemporaryFile()
+    shutil.copyfileobj(upload.stream if upload else request.stream, spooled)
+    spooled.seek(0)
+
+    events = queue.Queue()
+    conn = get_db_pool().getconn()
+
+    def run():
+        try:
+            summary = run_catalog_import(conn, spooled, fmt, dry_run, on_error, events.put)
+            events.put({'phase': 'summary', **summary})
+        except Exception as e:
+            app.logger.error(f"Catalog import error: {str(e)}", exc_info=True)
+            events.put({'phase': 'error', 'message': str(e)})
+        finally:
+            conn.close()
+            spooled.close()
+            events.put(None)
+
+    threading.Thread(target=run, name='catalog-import', daemon=True).start()
+
+    def generate():
+        while True:
+            event = events.get()
+            if event is None:
+                break
+            yield json.dumps(event) + '\n'
+
+    return Response(generate(), mimetype='application/x-ndjson')
+   
     
 # ---- СКИДКИ ----
 
@@ -1271,13 +2387,16 @@ def admin_discount(id):
             
             if not updated_discount:
                 return jsonify({'message': 'Discount not found'}), 404
-                
+            
+            cur.execute('SELECT album_id FROM album_discounts WHERE discount_id = %s', (id,))
+            invalidate_catalog(cur, *[f"discounts:{row['album_id']}" for row in cur.fetchall()])
             conn.commit()
             return jsonify(updated_discount)
             
         elif request.method == 'DELETE':
             # Сначала удаляем связи с альбомами
-            cur.execute('DELETE FROM album_discounts WHERE discount_id = %s', (id,))
+            cur.execute('DELETE FROM album_discounts WHERE discount_id = %s RETURNING album_id', (id,))
+            album_ids = [row['album_id'] for row in cur.fetchall()]
             
             # Затем удаляем саму скидку
             cur.execute('DELETE FROM discounts WHERE id = %s RETURNING id', (id,))
@@ -1285,7 +2404,8 @@ def admin_discount(id):
             
             if not deleted:
                 return jsonify({'message': 'Discount not found'}), 404
-                
+            
+            invalidate_catalog(cur, *[f'discounts:{album_id}' for album_id in album_ids])
             conn.commit()
             return jsonify({'message': 'Discount deleted successfully'}), 200
             
@@ -1341,6 +2461,7 @@ def discount_albums(discount_id):
                 VALUES (%s, %s)
             ''', (discount_id, data['album_id']))
             
+            invalidate_catalog(cur, f"discounts:{data['album_id']}")
             conn.commit()
             return jsonify({'message': 'Album added to discount'}), 201
             
@@ -1369,7 +2490,8 @@ def remove_album_from_discount(discount_id, album_id):
         
         if not cur.fetchone():
             return jsonify({'message': 'Album not found in discount'}), 404
-            
+        
+        invalidate_catalog(cur, f'discounts:{album_id}')
         conn.commit()
         return jsonify({'message': 'Album removed from discount'}), 200
         
@@ -1396,31 +2518,31 @@ def get_all_users():
     cur = conn.cursor(cursor_factory=RealDictCursor)
     
     try:
-        # Получаем параметры пагинации из запроса
-        page = request.args.get('page', 1, type=int)
-        per_page = request.args.get('per_page', 10, type=int)
-        offset = (page - 1) * per_page
-        
-        # Основной запрос пользователей
-        cur.execute('''
-            SELECT id, email, first_name, last_name, is_admin, is_active, created_at
-            FROM users
-            ORDER BY created_at DESC
-            LIMIT %s OFFSET %s
-        ''', (per_page, offset))
-        users = cur.fetchall()
+        # Параметры пагинации: курсор (next_cursor / prev_cursor) или старый ?page=N
+        per_page, cursor, offset, page = pagination_args()
+        
+        # Основной запрос пользователей (индекс idx_users_created)
+        users, next_cursor, prev_cursor = keyset_page(
+            cur,
+            'SELECT id, email, first_name, last_name, is_admin, is_active, created_at FROM users',
+            [], [], ('created_at', 'id'), ('created_at', 'id'), per_page, cursor, offset
+        )
         
-        # Получаем общее количество пользователей для пагинации
-        cur.execute('SELECT COUNT(*) FROM users')
-        total_users = cur.fetchone()['count']
+        # Общее количество: точное для небольшой таблицы, иначе оценка планировщика
+        total_users, total_is_estimate = estimated_count(cur, 'users', app.config['EXACT_COUNT_THRESHOLD'])
         
         return jsonify({
             'users': users,
             'total': total_users,
+            'total_is_estimate': total_is_estimate,
             'page': page,
-            'per_page': per_page
+            'per_page': per_page,
+            'next_cursor': next_cursor,
+            'prev_cursor': prev_cursor
         })
         
+    except InvalidCursor as e:
+        return jsonify({'message': str(e)}), 400
     except Exception as e:
         app.logger.error(f"Get all users error: {str(e)}")
         return jsonify({'message': str(e)}), 500
@@ -1462,6 +2584,8 @@ def get_user(user_id):
 @admin_required
 def update_user(user_id):
     data = request.get_json()
+    # Хеш - до соединения; очередь хеширования переполнена - 429
+    hashed_password = hash_password(data['password']) if isinstance(data, dict) and data.get('password') else None
     conn = get_db_connection()
     cur = conn.cursor(cursor_factory=RealDictCursor)
     
@@ -1495,8 +2619,7 @@ def update_user(user_id):
             update_fields.append("is_active = %s")
             update_values.append(data['is_active'])
             
-        if 'password' in data and data['password']:
-            hashed_password = generate_password_hash(data['password'])
+        if hashed_password is not None:
             update_fields.append("password_hash = %s")
             update_values.append(hashed_password)
         
@@ -1514,6 +2637,7 @@ def update_user(user_id):
         
         cur.execute(update_query, update_values)
         updated_user = cur.fetchone()
+        invalidate_user_state(cur, user_id)
         conn.commit()
         
         return jsonify(updated_user)
@@ -1554,6 +2678,7 @@ def delete_user(user_id):
         # Затем удаляем самого пользователя
         cur.execute('DELETE FROM users WHERE id = %s RETURNING id', (user_id,))
         deleted = cur.fetchone()
+        invalidate_user_state(cur, user_id)
         conn.commit()
         
         if not deleted:
@@ -1583,47 +2708,37 @@ def get_all_orders():
     cur = conn.cursor(cursor_factory=RealDictCursor)
     
     try:
-        # Получаем параметры пагинации
-        page = request.args.get('page', 1, type=int)
-        per_page = request.args.get('per_page', 10, type=int)
-        offset = (page - 1) * per_page
+        # Параметры пагинации: курсор (next_cursor / prev_cursor) или старый ?page=N
+        per_page, cursor, offset, page = pagination_args()
         
-        # Основной запрос заказов
-        cur.execute('''
+        # Основной запрос заказов (индекс idx_orders_created)
+        orders, next_cursor, prev_cursor = keyset_page(
+            cur, '''
     SELECT o.*, u.email as user_email, 
            CONCAT(u.first_name, ' ', u.last_name) as user_full_name
     FROM orders o
     JOIN users u ON o.user_id = u.id
-    LEFT JOIN user_addresses ua ON o.address_id = ua.id
-    ORDER BY o.created_at DESC
-    LIMIT %s OFFSET %s
-''', (per_page, offset))
-        orders = cur.fetchall()
+''', [], [], ('o.created_at', 'o.id'), ('created_at', 'id'), per_page, cursor, offset
+        )
         
-        # Получаем товары для каждого заказа
-        for order in orders:
-            cur.execute('''
-                SELECT oi.*, av.version_name as current_version_name,
-                       a.title as album_title, ar.name as artist_name
-                FROM order_items oi
-                JOIN album_versions av ON oi.album_version_id = av.id
-                JOIN albums a ON av.album_id = a.id
-                JOIN artists ar ON a.artist_id = ar.id
-                WHERE oi.order_id = %s
-            ''', (order['id'],))
-            order['items'] = cur.fetchall()
+        # Получаем товары для всех заказов страницы одним запросом
+        attach_order_items(cur, orders, ADMIN_ORDER_ITEM_COLUMNS)
         
-        # Получаем общее количество заказов
-        cur.execute('SELECT COUNT(*) FROM orders')
-        total_orders = cur.fetchone()['count']
+        # Общее количество: точное для небольшой таблицы, иначе оценка планировщика
+        total_orders, total_is_estimate = estimated_count(cur, 'orders', app.config['EXACT_COUNT_THRESHOLD'])
         
         return jsonify({
             'orders': orders,
             'total': total_orders,
+            'total_is_estimate': total_is_estimate,
             'page': page,
-            'per_page': per_page
+            'per_page': per_page,
+            'next_cursor': next_cursor,
+            'prev_cursor': prev_cursor
         })
         
+    except InvalidCursor as e:
+        return jsonify({'message': str(e)}), 400
     except Exception as e:
         app.logger.error(f"Get all orders error: {str(e)}")
         return jsonify({'message': str(e)}), 500
@@ -1631,6 +2746,49 @@ def get_all_orders():
         cur.close()
         conn.close()
 
+ORDER_STATUSES = ['created', 'paid', 'shipped', 'delivered', 'cancelled']
+
+# Потоковая выгрузка заказов (order_export.py)
+app.config['EXPORT_ITERSIZE'] = 2000 # Строк за одно обращение серверного курсора
+app.config['EXPORT_CHUNK_SIZE'] = 64 * 1024 # Размер куска ответа, символов
+
+def stream_order_export(fmt, clauses, params):
+    # Отдельное соединение из пула: запрос завершится раньше, чем будет прочитан ответ,
+    # поэтому соединение запроса (g.db_conn) здесь не подходит
+    conn = get_db_pool().getconn()
+    try:
+        yield from export_orders(
+            conn, fmt, clauses, params,
+            itersize=app.config['EXPORT_ITERSIZE'],
+            chunk_size=app.config['EXPORT_CHUNK_SIZE']
+        )
+    finally:
+        conn.close()
+
+# Выгрузка заказов с товарами для бухгалтерии.
+# Параметры: format=csv|ndjson, date_from / date_to (YYYY-MM-DD или ISO-время, date_to
+# включительно), status=paid,shipped. Ответ отдается потоком по мере чтения из БД.
+@app.route('/api/admin/orders/export', methods=['GET'])
+@jwt_required()
+@admin_required
+def export_all_orders():
+    fmt = request.args.get('format', 'csv')
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({'message': 'format must be csv or ndjson'}), 400
+    statuses = [status for status in request.args.get('status', '').split(',') if status]
+    try:
+        clauses, params = export_filters(
+            request.args.get('date_from'), request.args.get('date_to'), statuses, ORDER_STATUSES
+        )
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+
+    response = Response(stream_order_export(fmt, clauses, params), mimetype=EXPORT_MIMETYPES[fmt])
+    filename = f"orders-{datetime.now().strftime('%Y%m%d-%H%M%S')}.{fmt}"
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
 # Получить детальную информацию о заказе
 @app.route('/api/admin/orders/<int:order_id>', methods=['GET'])
 @jwt_required()
@@ -1690,8 +2848,7 @@ def update_order_status(order_id):
     if not data or 'status' not in data:
         return jsonify({'message': 'Status is required'}), 400
     
-    valid_statuses = ['created', 'paid', 'shipped', 'delivered', 'cancelled']
-    if data['status'] not in valid_statuses:
+    if data['status'] not in ORDER_STATUSES:
         return jsonify({'message': 'Invalid status'}), 400
     
     try:
@@ -1726,6 +2883,13 @@ def update_order_status(order_id):
         
         cur.execute(update_query, update_values)
         updated_order = cur.fetchone()
+        
+        # При отмене зарезервированные остатки возвращаются
+        if data['status'] == 'cancelled' and order['status'] != 'cancelled':
+            albums = release_order(conn, order_id, app.config['INVENTORY_TRACK_ALL'])
+            if albums:
+                on_display_stock_change(conn, albums)
+        
         conn.commit()
         
         return jsonify(updated_order)
@@ -1769,6 +2933,110 @@ def delete_order(order_id):
         conn.close()
 
 
+# =============================================================================================
+# ===================================== АНАЛИТИКА =============================================
+# =============================================================================================
+
+# Отчеты читают дневные агрегаты sales_daily с еще не перенесенными приращениями (analytics.py),
+# а не историю заказов
+
+ANALYTICS_TOP_MAX_LIMIT = 100
+
+def analytics_args():
+    dimension = request.args.get('dimension', 'category')
+    if dimension not in DIMENSIONS:
+        raise ValueError(f"dimension must be one of: {', '.join(DIMENSIONS)}")
+    date_from, date_to = date_range(request.args.get('date_from'), request.args.get('date_to'))
+    return dimension, date_from, date_to
+
+# Продажи по дням: dimension=version|album|artist|category, key (id или категория;
+# без key - сумма по всем ключам), date_from / date_to (по умолчанию последние 30 дней)
+@app.route('/api/admin/analytics/sales', methods=['GET'])
+@jwt_required()
+@admin_required
+def get_sales_series():
+    conn = get_db_connection()
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    
+    try:
+        dimension, date_from, date_to = analytics_args()
+        key = request.args.get('key') or None
+        series, totals = sales_series(cur, dimension, key, date_from, date_to)
+        return jsonify({
+            'dimension': dimension,
+            'key': key,
+            'date_from': date_from.isoformat(),
+            'date_to': date_to.isoformat(),
+            'series': [{**row, 'day': row['day'].isoformat()} for row in series],
+            'totals': totals
+        })
+        
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+    except Exception as e:
+        app.logger.error(f"Get sales series error: {str(e)}")
+        return jsonify({'message': str(e)}), 500
+    finally:
+        cur.close()
+        conn.close()
+
+# Топ-N за период: dimension, metric=units|revenue|discount_amount, limit (до 100)
+@app.route('/api/admin/analytics/top', methods=['GET'])
+@jwt_required()
+@admin_required
+def get_top_sales():
+    conn = get_db_connection()
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    
+    try:
+        dimension, date_from, date_to = analytics_args()
+        metric = request.args.get('metric', 'revenue')
+        if metric not in METRICS:
+            return jsonify({'message': f"metric must be one of: {', '.join(METRICS)}"}), 400
+        limit = min(max(request.args.get('limit', 10, type=int), 1), ANALYTICS_TOP_MAX_LIMIT)
+        return jsonify({
+            'dimension': dimension,
+            'metric': metric,
+            'date_from': date_from.isoformat(),
+            'date_to': date_to.isoformat(),
+            'items': top_sales(cur, dimension, date_from, date_to, metric, limit)
+        })
+        
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+    except Exception as e:
+        app.logger.error(f"Get top sales error: {str(e)}")
+        return jsonify({'message': str(e)}), 500
+    finally:
+        cur.close()
+        conn.close()
+
+# Пересчет агрегатов из истории заказов: {"date_from": "...", "date_to": "..."}, без дат - вся история
+@app.route('/api/admin/analytics/backfill', methods=['POST'])
+@jwt_required()
+@admin_required
+def backfill_sales():
+    data = request.get_json(silent=True) or {}
+    conn = get_db_connection()
+    
+    try:
+        date_from = date.fromisoformat(data['date_from']) if data.get('date_from') else None
+        date_to = date.fromisoformat(data['date_to']) if data.get('date_to') else None
+    except (TypeError, ValueError):
+        return jsonify({'message': 'Dates must be YYYY-MM-DD'}), 400
+    
+    try:
+        rows = rebuild_sales(conn, date_from, date_to)
+        conn.commit()
+        return jsonify({'message': 'Sales rollups rebuilt', 'rows': rows})
+        
+    except Exception as e:
+        conn.rollback()
+        app.logger.error(f"Backfill sales error: {str(e)}")
+        return jsonify({'message': str(e)}), 500
+    finally:
+        conn.close()
+
 
 # =============================================================================================
 # ===================================== ПРОФИЛЬ ===============================================
@@ -1778,6 +3046,9 @@ def delete_order(order_id):
 @jwt_required()
 def user_profile():
     current_user = get_jwt_identity()
+    # Хеш нового пароля - до соединения; очередь хеширования переполнена - 429
+    data = request.get_json() if request.method == 'PUT' else None
+    hashed_password = hash_password(data['password']) if isinstance(data, dict) and data.get('password') else None
     conn = get_db_connection()
     cur = conn.cursor(cursor_factory=RealDictCursor)
     
@@ -1808,7 +3079,7 @@ def user_profile():
                 FROM orders o
                 LEFT JOIN user_addresses ua ON o.address_id = ua.id
                 WHERE o.user_id = %s
-                ORDER BY o.created_at DESC
+                ORDER BY o.created_at DESC, o.id DESC
                 LIMIT 5
             ''', (current_user['id'],))
             orders = cur.fetchall()
@@ -1852,8 +3123,7 @@ def user_profile():
                 update_fields.append("email = %s")
                 update_values.append(data['email'])
                 
-            if 'password' in data and data['password']:
-                hashed_password = generate_password_hash(data['password'])
+            if hashed_password is not None:
                 update_fields.append("password_hash = %s")
                 update_values.append(hashed_password)
                 
@@ -2035,6 +3305,15 @@ def user_address(address_id):
 # ===================================== ИЗБРАННОЕ =============================================
 # =============================================================================================
 
+WISHLIST_SQL = '''
+    SELECT w.id, a.id as album_id, a.title, a.main_image_url,
+           ar.name as artist_name, a.base_price
+    FROM wishlist w
+    JOIN albums a ON w.album_id = a.id
+    JOIN artists ar ON a.artist_id = ar.id
+    WHERE w.user_id = %s
+'''
+
 @app.route('/api/wishlist', methods=['GET', 'POST', 'DELETE'])
 @jwt_required()
 def wishlist():
@@ -2045,14 +3324,7 @@ def wishlist():
     try:
         if request.method == 'GET':
             # Получаем избранное пользователя
-            cur.execute('''
-                SELECT w.id, a.id as album_id, a.title, a.main_image_url,
-                       ar.name as artist_name, a.base_price
-                FROM wishlist w
-                JOIN albums a ON w.album_id = a.id
-                JOIN artists ar ON a.artist_id = ar.id
-                WHERE w.user_id = %s
-            ''', (current_user['id'],))
+            cur.execute(WISHLIST_SQL, (current_user['id'],))
             wishlist_items = cur.fetchall()
             return jsonify(wishlist_items)
             
@@ -2117,6 +3389,230 @@ def wishlist():
         cur.close()
         conn.close()
       
+
+# =============================================================================================
+# ===================================== МОНИТОРИНГ ============================================
+# =============================================================================================
+
+# Состояние пула соединений: занятые, ожидающие, гистограмма времени ожидания
+@app.route('/api/admin/db-pool', methods=['GET'])
+@jwt_required()
+@admin_required
+def db_pool_stats():
+    return jsonify(get_db_pool().stats())
+
+# Состояние очередей допуска к оформлению заказа и корзине
+@app.route('/api/admin/admission', methods=['GET'])
+@jwt_required()
+@admin_required
+def admission_stats():
+    return jsonify({name: controller.stats() for name, controller in admission_controllers.items()})
+
+# Хеширование паролей: очередь, время хеширования, пересчитанные хеши
+@app.route('/api/admin/passwords', methods=['GET'])
+@jwt_required()
+@admin_required
+def password_hasher_stats():
+    return jsonify(get_password_hasher().stats())
+
+# Счетчики кэша каталога
+@app.route('/api/admin/cache', methods=['GET'])
+@jwt_required()
+@admin_required
+def catalog_cache_stats():
+    return jsonify(catalog_cache.stats())
+
+# Метрики процесса в текстовом формате Prometheus
+@app.route('/api/admin/metrics', methods=['GET'])
+@jwt_required()
+@admin_required
+def prometheus_metrics():
+    pool = get_db_pool().stats()
+    cache = catalog_cache.stats()
+    gauges = [
+        ('db_pool_size', 'Open DB connections.', pool['size']),
+        ('db_pool_in_use', 'DB connections checked out.', pool['in_use']),
+        ('db_pool_waiting', 'Requests waiting for a DB connection.', pool['waiting']),
+        ('db_pool_exhausted', 'Times the pool wait timed out (503), since start.', pool['exhausted']),
+        ('catalog_cache_entries', 'Cached catalog responses.', cache['entries']),
+        ('catalog_cache_hits', 'Catalog cache hits (fresh and stale), since start.', cache['hits'] + cache['stale_hits']),
+        ('catalog_cache_misses', 'Catalog cache misses, since start.', cache['misses']),
+    ]
+    for name, controller in admission_controllers.items():
+        admission = controller.stats()
+        gauges.append((f'admission_{name}_active', f'Admitted {name} requests in progress.', admission['active']))
+        gauges.append((f'admission_{name}_waiting', f'Requests queued for {name}.', admission['waiting']))
+    return Response(request_metrics.render(gauges), mimetype='text/plain; version=0.0.4')
+
+# Последние трассы запросов с медленным SQL: запросы, время, число строк и планы
+@app.route('/api/admin/slow-queries', methods=['GET'])
+@jwt_required()
+@admin_required
+def slow_queries():
+    limit = min(max(request.args.get('limit', 20, type=int), 1), app.config['SLOW_QUERY_MAX_TRACES'])
+    log = get_slow_query_log()
+    return jsonify({
+        'threshold_ms': app.config['SLOW_QUERY_THRESHOLD'] * 1000,
+        'stats': log.stats(),
+        'traces': log.recent(limit)
+    })
+
+@app.route('/api/admin/cache/users', methods=['GET'])
+@jwt_required()
+@admin_required
+def user_state_cache_stats():
+    return jsonify(user_state_cache.stats())
+
+# Применить новые SQL-миграции: flask --app server migrate
+@app.cli.command('migrate')
+def migrate_command():
+    conn = psycopg2.connect(**DB_CONFIG)
+    try:
+        apply_migrations(conn)
+    finally:
+        conn.close()
+
+@app.cli.command('catalog-check')
+@click.option('--fix', is_flag=True, help='Пересчитать расходящиеся строки')
+def catalog_check_command(fix):
+    # Сверка catalog_read_model с исходными таблицами
+    conn = psycopg2.connect(**DB_CONFIG)
+    try:
+        problems = check_read_model(conn, fix=fix)
+        conn.commit()
+    finally:
+        conn.close()
+    for album_id, problem in problems:
+        print(f'album {album_id}: {problem}')
+    print(f"{len(problems)} albums differ{' (fixed)' if fix and problems else ''}")
+    if problems and not fix:
+        raise SystemExit(1)
+
+@app.cli.command('import-catalog')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(IMPORT_FORMATS), help='По умолчанию - по расширению файла')
+@click.option('--dry-run', is_flag=True, help='Проверить и посчитать изменения без записи')
+@click.option('--on-error', type=click.Choice(['skip', 'abort']), default='skip')
+def import_catalog_command(path, fmt, dry_run, on_error):
+    # Массовый импорт каталога из CSV / NDJSON
+    fmt = fmt or ('csv' if path.lower().endswith('.csv') else 'ndjson')
+    def progress(event):
+        click.echo(json.dumps(event), err=True)
+    conn = psycopg2.connect(**DB_CONFIG)
+    try:
+        with open(path, 'rb') as f:
+            summary = run_catalog_import(conn, f, fmt, dry_run, on_error, progress)
+    finally:
+        conn.close()
+    click.echo(json.dumps(summary, indent=2, ensure_ascii=False))
+    if summary['error_count']:
+        raise SystemExit(1)
+
+@app.cli.command('export-orders')
+@click.option('--format', 'fmt', type=click.Choice(EXPORT_FORMATS), default='csv')
+@click.option('--date-from', help='YYYY-MM-DD или ISO-время')
+@click.option('--date-to', help='YYYY-MM-DD (включительно) или ISO-время')
+@click.option('--status', 'statuses', multiple=True, type=click.Choice(ORDER_STATUSES))
+@click.option('--output', '-o', type=click.File('w', encoding='utf-8'), default='-')
+def export_orders_command(fmt, date_from, date_to, statuses, output):
+    # Выгрузка заказов в файл или stdout тем же потоковым способом, что и эндпоинт
+    try:
+        clauses, params = export_filters(date_from, date_to, statuses)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+    conn = psycopg2.connect(**DB_CONFIG)
+    try:
+        for chunk in export_orders(conn, fmt, clauses, params, itersize=app.config['EXPORT_ITERSIZE']):
+            output.write(chunk)
+    finally:
+        conn.close()
+
+@app.cli.command('sales-backfill')
+@click.option('--date-from', type=click.DateTime(['%Y-%m-%d']), help='По умолчанию - с начала истории')
+@click.option('--date-to', type=click.DateTime(['%Y-%m-%d']), help='Включительно; по умолчанию - до конца')
+def sales_backfill_command(date_from, date_to):
+    # Пересчет дневных агрегатов продаж из истории заказов
+    conn = psycopg2.connect(**DB_CONFIG)
+    try:
+        rows = rebuild_sales(conn, date_from and date_from.date(), date_to and date_to.date())
+        conn.commit()
+    finally:
+        conn.close()
+    click.echo(f'Rebuilt {rows} sales rollup rows')
+
+@app.cli.command('inventory-stripe')
+def inventory_stripe_command():
+    # Раскладывает по корзинам остатки лимитированных версий, у которых корзин еще нет
+    conn = psycopg2.connect(**DB_CONFIG)
+    try:
+        count = stripe_versions(conn, app.config['INVENTORY_STRIPES'])
+        conn.commit()
+        print(f'Created {count} inventory buckets')
+    finally:
+        conn.close()
+
+@app.cli.command('inventory-sync')
+def inventory_sync_command():
+    # Разовая синхронизация витринных остатков с корзинами
+    albums = StockSync(lambda: psycopg2.connect(**DB_CONFIG), on_change=on_display_stock_change).run_once()
+    print(f'Updated stock for {len(albums)} albums')
+
+# =============================================================================================
+# ====================================== ЗАПУСК ===============================================
+# =============================================================================================
+
+# Продакшен: gunicorn -c gunicorn.conf.py wsgi:app (несколько процессов, см. gunicorn.conf.py).
+# Приложение импортируется в мастере до fork (preload), поэтому при импорте и в create_app
+# не открываются соединения и не запускаются потоки - это делает init_worker в каждом воркере.
+
+def create_app(config=None):
+    """Приложение с настройками из окружения и config.
+    Переменные KPOP_<КЛЮЧ> переопределяют app.config, значения разбираются как JSON
+    (KPOP_DB_POOL_MAX_SIZE=30, KPOP_DB_CONFIG__host=db)."""
+    app.config.from_prefixed_env('KPOP')
+    if config:
+        app.config.update(config)
+    DB_CONFIG.update(app.config['DB_CONFIG'])
+    app.config['DB_CONFIG'] = DB_CONFIG
+
+    # Объекты, созданные при импорте, получают переопределенные значения
+    catalog_cache.max_entries = app.config['CATALOG_CACHE_MAX_ENTRIES']
+    catalog_cache.ttl = app.config['CATALOG_CACHE_TTL']
+    catalog_cache.stale_ttl = app.config['CATALOG_CACHE_STALE_TTL']
+    user_state_cache.max_entries = app.config['USER_STATE_CACHE_MAX_ENTRIES']
+    user_state_cache.ttl = app.config['USER_STATE_CACHE_TTL']
+    for name, controller in admission_controllers.items():
+        controller.max_concurrent = app.config[f'ADMISSION_{name.upper()}_MAX_CONCURRENT']
+        controller.max_queue = app.config[f'ADMISSION_{name.upper()}_MAX_QUEUE']
+        controller.max_wait = app.config[f'ADMISSION_{name.upper()}_MAX_WAIT']
+    return app
+
+def init_worker():
+    # Ресурсы процесса: вызывается в воркере после fork, до первого запроса.
+    # Унаследованное от мастера состояние сбрасывается, пул соединений, слушатель NOTIFY,
+    # индекс скидок и перенос приращений продаж создаются уже в этом процессе
+    # (get_* сами пересоздают их по pid).
+    global _catalog_stamp
+    catalog_cache.clear()
+    user_state_cache.clear()
+    with _catalog_stamp_lock:
+        _catalog_stamp = None
+    try:
+        get_db_pool()
+        get_discount_index() # Заодно запускает слушатель NOTIFY
+        get_password_hasher()
+        get_sales_fold()
+    except Exception as e:
+        # БД недоступна при старте - ресурсы будут созданы при первом запросе
+        app.logger.error(f"Worker init error: {str(e)}")
+
 if __name__ == '__main__':
-    app.run(debug=True)
+    # Однопроцессный сервер для разработки; отладчик и перезагрузка - только при KPOP_DEBUG=true
+    create_app()
+    init_worker()
+    app.run(
+        host=os.environ.get('HOST', '127.0.0.1'),
+        port=int(os.environ.get('PORT', 5000)),
+        debug=app.config['DEBUG']
+    )
     
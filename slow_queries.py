@@ -0,0 +1,236 @@
+import logging
+import os
+import queue
+import random
+import re
+import threading
+import time
+from datetime import date, datetime, timezone
+from decimal import Decimal
+
+import psycopg2
+from psycopg2 import errors
+
+
+# Журнал медленных запросов.
+#
+# Курсоры InstrumentedConnection (metrics.py) записывают каждый SQL-запрос HTTP-запроса
+# в его трассу. Если хотя бы один запрос дольше порога, трасса целиком - нормализованный
+# текст, параметры без значений строк, время и число строк каждого запроса - попадает в
+# кольцевой буфер и в лог. Для медленных запросов в фоне снимается план
+# EXPLAIN (ANALYZE, BUFFERS): с вероятностью explain_sample, не чаще explain_per_minute
+# в минуту и не чаще раза в plan_ttl секунд для одного нормализованного текста.
+#
+# План снимается на отдельном соединении в транзакции READ ONLY, которая откатывается:
+# запросы на запись и SELECT ... FOR UPDATE получают план без ANALYZE (без выполнения).
+# Запрос для EXPLAIN содержит значения параметров, и Postgres печатает их в плане
+# (Index Cond: (email = 'alice@...'::text)) - поэтому план и текст ошибки EXPLAIN перед
+# записью в лог и буфер проходят redact_plan: строковые литералы заменяются на ?, как в
+# normalize_sql. Числа остаются - в плане это стоимости и времена, а в параметрах
+# (redact_params) числа и так показываются.
+
+logger = logging.getLogger(__name__)
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r'\b\d+(?:\.\d+)?\b')
+_WHITESPACE = re.compile(r'\s+')
+_QUOTED_VALUE = re.compile(r'"[^"]*"') # В сообщениях об ошибках значения - в двойных кавычках
+
+MAX_PARAMS_SHOWN = 20
+
+
+def normalize_sql(query):
+    """Текст запроса без литералов и лишних пробелов - одинаковый для запросов одного вида."""
+    query = _STRING_LITERAL.sub('?', query)
+    query = _NUMBER_LITERAL.sub('?', query)
+    return _WHITESPACE.sub(' ', query).strip()
+
+
+def redact_plan(text):
+    """Текст плана EXPLAIN без строковых литералов: 'alice@example.com'::text -> ?::text."""
+    return _STRING_LITERAL.sub('?', text)
+
+
+def _redact_value(value):
+    if value is None or isinstance(value, (bool, int, float, Decimal, date)):
+        return value
+    if isinstance(value, (str, bytes)):
+        return f'<{type(value).__name__}:{len(value)}>'
+    if isinstance(value, (list, tuple)):
+        return f'<list:{len(value)}>'
+    return f'<{type(value).__name__}>'
+
+
+def redact_params(params):
+    """Параметры для журнала: числа и даты как есть, строки и списки - только тип и длина."""
+    if params is None:
+        return None
+    if isinstance(params, dict):
+        return {key: _redact_value(value) for key, value in params.items()}
+    if isinstance(params, (list, tuple)) and len(params) <= MAX_PARAMS_SHOWN:
+        return [_redact_value(value) for value in params]
+    return _redact_value(params)
+
+
+class SlowQueryLog:
+    def __init__(self, dsn_kwargs, max_traces=100, explain_sample=0.2, explain_per_minute=6,
+                 explain_timeout=5.0, plan_ttl=300):
+        self.dsn_kwargs = dict(dsn_kwargs)
+        self.explain_sample = explain_sample # Доля медленных запросов, для которых снимается план
+        self.explain_per_minute = explain_per_minute
+        self.explain_timeout = explain_timeout # statement_timeout для EXPLAIN ANALYZE, сек
+        self.plan_ttl = plan_ttl # Повторно план одного запроса не снимается, сек
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        self._traces = [] # Последние трассы, новые в конце
+        self.max_traces = max_traces
+        self._plans = {} # нормализованный текст -> (время снятия, план)
+        self._tokens = float(explain_per_minute)
+        self._tokens_at = time.monotonic()
+        self._explain_queue = queue.Queue(maxsize=16)
+        self._thread = None
+
+        self.traces_logged = 0
+        self.plans_captured = 0
+        self.plans_failed = 0
+        self.explains_skipped = 0 # Не прошли выборку, лимит или очередь
+
+    def add(self, method, path, endpoint, status, duration, stats):
+        """Сохраняет трассу запроса с медленными SQL-запросами (stats - metrics.RequestStats)."""
+        statements = []
+        for query, params, elapsed, rows in stats.trace:
+            statements.append({
+                'sql': normalize_sql(query),
+                'params': redact_params(params),
+                'duration_ms': round(elapsed * 1000, 2),
+                'rows': rows,
+                'slow': elapsed >= stats.slow_threshold,
+            })
+        trace = {
+            'at': datetime.now(timezone.utc).isoformat(),
+            'method': method,
+            'path': path,
+            'endpoint': endpoint,
+            'status': status,
+            'duration_ms': round(duration * 1000, 2),
+            'queries': stats.queries,
+            'sql_ms': round(stats.sql_time * 1000, 2),
+            'truncated': stats.queries > len(statements),
+            'statements': statements,
+            'plans': [],
+        }
+        slowest = max(stats.slow, key=lambda item: item[2])
+        logger.warning('Slow SQL in %s %s (%s, %.1f ms total): %d statement(s) over %.0f ms, '
+                       'slowest %.1f ms: %s', method, path, status, duration * 1000, len(stats.slow),
+                       stats.slow_threshold * 1000, slowest[2] * 1000, normalize_sql(slowest[0]))
+        with self._lock:
+            self._traces.append(trace)
+            del self._traces[:-self.max_traces]
+            self.traces_logged += 1
+        for query, statement, elapsed in stats.slow:
+            self._schedule_explain(trace, normalize_sql(query), statement, elapsed)
+        return trace
+
+    def _take_token(self):
+        # Под self._lock
+        now = time.monotonic()
+        self._tokens = min(float(self.explain_per_minute),
+                           self._tokens + (now - self._tokens_at) * self.explain_per_minute / 60)
+        self._tokens_at = now
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+    def _schedule_explain(self, trace, normalized, statement, elapsed):
+        plan = {'sql': normalized, 'duration_ms': round(elapsed * 1000, 2), 'plan': None}
+        with self._lock:
+            cached = self._plans.get(normalized)
+            if cached is not None and time.monotonic() - cached[0] < self.plan_ttl:
+                plan.update(plan=cached[1], cached=True)
+                trace['plans'].append(plan)
+                return
+            if (statement is None or random.random() >= self.explain_sample
+                    or not self._take_token()):
+                self.explains_skipped += 1
+                return
+            trace['plans'].append(plan)
+        try:
+            self._explain_queue.put_nowait((plan, statement))
+        except queue.Full:
+            with self._lock:
+                trace['plans'].remove(plan)
+                self.explains_skipped += 1
+            return
+        self._ensure_thread()
+
+    def _ensure_thread(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='slow-query-explain', daemon=True)
+                self._thread.start()
+
+    def _explain(self, conn, statement):
+        timeout_ms = int(self.explain_timeout * 1000)
+        with conn.cursor() as cur:
+            try:
+                cur.execute(f'SET LOCAL statement_timeout = {timeout_ms}')
+                cur.execute('SET LOCAL lock_timeout = 100')
+                cur.execute(b'EXPLAIN (ANALYZE, BUFFERS) ' + statement)
+                analyzed = True
+            except errors.ReadOnlySqlTransaction:
+                # Запись или блокировка строк - только план, без выполнения
+                conn.rollback()
+                cur.execute(b'EXPLAIN ' + statement)
+                analyzed = False
+            lines = [row[0] for row in cur.fetchall()]
+        conn.rollback()
+        return redact_plan('\n'.join(lines)), analyzed
+
+    def _run(self):
+        conn = None
+        while True:
+            plan, statement = self._explain_queue.get()
+            try:
+                if conn is None or conn.closed:
+                    conn = psycopg2.connect(**self.dsn_kwargs)
+                    conn.set_session(readonly=True) # Каждая транзакция - BEGIN READ ONLY
+                text, analyzed = self._explain(conn, statement)
+            except Exception as e:
+                # Только первая строка: в следующих psycopg2 повторяет текст запроса со значениями
+                error = _QUOTED_VALUE.sub('?', redact_plan(str(e).strip().split('\n', 1)[0])) or type(e).__name__
+                logger.warning('EXPLAIN failed for %s: %s', plan['sql'], error)
+                with self._lock:
+                    plan['error'] = error
+                    self.plans_failed += 1
+                if conn is not None and not conn.closed:
+                    try:
+                        conn.rollback()
+                    except psycopg2.Error:
+                        conn.close()
+                continue
+            logger.warning('Plan for slow SQL (%.1f ms): %s\n%s', plan['duration_ms'], plan['sql'], text)
+            with self._lock:
+                plan.update(plan=text, analyzed=analyzed)
+                if len(self._plans) >= 1000:
+                    self._plans.clear()
+                self._plans[plan['sql']] = (time.monotonic(), text)
+                self.plans_captured += 1
+
+    def recent(self, limit=20):
+        """Последние трассы, новые первыми."""
+        with self._lock:
+            traces = self._traces[::-1][:limit]
+            return [dict(trace, plans=[dict(plan) for plan in trace['plans']]) for trace in traces]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'traces': len(self._traces),
+                'max_traces': self.max_traces,
+                'traces_logged': self.traces_logged,
+                'plans_captured': self.plans_captured,
+                'plans_failed': self.plans_failed,
+                'explains_skipped': self.explains_skipped,
+                'explain_queue': self._explain_queue.qsize(),
+            }
@@ -0,0 +1,57 @@
+from datetime import date
+from decimal import Decimal
+
+import pytest
+
+pytest.importorskip('psycopg2')
+
+from slow_queries import normalize_sql, redact_params, redact_plan
+
+
+def test_normalize_sql_replaces_literals_and_whitespace():
+    query = """
+        SELECT *  FROM users
+        WHERE email = 'alice@example.com' AND id > 42 AND price < 10.5
+    """
+    assert normalize_sql(query) == 'SELECT * FROM users WHERE email = ? AND id > ? AND price < ?'
+
+
+def test_normalize_sql_handles_escaped_quotes():
+    assert normalize_sql("SELECT 'it''s', 'x'") == 'SELECT ?, ?'
+
+
+def test_normalize_sql_keeps_identifiers_with_digits():
+    assert normalize_sql('SELECT v2.id FROM t1 AS v2') == 'SELECT v2.id FROM t1 AS v2'
+
+
+def test_redact_params_hides_strings_and_lists():
+    params = ('alice@example.com', b'\x00\x01', [1, 2, 3], 7, Decimal('9.99'), date(2024, 1, 2), None, True)
+    assert redact_params(params) == [
+        '<str:17>', '<bytes:2>', '<list:3>', 7, Decimal('9.99'), date(2024, 1, 2), None, True
+    ]
+
+
+def test_redact_params_dict_and_long_sequences():
+    assert redact_params({'email': 'bob@example.com', 'id': 1}) == {'email': '<str:15>', 'id': 1}
+    assert redact_params(list(range(100))) == '<list:100>'
+    assert redact_params(None) is None
+
+
+def test_redact_plan_removes_string_values():
+    plan = '\n'.join([
+        'Index Scan using users_email_key on users  (cost=0.29..8.31 rows=1 width=120) '
+        '(actual time=0.020..0.021 rows=1 loops=1)',
+        "  Index Cond: ((email)::text = 'alice@example.com'::text)",
+        "  Filter: (password_hash <> 'scrypt:32768:8:1$salt$hash'::text)",
+        "  Filter: (created_at >= '2024-01-02'::date AND tags && '{a,b}'::text[])",
+        "  Filter: (name = 'O''Brien'::text)",
+    ])
+    redacted = redact_plan(plan)
+    assert 'alice@example.com' not in redacted
+    assert 'scrypt' not in redacted
+    assert "O'Brien" not in redacted and 'Brien' not in redacted
+    assert '((email)::text = ?::text)' in redacted
+    assert '(created_at >= ?::date AND tags && ?::text[])' in redacted
+    # Стоимости и времена остаются
+    assert '(cost=0.29..8.31 rows=1 width=120)' in redacted
+    assert '(actual time=0.020..0.021 rows=1 loops=1)' in redacted
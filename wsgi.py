@@ -0,0 +1,6 @@
+"""Точка входа WSGI для продакшена:
+    gunicorn -c gunicorn.conf.py wsgi:app
+"""
+from server import create_app
+
+app = create_app()